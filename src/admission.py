@@ -0,0 +1,70 @@
+from concurrent.futures import Future
+from threading import Lock, Timer
+from typing import Callable, List, Optional, TypeVar
+import os
+
+import node_log
+
+log = node_log.get_logger(__name__)
+
+# Joins that arrive within this many seconds are committed together as one membership update
+JOIN_BATCH_WINDOW = float(os.environ.get("JOIN_BATCH_WINDOW", 0.05))
+# A batch this big is committed right away instead of waiting for the rest of the window
+MAX_JOIN_BATCH = int(os.environ.get("MAX_JOIN_BATCH", 100))
+
+T = TypeVar("T")
+
+
+class _JoinBatch:
+    __slots__ = ("player_numbers", "future")
+
+    def __init__(self):
+        self.player_numbers: List[int] = []
+        self.future: Future = Future()
+
+
+class JoinAdmissions:
+    """
+    Joins of one game waiting for their membership update. The players already have their numbers,
+    the batch is committed once for all of them and every joiner gets the result of the commit.
+    """
+
+    def __init__(self, window: float = JOIN_BATCH_WINDOW, max_batch: int = MAX_JOIN_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = Lock()
+        self.batch: Optional[_JoinBatch] = None
+
+    # Adds the player to the open batch, or opens one. The commit gets the player numbers of the whole batch.
+    def admit(self, player_number: int, commit: Callable[[List[int]], T]) -> "Future[T]":
+        with self.lock:
+            batch = self.batch
+            opened = batch is None
+            if opened:
+                batch = self.batch = _JoinBatch()
+            batch.player_numbers.append(player_number)
+            full = len(batch.player_numbers) >= self.max_batch
+            if full:
+                self.batch = None
+        if full:
+            # The joiner that filled the batch commits it, the timer finds it already gone
+            self._commit(batch, commit)
+        elif opened:
+            timer = Timer(self.window, self.flush, [batch, commit])
+            timer.daemon = True
+            timer.start()
+        return batch.future
+
+    def flush(self, batch: _JoinBatch, commit: Callable[[List[int]], T]):
+        with self.lock:
+            if self.batch is not batch:
+                return
+            self.batch = None
+        self._commit(batch, commit)
+
+    def _commit(self, batch: _JoinBatch, commit: Callable[[List[int]], T]):
+        try:
+            batch.future.set_result(commit(batch.player_numbers))
+        except Exception as e:
+            log.warning("Committing the joins of players %s failed: %s", batch.player_numbers, e)
+            batch.future.set_exception(e)
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+import aiohttp
+from aiohttp import web
+from werkzeug.http import parse_etags
+
+from game_snapshot import MAX_STATE_WAIT, GameStateSnapshot
+import metrics
+import network
+import node_log
+from network import BroadcastResult
+import state
+
+log = node_log.get_logger(__name__)
+
+# The route handlers are synchronous Flask views. They run in worker threads,
+# while all connections, request bodies and outbound broadcasts live on one event loop.
+HANDLER_THREADS = int(os.environ.get("HANDLER_THREADS", 64))
+# Handlers that wait for other nodes, e.g. the next helper of the shuffle chain or the membership update of a join,
+# run in a pool of their own, so that they cannot take up the threads of the quick ones
+BLOCKING_HANDLER_THREADS = int(os.environ.get("BLOCKING_HANDLER_THREADS", 512))
+BLOCKING_ROUTES = {"/join", "/shuffle-stage", "/plz-help-with-encrypting", "/pooled-deck"}
+# Headers that belong to a single connection and are not passed between WSGI and aiohttp
+_HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+
+
+class _StreamingInput:
+    """
+    wsgi.input that pulls the request body from the event loop only when a handler reads it,
+    so that handlers can start working on a body that is still arriving.
+    """
+
+    def __init__(self, content: aiohttp.StreamReader, loop: asyncio.AbstractEventLoop):
+        self.content = content
+        self.loop = loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # Werkzeug treats a short read as a disconnect, so read until size bytes or the end of the body
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return self._run(self.content.read())
+        data = b""
+        while len(data) < size:
+            more = self._run(self.content.read(size - len(data)))
+            if not more:
+                break
+            data += more
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._run(self.content.readline())
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+# None for a game this node does not know, the Flask view answers that
+def _game_and_snapshot(game_id: str) -> Optional[Tuple[state.GameSession, GameStateSnapshot]]:
+    game = state.find_session(game_id)
+    return (game, game.state_snapshot()) if game is not None else None
+
+
+class PeerResponse:
+    """
+    Response of a peer to a broadcast sent with the async client, mimics the parts of requests.Response the handlers use.
+    """
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+class AsyncNodeServer:
+    """
+    Serves the Flask app of the node on an aiohttp event loop and sends broadcasts with an aiohttp client.
+    """
+
+    def __init__(self, wsgi_app, host: str, port: int):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.client: Optional[aiohttp.ClientSession] = None
+        self.handler_executor = ThreadPoolExecutor(max_workers=HANDLER_THREADS, thread_name_prefix="handler")
+        self.blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_HANDLER_THREADS, thread_name_prefix="blocking-handler")
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.handler_executor)
+        local_addr = (network.NODE_HOST, 0) if network.NODE_HOST != "0.0.0.0" else None
+        connector = aiohttp.TCPConnector(
+            limit=0, limit_per_host=network.CONNECTIONS_PER_NODE, local_addr=local_addr
+        )
+        self.client = aiohttp.ClientSession(connector=connector)
+        network.set_broadcaster(self.broadcast)
+
+        runner = web.ServerRunner(web.Server(self.handle))
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        await site.start()
+        log.info("Serving on http://%s:%s with the asyncio runtime", self.host, self.port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            network.set_broadcaster(None)
+            await self.client.close()
+            await runner.cleanup()
+
+    def _environ(self, request: web.BaseRequest) -> Dict[str, Any]:
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": request.path,
+            "QUERY_STRING": request.query_string,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": _StreamingInput(request.content, self.loop),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            # aiohttp has already removed any chunked encoding, the body simply ends
+            "wsgi.input_terminated": True,
+        }
+        for (name, value) in request.headers.items():
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            elif f"HTTP_{key}" in environ:
+                environ[f"HTTP_{key}"] += "," + value
+            else:
+                environ[f"HTTP_{key}"] = value
+        return environ
+
+    # Runs the Flask app in a worker thread. Responses with a known length are read completely in the worker,
+    # streamed responses are handed over chunk by chunk.
+    def _call_wsgi_app(self, environ):
+        started: Dict[str, Any] = {}
+
+        def start_response(status: str, headers: List, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        app_iter = self.wsgi_app(environ, start_response)
+        headers = started["headers"]
+        if any(name.lower() == "content-length" for (name, _) in headers):
+            try:
+                return started["status"], headers, b"".join(app_iter), None
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+        return started["status"], headers, None, iter(app_iter)
+
+    # Long-polls of the game state wait for a change here on the event loop, so that thousands of spectators
+    # do not take up the handler threads. The Flask view then answers right away.
+    async def _wait_for_state_change(self, request: web.BaseRequest, environ: Dict[str, Any]):
+        path = request.path
+        if request.method != "GET" or not path.endswith("/state") or "wait" not in request.query:
+            return
+        parts = path.split("/")
+        if path == "/state":
+            game_id = state.DEFAULT_GAME_ID
+        elif len(parts) == 4 and parts[1] == "games":
+            game_id = parts[2]
+        else:
+            return
+        try:
+            wait = min(float(request.query["wait"]), MAX_STATE_WAIT)
+        except ValueError:
+            return
+        environ["QUERY_STRING"] = urlencode([(name, value) for (name, value) in parse_qsl(request.query_string) if name != "wait"])
+        # Finding the game takes the lock of the sessions, which must not happen on the event loop
+        found = await self.loop.run_in_executor(self.handler_executor, _game_and_snapshot, game_id)
+        if found is None:
+            return
+        (game, snapshot) = found
+        if wait <= 0 or not parse_etags(request.headers.get("If-None-Match")).contains(snapshot.etag):
+            return
+        changed = asyncio.Event()
+        watcher = lambda: self.loop.call_soon_threadsafe(changed.set)
+        game.add_state_watcher(watcher)
+        try:
+            if game.state_version == snapshot.version:
+                await asyncio.wait_for(changed.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            game.remove_state_watcher(watcher)
+
+    async def handle(self, request: web.BaseRequest) -> web.StreamResponse:
+        environ = self._environ(request)
+        await self._wait_for_state_change(request, environ)
+        executor = self.blocking_executor if metrics.route_of(request.path) in BLOCKING_ROUTES else self.handler_executor
+        (status, headers, body, chunks) = await self.loop.run_in_executor(
+            executor, self._call_wsgi_app, environ
+        )
+        response_headers = [(name, value) for (name, value) in headers if name.lower() not in _HOP_BY_HOP_HEADERS]
+        if chunks is None:
+            return web.Response(status=status, headers=response_headers, body=body)
+
+        response = web.StreamResponse(status=status, headers=response_headers)
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        try:
+            while True:
+                chunk = await self.loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+        finally:
+            if hasattr(chunks, "close"):
+                await self.loop.run_in_executor(executor, chunks.close)
+        await response.write_eof()
+        return response
+
+    async def _post(self, node, path: str, game_id: str, timeout: float, kwargs) -> PeerResponse:
+        started = time.perf_counter()
+        ok = False
+        try:
+            async with self.client.post(
+                network.node_url(node, path, game_id),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                **kwargs,
+            ) as response:
+                content = await response.read()
+                response.raise_for_status()
+                ok = True
+                return PeerResponse(response.status, response.headers, content)
+        finally:
+            metrics.record_outbound(node.ip, path, time.perf_counter() - started, ok)
+
+    async def _broadcast(self, nodes, path: str, game_id: str, timeout: float, deadline: Optional[float], kwargs) -> BroadcastResult:
+        result = BroadcastResult(path)
+        tasks = {
+            asyncio.ensure_future(self._post(node, path, game_id, timeout, kwargs)): node.player_number
+            for node in nodes
+        }
+        if len(tasks) == 0:
+            return result
+        done, not_done = await asyncio.wait(tasks, timeout=deadline)
+        for task in done:
+            try:
+                result.responses[tasks[task]] = task.result()
+            except Exception as e:
+                result.failures[tasks[task]] = e
+        for task in not_done:
+            task.cancel()
+            result.failures[tasks[task]] = TimeoutError(
+                f"No response before the broadcast deadline of {deadline}s"
+            )
+        return result
+
+    # Called from handler and command line threads, never from the event loop itself
+    def broadcast(self, nodes, path: str, game_id: str, timeout: float, deadline: Optional[float], kwargs) -> BroadcastResult:
+        return asyncio.run_coroutine_threadsafe(
+            self._broadcast(list(nodes), path, game_id, timeout, deadline, kwargs), self.loop
+        ).result()
+
+
+def serve(wsgi_app, host: str, port: int):
+    AsyncNodeServer(wsgi_app, host, port).serve_forever()
@@ -0,0 +1,150 @@
+from concurrent.futures import Future
+from threading import Lock, Timer
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import os
+import requests
+
+from classes import BatchedMessage, MessageBatchRequest
+from node_registry import PlayerRecord
+import network
+import node_log
+import overlay
+import state
+
+log = node_log.get_logger(__name__)
+
+# Messages of a game to the same nodes that are sent within this many seconds go to every node in one request
+MESSAGE_BATCH_WINDOW = float(os.environ.get("MESSAGE_BATCH_WINDOW", 0.005))
+BATCH_PATH = "/messages"
+
+
+class BatchedResponse:
+    """
+    Response to one message of a batch, mimics the parts of requests.Response the senders use.
+    """
+
+    def __init__(self, status_code: int, body: Any):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self) -> Any:
+        return self.body
+
+
+class _Batch:
+    __slots__ = ("game", "nodes", "direct", "messages", "futures")
+
+    def __init__(self, game: state.GameSession, nodes: List[PlayerRecord], direct: bool):
+        self.game = game
+        self.nodes = nodes
+        self.direct = direct
+        self.messages: List[BatchedMessage] = []
+        self.futures: List[Future] = []
+
+
+def _send_directly(
+    game: state.GameSession,
+    nodes: Iterable[PlayerRecord],
+    path: str,
+    json: Any = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> network.BroadcastResult:
+    return network.broadcast(nodes, path, game.game_id, json=json, headers=headers)
+
+
+class MessageBatcher:
+    """
+    Collects the messages of a game to the same nodes for MESSAGE_BATCH_WINDOW and sends them to every node
+    in one request to /messages, where they are handled in order. Nodes that do not know /messages get them one by one.
+    """
+
+    def __init__(self, window: float = MESSAGE_BATCH_WINDOW):
+        self.window = window
+        self.lock = Lock()
+        self.batches: Dict[Tuple[str, Tuple[int, ...], bool], _Batch] = {}
+
+    # Does not wait for the nodes. The future gets the result of the message as if it had been disseminated on its own.
+    # Direct messages are sent to every node by this node itself, never through the overlay,
+    # for handlers that tell the sender by the address the request came from.
+    def send(
+        self,
+        game: state.GameSession,
+        nodes: Iterable[PlayerRecord],
+        path: str,
+        json: Any = None,
+        headers: Optional[Dict[str, str]] = None,
+        direct: bool = False,
+    ) -> "Future[network.BroadcastResult]":
+        nodes = list(nodes)
+        message: BatchedMessage = {"path": path, "headers": headers or {}, "json": json}
+        future: "Future[network.BroadcastResult]" = Future()
+        key = (game.game_id, tuple(sorted(node.player_number for node in nodes)), direct)
+        with self.lock:
+            batch = self.batches.get(key)
+            scheduled = batch is not None
+            if not scheduled:
+                batch = self.batches[key] = _Batch(game, nodes, direct)
+            batch.messages.append(message)
+            batch.futures.append(future)
+        if not scheduled:
+            timer = Timer(self.window, self.flush, [key])
+            timer.daemon = True
+            timer.start()
+        return future
+
+    def flush(self, key: Tuple[str, Tuple[int, ...], bool]):
+        with self.lock:
+            batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        try:
+            results = self._send(batch)
+        except Exception as e:
+            log.warning("Sending a batch of %s messages failed: %s", len(batch.messages), e)
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+        for (future, result) in zip(batch.futures, results):
+            future.set_result(result)
+
+    def _send(self, batch: _Batch) -> List[network.BroadcastResult]:
+        game = batch.game
+        send = _send_directly if batch.direct else overlay.disseminate
+        if len(batch.messages) == 1:
+            message = batch.messages[0]
+            return [send(game, batch.nodes, message["path"], json=message["json"], headers=message["headers"])]
+
+        body: MessageBatchRequest = {"messages": batch.messages}
+        sent = send(game, batch.nodes, BATCH_PATH, json=body)
+        results = [network.BroadcastResult(message["path"]) for message in batch.messages]
+        for (player_number, response) in sent.responses.items():
+            for (message, message_result, result) in zip(batch.messages, response.json()["results"], results):
+                if message_result["status"] >= 400:
+                    result.failures[player_number] = requests.HTTPError(
+                        f"{message_result['status']} for {message['path']} in a batch: {message_result['json']}",
+                        response=BatchedResponse(message_result["status"], message_result["json"]),
+                    )
+                else:
+                    result.responses[player_number] = BatchedResponse(message_result["status"], message_result["json"])
+
+        # Older nodes do not know /messages
+        unbatched = []
+        for (player_number, error) in sent.failures.items():
+            if network.status_code_of(error) in (404, 405):
+                unbatched.append(player_number)
+            else:
+                for result in results:
+                    result.failures[player_number] = error
+        if len(unbatched) > 0:
+            nodes = [node for node in batch.nodes if node.player_number in unbatched]
+            for (message, result) in zip(batch.messages, results):
+                single = network.broadcast(nodes, message["path"], game.game_id, json=message["json"], headers=message["headers"])
+                result.responses.update(single.responses)
+                result.failures.update(single.failures)
+
+        for result in results:
+            network.log_failures(log, "Sending %s in a batch", result)
+        return results
+
+
+batcher = MessageBatcher()
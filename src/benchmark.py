@@ -0,0 +1,145 @@
+"""
+Benchmarks joining and playing on local tables of growing size, and saves the results so that later changes
+can be compared with them.
+
+For every table size a LocalCluster is started, the nodes join the first one one after another and the leader
+plays a few rounds. Measured are
+- how long joining takes
+- how long each phase of a round takes: shuffling and dealing, collecting the keys, and the fairness vote
+- how many requests the nodes receive per round, heartbeats not included
+- how much processor time a node uses per round
+
+Run with e.g. `python benchmark.py 3 10 30 --rounds 5`, and compare with an earlier run with
+`python benchmark.py 3 10 30 --compare benchmark-results/<earlier run>.json`.
+Every node is a process of its own, tables of hundreds of players need a lot of memory.
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import datetime
+import json
+import os
+import statistics
+
+from cluster import LocalCluster
+import network
+
+DEFAULT_TABLE_SIZES = [3, 10, 30]
+DEFAULT_ROUNDS = 5
+RESULTS_DIRECTORY = "benchmark-results"
+# Settings of the nodes that change the results, saved with them
+_SETTINGS = (
+    "NODE_RUNTIME",
+    "DISSEMINATION_MODE",
+    "TREE_FANOUT",
+    "SHUFFLE_STAGES",
+    "DECK_POOL_SIZE",
+    "MESSAGE_BATCH_WINDOW",
+    "GAME_LOG_DIR",
+)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize_ms(values: List[float]) -> Optional[Dict[str, float]]:
+    if len(values) == 0:
+        return None
+    return {
+        "median": round(statistics.median(values) * 1000, 2),
+        "p95": round(percentile(values, 0.95) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+def benchmark_table(number_of_nodes: int, rounds: int) -> Dict[str, Any]:
+    with LocalCluster(number_of_nodes) as cluster:
+        join_times = cluster.join_all()
+        # The leader fills its deck pool while nobody is playing, the rounds start after that
+        cluster.play_round()
+
+        requests_before = sum(node.requests_received() for node in cluster.nodes)
+        cpu_before = [node.cpu_seconds() for node in cluster.nodes]
+        phases: Dict[str, List[float]] = {}
+        for round_number in range(1, rounds + 1):
+            timings = cluster.play_round()
+            print(f"{number_of_nodes} players, round {round_number}: {timings.phases()}")
+            for (phase, duration) in timings.phases().items():
+                if duration is not None:
+                    phases.setdefault(phase, []).append(duration)
+        requests_after = sum(node.requests_received() for node in cluster.nodes)
+        cpu_per_round = [(node.cpu_seconds() - before) / rounds for (node, before) in zip(cluster.nodes, cpu_before)]
+
+    return {
+        "players": number_of_nodes,
+        "rounds": rounds,
+        "join_ms": summarize_ms(join_times),
+        "phases_ms": {phase: summarize_ms(durations) for (phase, durations) in phases.items()},
+        "requests_per_round": round((requests_after - requests_before) / rounds, 1),
+        "cpu_ms_per_node_per_round": {
+            "mean": round(statistics.mean(cpu_per_round) * 1000, 2),
+            "max": round(max(cpu_per_round) * 1000, 2),
+        },
+    }
+
+
+# "phases_ms.total.median" and so on, for comparing two runs
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for (name, value) in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and name not in ("players", "rounds"):
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(earlier: Dict[str, Any], current: Dict[str, Any]):
+    for (players, table) in current["tables"].items():
+        earlier_table = earlier["tables"].get(players)
+        if earlier_table is None:
+            print(f"{players} players: not in the earlier run")
+            continue
+        print(f"{players} players, compared with {earlier['created']}:")
+        earlier_metrics = flatten(earlier_table)
+        for (metric, value) in flatten(table).items():
+            if metric not in earlier_metrics:
+                continue
+            before = earlier_metrics[metric]
+            change = f"{(value - before) / before * 100:+.1f} %" if before != 0 else "n/a"
+            print(f"  {metric}: {before} -> {value} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks local tables of growing size.")
+    parser.add_argument("table_sizes", nargs="*", type=int, default=DEFAULT_TABLE_SIZES, help="numbers of players")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS, help="rounds played at every table")
+    parser.add_argument("--output", help=f"where to save the results, by default a new file in {RESULTS_DIRECTORY}/")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    arguments = parser.parse_args()
+
+    created = datetime.datetime.now().isoformat(timespec="seconds")
+    results: Dict[str, Any] = {
+        "created": created,
+        "settings": {name: os.environ[name] for name in _SETTINGS if name in os.environ},
+        "port": network.PORT,
+        "tables": {},
+    }
+    for number_of_nodes in arguments.table_sizes:
+        results["tables"][str(number_of_nodes)] = benchmark_table(number_of_nodes, arguments.rounds)
+
+    output = arguments.output or os.path.join(RESULTS_DIRECTORY, f"benchmark-{created.replace(':', '')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Saved the results to {output}")
+    print(json.dumps(results["tables"], indent=2))
+
+    if arguments.compare:
+        with open(arguments.compare) as earlier_file:
+            compare(json.load(earlier_file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+from array import array
+from functools import lru_cache
+from math import gcd
+from typing import Dict, List, Sequence, Type
+import base64
+import os
+import secrets
+import sys
+
+from cryptography.fernet import Fernet
+
+# Cipher used for new decks, every node encrypts a deck with the cipher the deck was started with
+DEFAULT_CIPHER = os.environ.get("DECK_CIPHER", "fernet")
+
+
+class CardCipher:
+    """
+    Interface of the deck encryption backends. Cards are raw bytes and keys are strings so that they can be shared in JSON.
+    The cipher is built once per key and encrypts or decrypts a whole deck in one call.
+    """
+
+    name = ""
+    # Commutative ciphers can remove encryption layers in any order
+    commutative = False
+
+    def __init__(self, key: str):
+        self.key = key
+
+    @classmethod
+    def generate(cls) -> "CardCipher":
+        raise NotImplementedError
+
+    # Plain card values to payloads that can be encrypted
+    def encode_cards(self, values: Sequence[int]) -> List[bytes]:
+        raise NotImplementedError
+
+    def decode_cards(self, payloads: Sequence[bytes]) -> List[int]:
+        raise NotImplementedError
+
+    def encrypt_batch(self, payloads: Sequence[bytes]) -> List[bytes]:
+        raise NotImplementedError
+
+    def decrypt_batch(self, tokens: Sequence[bytes]) -> List[bytes]:
+        raise NotImplementedError
+
+
+# Cards are stored as unsigned big-endian integers of this many bytes before Fernet encryption
+CARD_WIDTH = 2
+
+
+# Pack card numbers into one contiguous buffer of fixed width big-endian integers
+def pack_card_values(values: Sequence[int]) -> bytes:
+    packed = array("H", values)
+    if sys.byteorder == "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_card_values(buffer: bytes) -> List[int]:
+    unpacked = array("H")
+    unpacked.frombytes(buffer)
+    if sys.byteorder == "little":
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+class FernetCipher(CardCipher):
+    """
+    Every layer wraps the previous token, so layers have to be removed in reverse order.
+    """
+
+    name = "fernet"
+
+    def __init__(self, key: str):
+        # The key is shared between nodes as base64 of the Fernet key
+        super().__init__(key)
+        self.fernet = Fernet(base64.b64decode(key.encode("ascii")))
+
+    @classmethod
+    def generate(cls) -> "FernetCipher":
+        return cls(base64.b64encode(Fernet.generate_key()).decode("ascii"))
+
+    def encode_cards(self, values: Sequence[int]) -> List[bytes]:
+        buffer = memoryview(pack_card_values(values))
+        return [bytes(buffer[i : i + CARD_WIDTH]) for i in range(0, len(buffer), CARD_WIDTH)]
+
+    def decode_cards(self, payloads: Sequence[bytes]) -> List[int]:
+        return unpack_card_values(b"".join(payloads))
+
+    def encrypt_batch(self, payloads: Sequence[bytes]) -> List[bytes]:
+        encrypt = self.fernet.encrypt
+        return [encrypt(payload) for payload in payloads]
+
+    def decrypt_batch(self, tokens: Sequence[bytes]) -> List[bytes]:
+        decrypt = self.fernet.decrypt
+        return [decrypt(token) for token in tokens]
+
+
+# RFC 2409 1024-bit MODP group, a safe prime p = 2q + 1
+SRA_PRIME = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1"
+    "29024E088A67CC74020BBEA63B139B22514A08798E3404DD"
+    "EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245"
+    "E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE65381"
+    "FFFFFFFFFFFFFFFF",
+    16,
+)
+SRA_ORDER = SRA_PRIME - 1
+SRA_SUBGROUP_ORDER = SRA_ORDER // 2
+# Every encrypted card is exactly this many bytes, no matter how many layers it has
+SRA_WIDTH = (SRA_PRIME.bit_length() + 7) // 8
+# Plain card values are below this, everything above is the negated form of a card
+_SRA_MAX_PLAIN = 1 << 16
+
+
+@lru_cache(maxsize=None)
+def _sra_encode_value(value: int) -> int:
+    # Shift away from 0 and 1 and map every card to a quadratic residue.
+    # Otherwise the residuosity of a card would survive encryption and leak one bit of it.
+    m = value + 2
+    if pow(m, SRA_SUBGROUP_ORDER, SRA_PRIME) != 1:
+        # -1 is not a residue as p = 3 mod 4, so -m is
+        m = SRA_PRIME - m
+    return m
+
+
+def _sra_decode_value(m: int) -> int:
+    if m >= _SRA_MAX_PLAIN:
+        m = SRA_PRIME - m
+    return m - 2
+
+
+class SraCipher(CardCipher):
+    """
+    SRA / Pohlig-Hellman cipher, card^e mod p. Encryption layers commute, so they can be removed in any order
+    or all at once, and cards stay SRA_WIDTH bytes however many nodes encrypted them.
+    """
+
+    name = "sra"
+    commutative = True
+
+    def __init__(self, key: str):
+        super().__init__(key)
+        # Both exponents are computed once per key
+        self.exponent = int(key[len("sra:") :], 16)
+        self.inverse_exponent = pow(self.exponent, -1, SRA_ORDER)
+
+    @classmethod
+    def generate(cls) -> "SraCipher":
+        while True:
+            exponent = secrets.randbelow(SRA_ORDER - 3) + 3
+            if gcd(exponent, SRA_ORDER) == 1:
+                return cls(f"sra:{exponent:x}")
+
+    # A single cipher that removes (or adds) all the layers of the given ciphers with one exponentiation
+    @classmethod
+    def combine(cls, ciphers: Sequence["SraCipher"]) -> "SraCipher":
+        exponent = 1
+        for cipher in ciphers:
+            exponent = exponent * cipher.exponent % SRA_ORDER
+        return cls(f"sra:{exponent:x}")
+
+    def encode_cards(self, values: Sequence[int]) -> List[bytes]:
+        return [_sra_encode_value(value).to_bytes(SRA_WIDTH, "big") for value in values]
+
+    def decode_cards(self, payloads: Sequence[bytes]) -> List[int]:
+        return [_sra_decode_value(int.from_bytes(payload, "big")) for payload in payloads]
+
+    def encrypt_batch(self, payloads: Sequence[bytes]) -> List[bytes]:
+        return self._pow_all(payloads, self.exponent)
+
+    def decrypt_batch(self, tokens: Sequence[bytes]) -> List[bytes]:
+        return self._pow_all(tokens, self.inverse_exponent)
+
+    def _pow_all(self, cards: Sequence[bytes], exponent: int) -> List[bytes]:
+        from_bytes = int.from_bytes
+        return [
+            pow(from_bytes(card, "big"), exponent, SRA_PRIME).to_bytes(SRA_WIDTH, "big")
+            for card in cards
+        ]
+
+
+CIPHERS: Dict[str, Type[CardCipher]] = {
+    FernetCipher.name: FernetCipher,
+    SraCipher.name: SraCipher,
+}
+# Cipher ids used in the binary deck format
+CIPHER_IDS: Dict[str, int] = {FernetCipher.name: 0, SraCipher.name: 1}
+CIPHER_NAMES: Dict[int, str] = {cipher_id: name for (name, cipher_id) in CIPHER_IDS.items()}
+
+
+@lru_cache(maxsize=64)
+def cipher_for_key(key: str) -> CardCipher:
+    if key.startswith("sra:"):
+        return SraCipher(key)
+    return FernetCipher(key)
+
+
+# Decrypt all layers of the cards. Keys are given in the reverse order of encryption, outermost layer first.
+def decrypt_cards(tokens: Sequence[bytes], keys: Sequence[str]) -> List[int]:
+    ciphers = [cipher_for_key(key) for key in keys]
+    if len(ciphers) > 1 and all(cipher.commutative for cipher in ciphers):
+        # Order does not matter, so all layers are removed with one exponentiation per card
+        ciphers = [SraCipher.combine(ciphers)]
+    for cipher in ciphers:
+        tokens = cipher.decrypt_batch(tokens)
+    return ciphers[-1].decode_cards(tokens)
@@ -1,10 +1,11 @@
 import json
-from typing import Dict, TypedDict
+from typing import Dict, Iterator, List, Optional, Sequence, TypedDict, Union
 import base64
 import random
+import struct
 from enum import Enum
 
-from cryptography.fernet import Fernet
+from ciphers import CIPHER_IDS, CIPHER_NAMES, CIPHERS, DEFAULT_CIPHER, decrypt_cards
 
 class Player(TypedDict):
     player_number: int
@@ -12,16 +13,91 @@ class Player(TypedDict):
     score: int
 
 
+# Binary deck wire format:
+# magic, cipher id as uint8, number of cards as uint32 and then every card as uint32 length followed by the raw token
+DECK_MAGIC = b"DCK1"
+DECK_MIMETYPE = "application/octet-stream"
+_uint32 = struct.Struct(">I")
+
+
+# Number of cards sent at a time when a deck is streamed
+DECK_STREAM_CHUNK_SIZE = 13
+
+
+# Encrypted cards are kept as raw token bytes, JSON messages carry them as base64 strings
+def card_to_token(card) -> bytes:
+    if type(card) == str:
+        return base64.b64decode(card.encode("ascii"))
+    return bytes(card)
+
+
+class DeckStreamReader:
+    """
+    Reads a binary deck from a file-like stream, handing out cards in chunks as soon as they have arrived.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        header = self._read_exact(9)
+        if header[:4] != DECK_MAGIC:
+            raise ValueError("Not a binary deck")
+        self.cipher = CIPHER_NAMES[header[4]]
+        (self.number_of_cards,) = _uint32.unpack_from(header, 5)
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        while len(data) < size:
+            more = self.stream.read(size - len(data))
+            if not more:
+                raise ValueError("Binary deck ended too early")
+            data += more
+        return data
+
+    def iter_chunks(self, chunk_size: int = DECK_STREAM_CHUNK_SIZE) -> Iterator[List[bytes]]:
+        chunk = []
+        for _ in range(self.number_of_cards):
+            (length,) = _uint32.unpack(self._read_exact(4))
+            chunk.append(self._read_exact(length))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
 class Deck:
 
     # Make a new deck 0-51
-    # Init Deck from a JSON deck if provided
-    def __init__(self, jsonString = None):
-        if jsonString is None:
+    # Init Deck from a JSON deck or from already parsed cards if provided
+    # The cipher is the one the deck has been, or will be, encrypted with
+    def __init__(self, jsonString = None, cards = None, cipher = DEFAULT_CIPHER):
+        self.cipher = cipher
+        if cards is not None:
+            self.cards = cards
+        elif jsonString is None:
             self.cards = list(range(52))
         else:
-            self.cards = json.loads(jsonString)
-        self.top_card = 51
+            self.cards = [card_to_token(card) for card in json.loads(jsonString)]
+        self.top_card = len(self.cards) - 1
+
+    # Init Deck from the binary wire format. Cards are memoryview slices of the buffer, nothing is copied.
+    @staticmethod
+    def from_bytes(buffer: bytes) -> "Deck":
+        view = memoryview(buffer)
+        if bytes(view[:4]) != DECK_MAGIC:
+            raise ValueError("Not a binary deck")
+        cipher = CIPHER_NAMES[view[4]]
+        (number_of_cards,) = _uint32.unpack_from(view, 5)
+        offset = 9
+        cards = []
+        for _ in range(number_of_cards):
+            (length,) = _uint32.unpack_from(view, offset)
+            offset += 4
+            cards.append(view[offset : offset + length])
+            offset += length
+        if offset != len(view):
+            raise ValueError("Binary deck has trailing data")
+        return Deck(cards=cards, cipher=cipher)
 
     # Get the top card
     def pop(self):
@@ -35,43 +111,43 @@ class Deck:
 
     # encrypt the deck with a key and return the key
     def encrypt_all(self):
-        key = Fernet.generate_key()
-        fernet = Fernet(key)
-        for i in range(52):
-            card = self.cards[i]
-            card_bytes = None
-            if type(card) == int:
-                card_bytes = card.to_bytes(self.cards[i].bit_length() + 7 // 8, "big")
-            if type(card) == str:
-                card_bytes =  base64.b64decode(card.encode("ascii"))
-            if type(card) == bytes:
-                card_bytes = card
-            self.cards[i] = base64.b64encode(fernet.encrypt(
-                card_bytes
-            )).decode("ascii")
-        return base64.b64encode(key).decode("ascii")
-
-    def decrypt_helper(key: str, card):
-        fernet = Fernet(base64.b64decode(key.encode("ascii")))
-        decrypted = None
-        try:
-            decrypted = fernet.decrypt(base64.b64decode(card.encode("ascii")))
-        except:
-            decrypted = fernet.decrypt(card.encode("ascii"))
-        return decrypted.decode("ascii")
-
-    def decrypt_one(key: str, card):
-        fernet = Fernet(base64.b64decode(key.encode("ascii")))
-        decrypted = None
-        try:
-            decrypted = fernet.decrypt(base64.b64decode(card.encode("ascii")))
-        except:
-            decrypted = fernet.decrypt(card.encode("ascii"))
-        return int.from_bytes(decrypted, "big")
+        cipher = CIPHERS[self.cipher].generate()
+        if all(type(card) == int for card in self.cards):
+            payloads = cipher.encode_cards(self.cards)
+        else:
+            # Already encrypted deck
+            payloads = [card_to_token(card) for card in self.cards]
+        self.cards = cipher.encrypt_batch(payloads)
+        return cipher.key
+
+    # Decrypt cards that have been encrypted with all the given keys.
+    # Keys are given in the reverse order of encryption, outermost layer first.
+    @staticmethod
+    def decrypt_cards(cards: Sequence, *keys: str) -> List[int]:
+        return decrypt_cards([card_to_token(card) for card in cards], keys)
+
+    # Encrypted card as it is sent in JSON messages
+    @staticmethod
+    def card_to_json(card) -> str:
+        return base64.b64encode(card).decode("ascii")
 
     # Return a json version of the deck
     def cards_to_json(self):
-        return json.dumps(self.cards)
+        return json.dumps([Deck.card_to_json(card) for card in self.cards])
+
+    # Return the deck in the binary wire format
+    def to_bytes(self) -> bytes:
+        return b"".join(self.iter_bytes(len(self.cards)))
+
+    # The binary wire format in pieces of chunk_size cards, for streaming the deck
+    def iter_bytes(self, chunk_size: int = DECK_STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        yield DECK_MAGIC + bytes([CIPHER_IDS[self.cipher]]) + _uint32.pack(len(self.cards))
+        for i in range(0, len(self.cards), max(chunk_size, 1)):
+            parts = []
+            for card in self.cards[i : i + chunk_size]:
+                parts.append(_uint32.pack(len(card)))
+                parts.append(card)
+            yield b"".join(parts)
 
 class JoinRequest(TypedDict):
     your_ip: str
@@ -83,12 +159,18 @@ class JoinResponse(TypedDict):
     nodes: Dict[str, Player]
     your_player_number: int
     leader_node_number: int
+    # Deltas after this version of the membership are sent to /membership-delta
+    membership_epoch: int
+    membership_version: int
+    # The table the player joined, a lobby routes joining players to one of its tables
+    game_id: str
 
 class LeaveResponse(TypedDict):
     message: str
 
 class DoubleEncryptedDeckRequest(TypedDict):
     deck: str
+    cipher: str
 
 
 class WinnerRequest(TypedDict):
@@ -96,25 +178,87 @@ class WinnerRequest(TypedDict):
 
 class GameWinnerVerificationResultRequest(TypedDict):
     agree: bool
+    # The voter, the vote may have been passed on by another node
+    player_number: int
 
 class PlzHelpWithEncryptingDeckRequest(TypedDict):
     deck: str
+    cipher: str
 
 class PlzHelpWithEncryptingDeckResponse(TypedDict):
     deck: str
+    cipher: str
 
 class ShareKeyRequest(TypedDict):
     key: str
+    player_number: int
+
+# Headers of /shuffle-stage. The chain header lists the helpers after the receiving one.
+SHUFFLE_CHAIN_HEADER = "X-Shuffle-Chain"
+SHUFFLE_TIMINGS_HEADER = "X-Shuffle-Timings"
+# Id of the round a message belongs to, so that messages of an earlier round are not taken for the current one
+ROUND_HEADER = "X-Round-Id"
+# Id of a deck shuffled for the deck pool, helpers keep its key until a round uses the deck
+POOLED_DECK_HEADER = "X-Pooled-Deck"
+# Time one helper may take, the whole chain may take this times the number of helpers
+SHUFFLE_STAGE_TIMEOUT = 5
+
+class ShuffleStageTiming(TypedDict):
+    player_number: int
+    encrypt_ms: int
+    shuffle_ms: int
+
+# Asks a helper to use the key of a pooled deck in the current round
+class UsePooledDeckRequest(TypedDict):
+    deck_id: str
 
 class DealResultsBroadcastRequest(TypedDict):
     # Key player number, value encrypted card
     who_got_what_cards: Dict[int, str]
+    # The first helper, kept for nodes that only know about one helper
     helper_player_number: int
+    # All nodes that helped with shuffling, in the order they encrypted the deck
+    shuffler_player_numbers: List[int]
+
+
+# Messages of a round that can be sent together in one request to /messages, by route
+BATCHABLE_PATHS = (
+    "/game-starting",
+    "/deal-results",
+    "/i-got-the-dealt-cards",
+    "/helper-key",
+    "/leader-key",
+    "/winner",
+    "/game-winner-verification-result",
+)
+
+class BatchedMessage(TypedDict):
+    path: str
+    # E.g. the round of the message
+    headers: Dict[str, str]
+    # The messages without a body send None
+    json: Optional[Union[DealResultsBroadcastRequest, ShareKeyRequest, WinnerRequest, GameWinnerVerificationResultRequest]]
+
+class MessageBatchRequest(TypedDict):
+    # Handled in this order
+    messages: List[BatchedMessage]
+
+class BatchedMessageResult(TypedDict):
+    status: int
+    json: Dict
+
+class MessageBatchResponse(TypedDict):
+    # In the order of the messages
+    results: List[BatchedMessageResult]
 
 
 class NodeList(TypedDict):
     message: str
     nodes: Dict[int, Player]
+    next_player_number: int
+    leader_node_number: int
+    membership_epoch: int
+    membership_version: int
 
 
 class NewNodeListMessage(TypedDict):
@@ -122,10 +266,63 @@ class NewNodeListMessage(TypedDict):
     next_player_number: int
 
 
+# Membership changes from from_version to to_version, the joined players are added before the left ones are removed.
+# The epoch changes when another node starts managing the membership, e.g. after an election.
+class MembershipDeltaMessage(TypedDict):
+    epoch: int
+    from_version: int
+    to_version: int
+    joined: List[Player]
+    left: List[int]
+    next_player_number: int
+
+
+class ReverseBullyElectionRequest(TypedDict):
+    term: int
+
+
 class ReverseBullyElectionResponse(TypedDict):
     taking_over: bool
 
 
+class NewLeaderRequest(TypedDict):
+    term: int
+    leader_node_number: int
+
+
+# A lobby is split into tables once too many players wait in it
+class TableAssignmentMessage(TypedDict):
+    # Players of every new table by table id, the tables keep the player numbers of the lobby
+    tables: Dict[str, Dict[str, Player]]
+    # Membership epoch of the new tables, until their leaders start epochs of their own
+    membership_epoch: int
+
+
+class TableTournamentRequest(TypedDict):
+    tournament_id: str
+    # The table sends its result to the leader of this game
+    lobby_game_id: str
+    rounds: int
+    number_of_shufflers: int
+
+
+class TournamentResult(TypedDict):
+    game_id: str
+    rounds_played: int
+    seconds: float
+    # Rounds by the outcome of their fairness vote, "aborted" for rounds that did not get to the vote
+    outcomes: Dict[str, int]
+    # Confirmed wins by player number
+    wins: Dict[str, int]
+    # Players of the table, player numbers are only unique within a table
+    players: Dict[str, Player]
+
+
+class TableTournamentResult(TypedDict):
+    tournament_id: str
+    result: TournamentResult
+
+
 class GamePhase(Enum):
     WAITING_FOR_PLAYERS = 0
     GAME_ONGOING = 1
@@ -0,0 +1,266 @@
+"""
+Runs a table of nodes on one machine and drives them from code instead of the command line.
+
+Every node is a local process on its own loopback address (127.0.x.y, needs Linux), all of them on NODE_PORT.
+Commands such as `join` and `start_game` are written to the command line of the node, and the harness
+follows the game through the /state endpoint of the nodes.
+
+    with LocalCluster(5) as cluster:
+        cluster.join_all()
+        cluster.play_round()
+"""
+from typing import Any, Callable, Dict, List, Optional
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from classes import GamePhase, NodeList
+import network
+import state
+
+SRC_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+POLL_INTERVAL = 0.05
+# Joins take milliseconds, their end is polled for more often
+JOIN_POLL_INTERVAL = 0.005
+STARTUP_TIMEOUT = 60
+ROUND_TIMEOUT = 120
+# A round is followed through long-polls of the leader's game state, each one waits at most this many seconds
+STATE_POLL_WAIT = 5
+# Routes that are not part of playing, e.g. heartbeats and the harness's own polling
+_IDLE_ROUTES = ("/health", "/state", "/get-nodes", "/metrics")
+REQUEST_COUNT_METRIC = "card_game_http_request_duration_seconds_count"
+# Printed by a node that a lobby has sent to one of its tables
+_JOINED_TABLE = re.compile(r"Joined table (\S+)")
+
+
+# 127.0.0.1 for the first node, the last part of the address goes up to 254 before the next one starts
+def loopback_address(index: int) -> str:
+    return f"127.0.{(index - 1) // 254}.{(index - 1) % 254 + 1}"
+
+
+class ClusterNode:
+    """
+    One node of the table, started as `python main.py` with its command line on stdin and its output in a log file.
+    """
+
+    def __init__(self, index: int, log_directory: str, environment: Dict[str, str]):
+        self.index = index
+        self.ip = loopback_address(index)
+        # Game the node has joined, a lobby may send it to one of its tables
+        self.game_id = state.DEFAULT_GAME_ID
+        self.log_path = os.path.join(log_directory, f"node-{index}.log")
+        self.log = open(self.log_path, "w")
+        environment = dict(os.environ, **environment, NODE_HOST=self.ip, PYTHONUNBUFFERED="1")
+        # Every node keeps its game logs in a directory of its own below GAME_LOG_DIR
+        if environment.get("GAME_LOG_DIR"):
+            environment["GAME_LOG_DIR"] = os.path.join(environment["GAME_LOG_DIR"], f"node-{index}")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIRECTORY, "main.py")],
+            cwd=SRC_DIRECTORY,
+            env=environment,
+            stdin=subprocess.PIPE,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.ip}:{network.PORT}"
+
+    def command(self, line: str):
+        self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+
+    def game_url(self, path: str, game_id: str = state.DEFAULT_GAME_ID) -> str:
+        return self.url + path if game_id == state.DEFAULT_GAME_ID else f"{self.url}/games/{game_id}{path}"
+
+    # None while the node does not know the game yet
+    def node_list(self, game_id: str = state.DEFAULT_GAME_ID) -> Optional[NodeList]:
+        response = requests.get(self.game_url("/get-nodes", game_id), timeout=1)
+        if response.status_code == 404:
+            return None
+        return response.json()
+
+    # Bytes the node has written to its log so far
+    def log_size(self) -> int:
+        return os.path.getsize(self.log_path)
+
+    # The table the node has printed that it joined after the given offset of its log, None if it has not
+    def joined_table(self, log_offset: int) -> Optional[str]:
+        with open(self.log_path) as log_file:
+            log_file.seek(log_offset)
+            tables = _JOINED_TABLE.findall(log_file.read())
+        return tables[-1] if len(tables) > 0 else None
+
+    # The spectator view of the game, waits up to wait seconds for it to change from the version with the etag
+    def game_state(self, etag: Optional[str] = None, wait: float = 0) -> requests.Response:
+        headers = {"If-None-Match": etag} if etag is not None else {}
+        params = {"wait": wait} if wait > 0 else {}
+        return requests.get(f"{self.url}/state", headers=headers, params=params, timeout=wait + 5)
+
+    def healthy(self) -> bool:
+        try:
+            return requests.get(f"{self.url}/health", timeout=1).ok
+        except requests.RequestException:
+            return False
+
+    # Processor time the node has used so far, in seconds
+    def cpu_seconds(self) -> float:
+        with open(f"/proc/{self.process.pid}/stat") as stat_file:
+            # The name of the process is in parentheses and may contain spaces, the fields after it are numbered from 3
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        (user_time, system_time) = (int(fields[11]), int(fields[12]))
+        return (user_time + system_time) / os.sysconf("SC_CLK_TCK")
+
+    # Requests that the node has received so far, counted from its metrics
+    def requests_received(self) -> int:
+        count = 0
+        for line in requests.get(f"{self.url}/metrics", timeout=5).text.splitlines():
+            if line.startswith(REQUEST_COUNT_METRIC + "{") and not any(f'route="{route}"' in line for route in _IDLE_ROUTES):
+                count += int(float(line.rsplit(" ", 1)[1]))
+        return count
+
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.log.close()
+
+
+class RoundTimings:
+    """
+    When the leader's game state reached each phase of one round, in seconds after the round was started.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.dealt: Optional[float] = None
+        self.winner_known: Optional[float] = None
+        self.ended: Optional[float] = None
+        self.winner_number: Optional[int] = None
+
+    def phases(self) -> Dict[str, Optional[float]]:
+        def between(start: Optional[float], end: Optional[float]) -> Optional[float]:
+            return end - start if start is not None and end is not None else None
+
+        return {
+            "shuffle": self.dealt,
+            "keys": between(self.dealt, self.winner_known),
+            "vote": between(self.winner_known, self.ended),
+            "total": self.ended,
+        }
+
+
+def wait_for(predicate: Callable[[], bool], timeout: float, what: str, poll_interval: float = POLL_INTERVAL):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise TimeoutError(f"Timed out waiting for {what}")
+        time.sleep(poll_interval)
+
+
+class LocalCluster:
+    """
+    A table of nodes on this machine. The first node leads the table once the others have joined it.
+    The logs of the nodes are kept in a temporary directory.
+    """
+
+    def __init__(self, number_of_nodes: int, environment: Optional[Dict[str, str]] = None):
+        self.number_of_nodes = number_of_nodes
+        self.environment = environment or {}
+        self.log_directory = tempfile.mkdtemp(prefix="cluster-")
+        self.nodes: List[ClusterNode] = []
+
+    def start(self):
+        print(f"Starting {self.number_of_nodes} nodes, logs in {self.log_directory}")
+        self.nodes = [ClusterNode(index, self.log_directory, self.environment) for index in range(1, self.number_of_nodes + 1)]
+        wait_for(lambda: all(node.healthy() for node in self.nodes), STARTUP_TIMEOUT, "the nodes to start")
+
+    def stop(self):
+        for node in self.nodes:
+            if node.running():
+                node.kill()
+
+    def __enter__(self) -> "LocalCluster":
+        self.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.stop()
+
+    @property
+    def leader(self) -> ClusterNode:
+        return self.nodes[0]
+
+    # Adds the node to the leader's game, or the table of it that the join was sent on to.
+    # Returns how long joining took, until the node knew its place in the game.
+    def join(self, node: ClusterNode) -> float:
+        started = time.time()
+        log_offset = node.log_size()
+        node.command(f"join {self.leader.ip}")
+
+        def joined() -> bool:
+            node.game_id = node.joined_table(log_offset) or state.DEFAULT_GAME_ID
+            node_list = node.node_list(node.game_id)
+            return node_list is not None and any(player["ip"] == node.ip for player in node_list["nodes"].values())
+
+        wait_for(joined, STARTUP_TIMEOUT, f"node {node.ip} to join", JOIN_POLL_INTERVAL)
+        return time.time() - started
+
+    # Joins the other nodes one after another and waits until the nodes of every game know each other.
+    # Returns the join times.
+    def join_all(self) -> List[float]:
+        join_times = [self.join(node) for node in self.nodes[1:]]
+
+        def settled() -> bool:
+            versions: Dict[str, set] = {}
+            for node in self.nodes:
+                node_list = node.node_list(node.game_id)
+                versions.setdefault(node.game_id, set()).add(node_list["membership_version"] if node_list is not None else None)
+            return all(len(game_versions) == 1 for game_versions in versions.values())
+
+        wait_for(settled, STARTUP_TIMEOUT, "all nodes to know each other")
+        return join_times
+
+    def player_numbers(self) -> Dict[str, int]:
+        return {player["ip"]: player["player_number"] for player in self.leader.node_list()["nodes"].values()}
+
+    # Starts a round on the leader and follows its game state until the round is over
+    def play_round(self, number_of_shufflers: Optional[int] = None) -> RoundTimings:
+        response = self.leader.game_state()
+        etag = response.headers["ETag"]
+        previous_round = response.json()["round_id"]
+        timings = RoundTimings()
+        self.leader.command("start_game" if number_of_shufflers is None else f"start_game {number_of_shufflers}")
+        deadline = timings.started + ROUND_TIMEOUT
+        playing = False
+        while timings.ended is None:
+            if time.time() > deadline:
+                raise TimeoutError("Timed out waiting for the round to end")
+            response = self.leader.game_state(etag, STATE_POLL_WAIT)
+            if response.status_code == 304:
+                continue
+            etag = response.headers["ETag"]
+            game_state: Dict[str, Any] = response.json()
+            elapsed = time.time() - timings.started
+            if game_state["round_id"] == previous_round:
+                continue
+            if game_state["game_phase"] != GamePhase.WAITING_FOR_PLAYERS.name:
+                playing = True
+            if game_state["deal_results"] is not None and timings.dealt is None:
+                timings.dealt = elapsed
+            if game_state["game_phase"] == GamePhase.VOTING.name and timings.winner_known is None:
+                timings.winner_known = elapsed
+                timings.winner_number = game_state["winner_number"]
+            # The game state is emptied when the round is over, or was aborted before the winner was known
+            if game_state["game_phase"] == GamePhase.WAITING_FOR_PLAYERS.name and playing:
+                timings.ended = elapsed
+        return timings
@@ -1,26 +1,72 @@
+import json
+import os
 import random
 import time
-import requests
-from classes import DealResultsBroadcastRequest, Deck, GamePhase, GameWinnerVerificationResultRequest, JoinRequest, JoinResponse, LeaveResponse, NewNodeListMessage, Player, PlzHelpWithEncryptingDeckRequest, PlzHelpWithEncryptingDeckResponse, ShareKeyRequest, WinnerRequest
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple
+from classes import DECK_MIMETYPE, POOLED_DECK_HEADER, ROUND_HEADER, SHUFFLE_CHAIN_HEADER, SHUFFLE_STAGE_TIMEOUT, SHUFFLE_TIMINGS_HEADER, DealResultsBroadcastRequest, Deck, GamePhase, GameWinnerVerificationResultRequest, JoinRequest, JoinResponse, LeaveResponse, ShareKeyRequest, ShuffleStageTiming, TableTournamentRequest, TableTournamentResult, TournamentResult, UsePooledDeckRequest, WinnerRequest
 import pdb
 import cmd
 import state
+import failure_detector
+import lobby
 import reverse_bully as bully
+import network
+import voting
+from batching import batcher
+import node_log
+from voting import VoteResult
+from metrics import FAIRNESS_VOTE_SECONDS, FAIRNESS_VOTES, RoundTrace
+from deck_pool import DECK_POOL_SIZE, Membership, PooledDeck
+from node_registry import PlayerRecord
+
+log = node_log.get_logger(__name__)
+
+# How many nodes help the leader with shuffling, can be overridden with start_game <number>
+NUMBER_OF_SHUFFLERS = int(os.environ.get("SHUFFLE_STAGES", 1))
+# How long the leader waits for the helper keys, and everyone for the fairness vote, in seconds
+HELPER_KEYS_TIMEOUT = 30
+VOTE_TIMEOUT = 30
+# How long the leader of a lobby waits for the results of the tables, per round of the tournament
+TOURNAMENT_ROUND_TIMEOUT = 10
+
+# Encrypts and shuffles the deck of the next tournament round
+deck_preparer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deck")
+# How often the leader looks for deck pools to fill, in seconds
+DECK_POOL_INTERVAL = 1
 
 class CommandLoop(cmd.Cmd):
+    # Game the commands are about, changed with the use command
+    game_id = state.DEFAULT_GAME_ID
+
+    @property
+    def game(self) -> state.GameSession:
+        return state.get_session(self.game_id)
+
     def precmd(self, line: str) -> str:
-        print(f"Processing command: {line}")
-        leader_node_healthy = check_leader_node_health()
-        if not leader_node_healthy:
-            print("Leader node is not healthy. Starting a new leader election.")
-            bully.reverse_bully()
+        log.debug("Processing command: %s", line)
+        # The failure detector has already started an election if the leader is suspected
+        if failure_detector.detector.leader_suspected(self.game):
+            print("Leader node is not healthy, a new leader is being elected.")
         return super().precmd(line)
 
     def postcmd(self, stop: bool, line: str) -> bool:
-        print(f"Finished processing command: {line}")
+        log.debug("Finished processing command: %s", line)
         return super().postcmd(stop, line)
 
+    def do_use(self, line: str):
+        use_command_parts = line.strip().split()
+        if len(use_command_parts) < 1:
+            print(f"Usage: use <game id>, currently using game {self.game_id}")
+            return
+        self.game_id = use_command_parts[0]
+        print(f"Using game {self.game_id}")
+
     def do_join(self, line: str):
+        game = self.game
         join_command_parts = line.strip().split()
         if len(join_command_parts) < 1:
             print("Usage: join <ip>")
@@ -29,168 +75,470 @@ class CommandLoop(cmd.Cmd):
 
         # This is used so that leader learns their IP
         join_request: JoinRequest = {"your_ip": ip}
-        res_obj = requests.post(
-            f"http://{ip}:6376/join",
+        res_obj = network.post(
+            PlayerRecord(player_number=-1, ip=ip),
+            "/join",
+            game.game_id,
             json=join_request,
-            timeout=5,
         )
         res: JoinResponse = res_obj.json()
-        print("Join request response:", res)
+        log.debug("Join request response: %s", res)
+        # A lobby may have sent me to one of its tables, older nodes do not tell the game
+        table_id = res.get("game_id", game.game_id)
+        if table_id != game.game_id:
+            game = state.get_session(table_id)
+            self.game_id = table_id
+            print(f"Joined table {table_id}")
         # Set returned NODES state
-        state.NODES = {int(k): v for k, v in res["nodes"].items()}
+        game.adopt_node_list(res["nodes"], res["membership_epoch"], res["membership_version"])
         # Set your own player number
-        state.OWN_NODE_NUMBER = res["your_player_number"]
+        game.own_node_number = res["your_player_number"]
         # Assign leader
-        state.LEADER_NODE_NUMBER = res["leader_node_number"]
+        game.leader_node_number = res["leader_node_number"]
+        game.log_roles()
+        game.notify_changed()
     def do_leave(self, line: str):
-        leader_ip = next(node["ip"] for node in state.NODES.values() if node["player_number"] == state.LEADER_NODE_NUMBER)
-        result: LeaveResponse = requests.post(f"http://{leader_ip}:6376/leave").json()
+        game = self.game
+        leader = game.nodes[game.leader_node_number]
+        result: LeaveResponse = network.post(leader, "/leave", game.game_id).json()
         print(f"{result['message']}")
-        state.empty_game_states()
-        state.NODES = {}
+        state.drop_session(game.game_id)
+
+    # Suspicion levels of the nodes I send heartbeats to, a node is suspected at PHI_THRESHOLD
+    def do_health(self, line: str):
+        game = self.game
+        levels = failure_detector.detector.suspicion_levels(game)
+        if len(levels) == 0:
+            print("Not sending heartbeats to any node of this game.")
+        for (player_number, phi) in levels.items():
+            status = "suspected" if phi >= failure_detector.PHI_THRESHOLD else "ok"
+            print(f"Node {player_number}: phi {phi:.2f} ({status})")
+        print(f"Elections: {bully.election_metrics}")
 
     def do_list(self, line: str):
-        print("Listing all nodes in the game.")
-        print(state.NODES)
+        print(f"Listing all nodes in the game {self.game_id}.")
+        print(self.game.nodes)
 
     def do_debug(self, line: str):
         pdb.set_trace()
 
     def do_start_game(self, line: str):
+        game = self.game
 
-        if state.OWN_NODE_NUMBER != state.LEADER_NODE_NUMBER:
+        if game.own_node_number != game.leader_node_number:
             print("Not the leader. Cannot start game.")
             return
 
-        print("Starting game.")
-        broadcast_game_starting()
-        # Todo handle if this fails
-        state.GAME_PHASE = GamePhase.GAME_ONGOING
-        node_that_helps_with_shuffling = choose_follower_to_help_with_shuffling()
-        # Master starts the shuffling. It first chooses a key and encrypts all cards with the same key.
-        state.DECK = Deck()
-        state.ENCRYPTION_KEY = state.DECK.encrypt_all()
-        state.DECK.shuffle()
-        # Next we send the deck to the helper node
-        state.DOUBLE_ENCRYPTED_DECK = Deck(send_deck_to_node_to_help_with_shuffling(state.DECK, node_that_helps_with_shuffling))
-        # Leader deals cards
-        deal_request: DealResultsBroadcastRequest = { "who_got_what_cards": {}, "helper_player_number": node_that_helps_with_shuffling["player_number"]}
-        for node in sorted(state.NODES):
-            deal_request["who_got_what_cards"][node] = state.DOUBLE_ENCRYPTED_DECK.pop()
-        # broadcast dealt card, each participant tells helper that they have received a card
-        broadcast_dealt_cards(deal_request)
-        # Next, the encryption keys will be published
-
-        # As the leader, we are in different thread (Command Line) and we can wait for the HELPER_ENCRYPTION_KEY to be broadcasted
-        # Via the HTTP POST by the helper node.
-        # Helper will send it to us once it has received confirmation from all nodes that they have received the dealt cards
-        while state.HELPER_ENCRYPTION_KEY == None:
-            time.sleep(0.5)
-
-        # Now we can publish leader encryption key as we received the helper key and majority has confirmed receiving the deck
-        broadcast_leader_encryption_key()
-        highest_card = -1
-        highest_card_owner = None
-        for (node, card) in deal_request["who_got_what_cards"].items():
-            helper_decrypted_card = Deck.decrypt_helper(state.HELPER_ENCRYPTION_KEY, card)
-            decrypted_card_value = Deck.decrypt_one(state.ENCRYPTION_KEY, helper_decrypted_card)
-            print(f"Dealt card {decrypted_card_value} to player name {node}")
-            if decrypted_card_value > highest_card:
-                highest_card = decrypted_card_value
-                highest_card_owner = node
-        broadcast_winner(highest_card_owner)
-        req: GameWinnerVerificationResultRequest = { "agree" : True }
-        share_your_fairness_vote_and_wait_for_results(req, highest_card_owner)
-        
-# Used before every command by a NODE
-def check_leader_node_health() -> bool:
-    # Do not check for health when joining game
-    if state.OWN_NODE_NUMBER == -1:
-        print("Not checking leader node health")
-        return True
-    if state.LEADER_NODE_NUMBER == state.OWN_NODE_NUMBER:
-        print("Not checking leader health because I am the leader.")
-        return True
-    print("Checking leader node health.")
-    leader_node_ip = state.NODES[state.LEADER_NODE_NUMBER]["ip"]
-    try:
-        requests.get(
-            f"http://{leader_node_ip}:6376/health", timeout=5
-        ).json
-    except:
-        print("Health check failed.")
-        return False
-    print("The leader is healthy")
-    return True
-
-
-def choose_follower_to_help_with_shuffling() -> Player:
-    print("Choosing node to help with shuffling")
-    if len(state.NODES.values()) == 0:
-        print("The game is empty")
-        raise Exception("The game is empty")
-    # Exclude own player number
-    players_excluding_myself = [node for node in state.NODES.values() if node["player_number"] != state.OWN_NODE_NUMBER]
-    chosen_one = random.choice(players_excluding_myself)
-    print(f"Node {chosen_one['player_number']} will help with shuffling.")
-    return chosen_one
-
-
-def share_your_fairness_vote_and_wait_for_results(game_winner: GameWinnerVerificationResultRequest, winner_number: int):
-    print("Starting fairness vote.")
-    for node in state.NODES.values():
-        requests.post(f"http://{node['ip']}:6376/game-winner-verification-result", json=game_winner)
-    while True:
-        if state.NUMBER_OF_NODES_THAT_AGREE_WITH_THE_RESULT >= len(state.NODES) / 2:
-            print(f"The winner is confirmed to be {winner_number}")
+        # Optional argument: how many nodes help with shuffling
+        start_game_parts = line.strip().split()
+        number_of_shufflers = int(start_game_parts[0]) if len(start_game_parts) > 0 else NUMBER_OF_SHUFFLERS
+        play_round(game, number_of_shufflers)
+
+    # Plays many rounds in a row. The deck of the next round is encrypted and shuffled while the current one is played,
+    # and the next round starts as soon as the vote of the current one is decided. The tables of a lobby play at the same time.
+    def do_tournament(self, line: str):
+        game = self.game
+        tournament_parts = line.strip().split()
+        if len(tournament_parts) < 1:
+            print("Usage: tournament <rounds> [number of shufflers]")
+            return
+        if game.own_node_number != game.leader_node_number:
+            print("Not the leader. Cannot start a tournament.")
+            return
+        rounds = int(tournament_parts[0])
+        number_of_shufflers = int(tournament_parts[1]) if len(tournament_parts) > 1 else NUMBER_OF_SHUFFLERS
+
+        if len(game.lobby) > 0:
+            play_lobby_tournament(game, rounds, number_of_shufflers)
+            return
+
+        print(f"Starting a tournament of {rounds} rounds.")
+        result = play_tournament(game, rounds, number_of_shufflers)
+        print(f"Played {result['rounds_played']} rounds in {result['seconds']:.2f} s, {result['rounds_played'] / result['seconds']:.2f} rounds/s")
+        print(f"Outcomes: {result['outcomes']}")
+        wins = {int(player_number): count for (player_number, count) in result["wins"].items()}
+        print(f"Confirmed wins by player: {wins}")
+
+
+# Plays the rounds of a tournament at one table as its leader
+def play_tournament(game: state.GameSession, rounds: int, number_of_shufflers: int) -> TournamentResult:
+    started = time.time()
+    outcomes = Counter()
+    wins = Counter()
+    rounds_played = 0
+    prepared_decks = PreparedDecks()
+    for round_number in range(1, rounds + 1):
+        if game.own_node_number != game.leader_node_number:
+            log.warning("No longer the leader of game %s, stopping the tournament.", game.game_id)
             break
-        elif state.NUMBER_OF_NODES_THAT_DISAGREE_WITH_THE_RESULT >= len(state.NODES) / 2:
-            print(f"Winner cannot be detemined because cheating.")
+        log.info("Round %s of %s.", round_number, rounds)
+        result = play_round(game, number_of_shufflers, prepared_decks.take)
+        rounds_played += 1
+        if result is None:
+            outcomes["aborted"] += 1
+            continue
+        outcomes[result.outcome] += 1
+        if result.outcome == voting.CONFIRMED:
+            wins[str(result.winner_number)] += 1
+    prepared_decks.close()
+    return TournamentResult(
+        game_id=game.game_id,
+        rounds_played=rounds_played,
+        seconds=time.time() - started,
+        outcomes=dict(outcomes),
+        wins=dict(wins),
+        players=game.nodes.to_json(),
+    )
+
+
+# Plays the tournament a lobby asked my table to play and sends the result to the leader of the lobby
+def play_table_tournament(game: state.GameSession, request: TableTournamentRequest):
+    log.info("Starting a tournament of %s rounds at table %s.", request["rounds"], game.game_id)
+    result = play_tournament(game, request["rounds"], request["number_of_shufflers"])
+    lobby_game = state.get_session(request["lobby_game_id"])
+    lobby_leader = lobby_game.nodes.get(lobby_game.leader_node_number)
+    if lobby_leader is None:
+        log.warning("The leader of lobby %s is not known, dropping the result of table %s.", lobby_game.game_id, game.game_id)
+        return
+    message: TableTournamentResult = {"tournament_id": request["tournament_id"], "result": result}
+    try:
+        network.post(lobby_leader, "/tournament-results", lobby_game.game_id, json=message).raise_for_status()
+    except Exception as e:
+        log.warning("Sending the result of table %s to the lobby failed: %s", game.game_id, e)
+
+
+# The tables of the lobby play the rounds at the same time, their results are added up when all of them are done
+def play_lobby_tournament(game: state.GameSession, rounds: int, number_of_shufflers: int):
+    tournament_id = uuid.uuid4().hex
+    request: TableTournamentRequest = {
+        "tournament_id": tournament_id,
+        "lobby_game_id": game.game_id,
+        "rounds": rounds,
+        "number_of_shufflers": number_of_shufflers,
+    }
+    print(f"Starting a tournament of {rounds} rounds at {len(game.lobby)} tables.")
+    started = time.time()
+    playing = []
+    for table_id in game.lobby.table_ids():
+        # Any player of the table sends the request on to the leader of the table
+        for player in game.lobby.players_at(table_id):
+            try:
+                network.post(player, "/tournament", table_id, json=request).raise_for_status()
+            except Exception as e:
+                log.info("Player %s could not start the tournament of table %s: %s", player.ip, table_id, e)
+                continue
+            playing.append(table_id)
             break
-    state.empty_game_states()
+        else:
+            print(f"Table {table_id} could not be reached.")
+    game.wait_until(lambda: len(game.lobby.results_of(tournament_id)) == len(playing), rounds * TOURNAMENT_ROUND_TIMEOUT)
+    results = game.lobby.results_of(tournament_id)
+    game.lobby.forget_tournament(tournament_id)
+    elapsed = time.time() - started
+    for table_id in playing:
+        result = results.get(table_id)
+        if result is None:
+            print(f"Table {table_id} did not finish the tournament in time.")
+        else:
+            print(f"Table {table_id}: {result['rounds_played']} rounds in {result['seconds']:.2f} s, outcomes {result['outcomes']}")
+    (rounds_played, outcomes, wins) = lobby.aggregate(results.values())
+    print(f"Played {rounds_played} rounds at {len(results)} tables in {elapsed:.2f} s, {rounds_played / elapsed:.2f} rounds/s")
+    print(f"Outcomes: {dict(outcomes)}")
+    print(f"Confirmed wins by player: {dict(wins)}")
+    if len(wins) > 0:
+        (winner, most_wins) = wins.most_common(1)[0]
+        print(f"Tournament winner: {winner} with {most_wins} wins")
 
 
-def broadcast_dealt_cards(deal_request: DealResultsBroadcastRequest):
-    for node in state.NODES.values():
-        requests.post(
-            f"http://{node['ip']}:6376/deal-results", json=deal_request
-        )
+# The leader's part of shuffling: a new deck encrypted with the leader's key and shuffled, and the key
+def prepare_deck() -> Tuple[Deck, str]:
+    deck = Deck()
+    key = deck.encrypt_all()
+    deck.shuffle()
+    return (deck, key)
 
-def broadcast_game_starting():
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER:
-            continue
-        requests.post(
-            f"http://{node['ip']}:6376/game-starting"
-        )
 
-def broadcast_leader_encryption_key():
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER:
-            continue
-        body: ShareKeyRequest = {"key": state.ENCRYPTION_KEY}
-        requests.post(
-            f"http://{node['ip']}:6376/leader-key", json=body
-        )
+class PreparedDecks:
+    """
+    Leader decks of a tournament. The next one is encrypted and shuffled in the background while a round is played.
+    """
 
-# Winner of the game
-def broadcast_winner(winner_number: int):
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER:
-            continue
-        body: WinnerRequest = {"winner": winner_number}
-        requests.post(
-            f"http://{node['ip']}:6376/winner", json=body
+    def __init__(self):
+        self.next = deck_preparer.submit(prepare_deck)
+
+    def take(self) -> Tuple[Deck, str]:
+        prepared = self.next.result()
+        self.next = deck_preparer.submit(prepare_deck)
+        return prepared
+
+    def close(self):
+        self.next.cancel()
+
+
+# Plays one round as the leader. The deck is taken from the deck pool if it has one, otherwise
+# the leader's part of shuffling comes from prepare and the deck goes through the helpers.
+# Returns the outcome of the fairness vote, or None if the round was aborted.
+def play_round(game: state.GameSession, number_of_shufflers: int, prepare: Callable[[], Tuple[Deck, str]] = prepare_deck) -> Optional[VoteResult]:
+    round_id = game.next_round_id()
+    game.enter_round(round_id)
+    log.info("Starting game, round %s.", round_id)
+    trace = RoundTrace(round_id)
+    with trace.span("start_broadcast"):
+        # A node that misses the start still plays the round, every message of the round starts it there.
+        # Joins are not affected, they all end up at the leader, which is already playing.
+        broadcast_game_starting(game)
+        game.game_phase = GamePhase.GAME_ONGOING
+        game.log_change({"type": "phase", "phase": game.game_phase.value})
+        game.notify_changed()
+    pooled_deck = game.deck_pool.take(game.membership_stamp(), number_of_shufflers)
+    if pooled_deck is not None:
+        with trace.span("helper_round_trip"):
+            if not use_pooled_deck(game, pooled_deck):
+                pooled_deck = None
+    if pooled_deck is not None:
+        game.shuffler_player_numbers = pooled_deck.shuffler_player_numbers
+        (game.deck, game.encryption_key) = (None, pooled_deck.leader_key)
+        game.double_encrypted_deck = pooled_deck.deck
+    else:
+        nodes_that_help_with_shuffling = choose_followers_to_help_with_shuffling(game, number_of_shufflers)
+        game.shuffler_player_numbers = [node.player_number for node in nodes_that_help_with_shuffling]
+        # Master starts the shuffling. It first chooses a key and encrypts all cards with the same key.
+        with trace.span("leader_encrypt"):
+            (game.deck, game.encryption_key) = prepare()
+        # Next the deck goes through all the helper nodes, each encrypting and shuffling it once more
+        with trace.span("helper_round_trip"):
+            game.double_encrypted_deck = send_deck_through_shuffle_chain(game, game.deck, nodes_that_help_with_shuffling)
+    # Leader deals cards
+    with trace.span("deal"):
+        deal_request: DealResultsBroadcastRequest = {
+            "who_got_what_cards": {},
+            "helper_player_number": game.shuffler_player_numbers[0],
+            "shuffler_player_numbers": game.shuffler_player_numbers,
+        }
+        dealt_cards = {}
+        for node in game.nodes.numbers():
+            dealt_cards[node] = game.double_encrypted_deck.pop()
+            deal_request["who_got_what_cards"][node] = Deck.card_to_json(dealt_cards[node])
+        game.log_change({"type": "leader_key", "key": game.encryption_key})
+        # The helper layers are removed from the dealt cards as the helper keys arrive
+        game.feed_verifier()
+        game.verifier.start(dealt_cards, game.double_encrypted_deck.cipher, game.shuffler_player_numbers, game.own_node_number)
+        # broadcast dealt card, each participant tells helper that they have received a card
+        broadcast_dealt_cards(game, deal_request)
+    # Next, the encryption keys will be published
+
+    # As the leader, we are in different thread (Command Line) and we can wait for the HELPER_ENCRYPTION_KEYS to be broadcasted
+    # Via the HTTP POST by the helper nodes.
+    # Helpers will send them to us once they have received confirmation from all nodes that they have received the dealt cards
+    with trace.span("key_wait"):
+        all_keys_received = game.wait_until(game.all_helper_keys_received, HELPER_KEYS_TIMEOUT)
+    if not all_keys_received:
+        log.warning("Did not receive the encryption keys of all helpers, aborting the game.")
+        game.end_round(round_id)
+        log.info("Round %s phases: %s", round_id, trace)
+        return None
+
+    # All keys are known now, what is left of decrypting the cards is done here
+    with trace.span("decrypt"):
+        game.feed_verifier()
+    for (node, card_value) in game.verifier.values.items():
+        log.debug("Dealt card %s to player name %s", card_value, node)
+    highest_card_owner = game.verifier.highest_card_owner
+    game.winner_number = highest_card_owner
+    game.game_phase = GamePhase.VOTING
+    game.log_change({"type": "winner", "winner": highest_card_owner})
+    game.log_change({"type": "phase", "phase": game.game_phase.value})
+    game.notify_changed()
+    with trace.span("vote"):
+        # Now we can publish leader encryption key as we received the helper keys and majority has confirmed receiving the deck.
+        # The key, the winner and my vote are sent right after each other, so they go to every node in one batch.
+        broadcast_leader_encryption_key(game)
+        broadcast_winner(game, highest_card_owner)
+        req: GameWinnerVerificationResultRequest = { "agree" : True, "player_number": game.own_node_number }
+        result = share_your_fairness_vote_and_wait_for_results(game, req, highest_card_owner, round_id)
+    log.info("Round %s phases: %s", round_id, trace)
+    return result
+
+# Tells the helpers of a pooled deck to use their keys of it in this round. The last helper shares the deck for verification.
+def use_pooled_deck(game: state.GameSession, pooled_deck: PooledDeck) -> bool:
+    log.info("Using pooled deck %s shuffled by nodes %s", pooled_deck.deck_id, pooled_deck.shuffler_player_numbers)
+    body: UsePooledDeckRequest = {"deck_id": pooled_deck.deck_id}
+    helpers = [game.nodes[player_number] for player_number in pooled_deck.shuffler_player_numbers]
+    result = network.broadcast(helpers, "/pooled-deck", game.game_id, json=body, headers=game.round_headers())
+    if not result.ok:
+        log.warning("The helpers no longer have the pooled deck, shuffling a new one.")
+    return result.ok
+
+
+# A deck for the pool, shuffled by the leader and NUMBER_OF_SHUFFLERS helpers outside of any round
+def make_pooled_deck(game: state.GameSession) -> PooledDeck:
+    membership = game.membership_stamp()
+    nodes_that_help_with_shuffling = choose_followers_to_help_with_shuffling(game, NUMBER_OF_SHUFFLERS)
+    (deck, key) = prepare_deck()
+    deck_id = uuid.uuid4().hex
+    double_encrypted_deck = send_deck_through_shuffle_chain(
+        game, deck, nodes_that_help_with_shuffling, {POOLED_DECK_HEADER: deck_id}
+    )
+    return PooledDeck(
+        deck_id,
+        double_encrypted_deck,
+        key,
+        [node.player_number for node in nodes_that_help_with_shuffling],
+        membership,
+    )
+
+
+class DeckPoolReplenisher:
+    """
+    Fills the deck pools of the games I lead in the background, while no round is being played in them.
+    """
+
+    def __init__(self):
+        # Membership of every game at the last check, pools are only filled once it has stayed the same for a while
+        self.memberships: Dict[str, Membership] = {}
+        self.thread = None
+
+    def start(self):
+        if self.thread is None and DECK_POOL_SIZE > 0:
+            self.thread = Thread(target=self._run, name="deck-pool", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                log.warning("Filling the deck pool failed: %s", e)
+            time.sleep(DECK_POOL_INTERVAL)
+
+    def idle(self, game: state.GameSession) -> bool:
+        return (
+            game.own_node_number != -1
+            and game.own_node_number == game.leader_node_number
+            and not game.leader_election_ongoing
+            and game.game_phase == GamePhase.WAITING_FOR_PLAYERS
+            and len(game.nodes) > 1
         )
 
+    def tick(self):
+        with state.sessions_lock:
+            games = list(state.SESSIONS.values())
+        memberships = {}
+        for game in games:
+            membership = memberships[game.game_id] = game.membership_stamp()
+            # Players that are still joining would evict every deck right away
+            if self.memberships.get(game.game_id) != membership or not self.idle(game):
+                continue
+            evicted = game.deck_pool.evict_stale(membership)
+            if evicted > 0:
+                log.info("Evicted %s pooled decks of game %s after a membership change.", evicted, game.game_id)
+            while len(game.deck_pool) < DECK_POOL_SIZE and self.idle(game) and game.membership_stamp() == membership:
+                game.deck_pool.add(make_pooled_deck(game))
+        self.memberships = memberships
+
 
+deck_pool_replenisher = DeckPoolReplenisher()
+
+
+def choose_followers_to_help_with_shuffling(game: state.GameSession, number_of_shufflers: int) -> List[PlayerRecord]:
+    log.debug("Choosing nodes to help with shuffling")
+    if len(game.nodes) == 0:
+        log.warning("The game is empty")
+        raise Exception("The game is empty")
+    # Exclude own player number
+    players_excluding_myself = network.peers(game)
+    chosen_ones = random.sample(players_excluding_myself, max(1, min(number_of_shufflers, len(players_excluding_myself))))
+    log.info("Nodes %s will help with shuffling, in this order.", [node.player_number for node in chosen_ones])
+    return chosen_ones
 
-def send_deck_to_node_to_help_with_shuffling(deck: Deck, node_that_helps_with_shuffling: Player) -> Deck:
-    print(f"Sending deck to node {node_that_helps_with_shuffling}")
 
-    request: PlzHelpWithEncryptingDeckRequest = { "deck": deck.cards_to_json() }
+# Counts my own vote locally and sends it to the others in the background,
+# so that waiting for their votes starts right away and ends as soon as the outcome is decided or the next round starts
+def share_your_fairness_vote_and_wait_for_results(
+    game: state.GameSession, game_winner: GameWinnerVerificationResultRequest, winner_number: int, round_id: int
+) -> VoteResult:
+    log.debug("Starting fairness vote.")
+    started = time.time()
+    number_of_voters = len(game.nodes)
+    (current_round_id, votes) = game.current_round()
+    if current_round_id != round_id:
+        log.info("Round %s is over, not voting in it.", round_id)
+        FAIRNESS_VOTES.inc(voting.ABANDONED)
+        return VoteResult(voting.ABANDONED, winner_number, 0, 0, number_of_voters, 0)
+    votes.record(game.own_node_number, game_winner["agree"])
+    game.log_change({"type": "vote", "player_number": game.own_node_number, "agree": game_winner["agree"]})
+    batcher.send(
+        game,
+        network.peers(game),
+        "/game-winner-verification-result",
+        json=game_winner,
+        headers={ROUND_HEADER: str(round_id)},
+    )
+    game.wait_until(lambda: votes.outcome(number_of_voters) is not None or game.round_id != round_id, VOTE_TIMEOUT)
+    result = votes.result(number_of_voters, winner_number, started, abandoned=game.round_id != round_id)
+    if result.outcome == voting.CONFIRMED:
+        log.info("The winner is confirmed to be %s", winner_number)
+    elif result.outcome == voting.CHEATING:
+        log.warning("Winner cannot be detemined because cheating.")
+    elif result.outcome == voting.ABANDONED:
+        log.info("The next round started before the fairness vote was decided.")
+    else:
+        log.warning("Fairness vote timed out without a majority.")
+    log.info("Fairness vote: %s", result)
+    FAIRNESS_VOTES.inc(result.outcome)
+    FAIRNESS_VOTE_SECONDS.observe(result.latency_ms / 1000)
+    game.end_round(round_id)
+    return result
 
-    res: PlzHelpWithEncryptingDeckResponse = requests.post(f"http://{node_that_helps_with_shuffling['ip']}:6376/plz-help-with-encrypting", json=request, timeout=5).json()
-    return res["deck"]
 
+def broadcast_dealt_cards(game: state.GameSession, deal_request: DealResultsBroadcastRequest):
+    batcher.send(game, game.nodes.values(), "/deal-results", json=deal_request, headers=game.round_headers())
 
+# Also to myself, so that it goes in the same batch as the deal when the deck comes from the pool
+def broadcast_game_starting(game: state.GameSession):
+    batcher.send(game, game.nodes.values(), "/game-starting", headers=game.round_headers())
+
+def broadcast_leader_encryption_key(game: state.GameSession):
+    body: ShareKeyRequest = {"key": game.encryption_key, "player_number": game.own_node_number}
+    batcher.send(game, network.peers(game), "/leader-key", json=body, headers=game.round_headers())
+
+# Winner of the game
+def broadcast_winner(game: state.GameSession, winner_number: int):
+    body: WinnerRequest = {"winner": winner_number}
+    batcher.send(game, network.peers(game), "/winner", json=body, headers=game.round_headers())
+
+
+
+# Sends the deck to the first helper, which passes it on to the next one and so on.
+# The deck is streamed so that the next helper can start encrypting while the previous one is still sending.
+# The last helper's deck comes back through the chain.
+# The headers tell the helpers which round, or which pooled deck, the deck is for.
+def send_deck_through_shuffle_chain(
+    game: state.GameSession,
+    deck: Deck,
+    nodes_that_help_with_shuffling: List[PlayerRecord],
+    headers: Optional[Dict[str, str]] = None,
+) -> Deck:
+    log.debug("Sending deck to nodes %s", [node.player_number for node in nodes_that_help_with_shuffling])
+    started = time.time()
+    res = network.post(
+        nodes_that_help_with_shuffling[0],
+        "/shuffle-stage",
+        game.game_id,
+        data=deck.iter_bytes(),
+        headers={
+            **(headers or game.round_headers()),
+            "Content-Type": DECK_MIMETYPE,
+            SHUFFLE_CHAIN_HEADER: ",".join(str(node.player_number) for node in nodes_that_help_with_shuffling[1:]),
+        },
+        timeout=SHUFFLE_STAGE_TIMEOUT * len(nodes_that_help_with_shuffling),
+    )
+    res.raise_for_status()
+    shuffled_deck = Deck.from_bytes(res.content)
+    timings: List[ShuffleStageTiming] = json.loads(res.headers[SHUFFLE_TIMINGS_HEADER])
+    for timing in timings:
+        log.debug(
+            "Shuffle stage of node %s: encrypting took %s ms, shuffling %s ms", timing["player_number"], timing["encrypt_ms"], timing["shuffle_ms"]
+        )
+    log.debug("Deck went through %s helpers in %s ms", len(timings), round((time.time() - started) * 1000))
+    return shuffled_deck
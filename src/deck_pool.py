@@ -0,0 +1,105 @@
+from collections import OrderedDict, deque
+from threading import Lock
+from typing import Deque, List, Optional, Tuple
+import os
+
+from classes import Deck
+
+# How many ready decks the leader keeps per game, 0 turns the pool off
+DECK_POOL_SIZE = int(os.environ.get("DECK_POOL_SIZE", 2))
+# A helper keeps the keys of a few more decks than the leader's pool, the leader may have evicted some of them
+MAX_POOLED_SHUFFLES = max(DECK_POOL_SIZE, 1) * 4
+
+# Membership epoch and version, decks are only used with the membership they were made for
+Membership = Tuple[int, int]
+
+
+class PooledDeck:
+    """
+    A deck that the leader and its helpers encrypted and shuffled before any round needed it.
+    """
+
+    __slots__ = ("deck_id", "deck", "leader_key", "shuffler_player_numbers", "membership")
+
+    def __init__(self, deck_id: str, deck: Deck, leader_key: str, shuffler_player_numbers: List[int], membership: Membership):
+        self.deck_id = deck_id
+        self.deck = deck
+        self.leader_key = leader_key
+        self.shuffler_player_numbers = shuffler_player_numbers
+        self.membership = membership
+
+
+class DeckPool:
+    """
+    The leader's ready decks of one game, oldest first.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.decks: Deque[PooledDeck] = deque()
+
+    def add(self, pooled_deck: PooledDeck):
+        with self.lock:
+            self.decks.append(pooled_deck)
+
+    # Drops the decks made for another membership, their helpers may be gone. Returns how many were dropped.
+    def evict_stale(self, membership: Membership) -> int:
+        with self.lock:
+            fresh = deque(pooled_deck for pooled_deck in self.decks if pooled_deck.membership == membership)
+            evicted = len(self.decks) - len(fresh)
+            self.decks = fresh
+            return evicted
+
+    # The oldest deck made for this membership with the given number of helpers, None if there is none
+    def take(self, membership: Membership, number_of_shufflers: int) -> Optional[PooledDeck]:
+        self.evict_stale(membership)
+        with self.lock:
+            for pooled_deck in self.decks:
+                if len(pooled_deck.shuffler_player_numbers) == number_of_shufflers:
+                    self.decks.remove(pooled_deck)
+                    return pooled_deck
+            return None
+
+    def __len__(self):
+        return len(self.decks)
+
+
+class PooledShuffle:
+    """
+    A helper's part of a pooled deck: its key, and the final deck if it was the last helper.
+    """
+
+    __slots__ = ("deck_id", "key", "deck", "membership")
+
+    def __init__(self, deck_id: str, key: str, deck: Optional[Deck], membership: Membership):
+        self.deck_id = deck_id
+        self.key = key
+        self.deck = deck
+        self.membership = membership
+
+
+class PooledShuffles:
+    """
+    The keys a helper used for the pooled decks of one game, by deck id. Every key is used in one round at most.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.shuffles: "OrderedDict[str, PooledShuffle]" = OrderedDict()
+
+    def add(self, shuffle: PooledShuffle):
+        with self.lock:
+            for (deck_id, stored) in list(self.shuffles.items()):
+                if stored.membership != shuffle.membership:
+                    del self.shuffles[deck_id]
+            self.shuffles[shuffle.deck_id] = shuffle
+            while len(self.shuffles) > MAX_POOLED_SHUFFLES:
+                self.shuffles.popitem(last=False)
+
+    # Removes and returns the shuffle of the deck, None if it is unknown or was made for another membership
+    def take(self, deck_id: str, membership: Membership) -> Optional[PooledShuffle]:
+        with self.lock:
+            shuffle = self.shuffles.pop(deck_id, None)
+        if shuffle is None or shuffle.membership != membership:
+            return None
+        return shuffle
@@ -0,0 +1,46 @@
+"""
+Measures how long electing a new leader takes when k of n nodes crash.
+
+Starts n nodes as local processes, each on its own loopback address (127.0.x.y, needs Linux), lets them join
+the first one, kills the k nodes with the smallest player numbers, the leader among them, and polls the
+others until they all agree on the new leader.
+
+Run with e.g. `python election_harness.py 10 3`. The logs of the nodes are kept in a temporary directory.
+"""
+from typing import List
+import sys
+import time
+
+from cluster import LocalCluster, wait_for
+
+AGREEMENT_TIMEOUT = 60
+
+
+def run(number_of_nodes: int, number_to_kill: int) -> float:
+    with LocalCluster(number_of_nodes) as cluster:
+        cluster.join_all()
+
+        player_numbers = cluster.player_numbers()
+        nodes = sorted(cluster.nodes, key=lambda node: player_numbers[node.ip])
+        (killed, survivors) = (nodes[:number_to_kill], nodes[number_to_kill:])
+        expected_leader = player_numbers[survivors[0].ip]
+        print(f"Killing players {[player_numbers[node.ip] for node in killed]}")
+        for node in killed:
+            node.kill()
+        started = time.time()
+        wait_for(
+            lambda: all(node.node_list()["leader_node_number"] == expected_leader for node in survivors),
+            AGREEMENT_TIMEOUT,
+            f"the survivors to agree on leader {expected_leader}",
+        )
+        time_to_leader = time.time() - started
+        print(
+            f"{number_of_nodes} nodes, {number_to_kill} killed: all {len(survivors)} others "
+            f"agreed on leader {expected_leader} after {time_to_leader:.2f} s"
+        )
+        return time_to_leader
+
+
+if __name__ == "__main__":
+    arguments: List[int] = [int(argument) for argument in sys.argv[1:]]
+    run(arguments[0] if len(arguments) > 0 else 5, arguments[1] if len(arguments) > 1 else 1)
@@ -0,0 +1,167 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Dict, List
+import math
+import os
+import time
+
+from node_registry import PlayerRecord
+import network
+import node_log
+import reverse_bully as bully
+import state
+
+log = node_log.get_logger(__name__)
+
+# Every node sends a heartbeat to its leaders this often, in seconds
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 1))
+# "leader" heartbeats only the leaders of my games, "all" every node of them, e.g. to see suspicion levels of all nodes
+HEARTBEAT_TARGETS = os.environ.get("HEARTBEAT_TARGETS", "leader")
+# A node is suspected once its suspicion level (phi) reaches this. Phi 8 means a 1 in 10^8 chance of a false suspicion.
+PHI_THRESHOLD = float(os.environ.get("PHI_THRESHOLD", 8))
+# How many heartbeat intervals the detector remembers per node
+HEARTBEAT_WINDOW = 100
+# Lower bound for the deviation of the intervals, so that very regular heartbeats do not make the detector too eager
+MIN_STD_DEVIATION = 0.2
+# Heartbeats may be this many seconds late, e.g. because of garbage collection, without raising suspicion
+ACCEPTABLE_HEARTBEAT_PAUSE = 0.5
+
+
+class HeartbeatHistory:
+    """
+    Arrival times of the heartbeats of one node, for the phi accrual failure detector.
+    """
+
+    __slots__ = ("intervals", "last_heartbeat", "probe_in_flight")
+
+    def __init__(self, now: float):
+        # Until real heartbeats arrive, pretend that they arrive on time
+        self.intervals = deque([HEARTBEAT_INTERVAL], maxlen=HEARTBEAT_WINDOW)
+        self.last_heartbeat = now
+        self.probe_in_flight = False
+
+    def heartbeat(self, now: float):
+        self.intervals.append(now - self.last_heartbeat)
+        self.last_heartbeat = now
+
+    # How suspicious the silence since the last heartbeat is, assuming normally distributed intervals
+    def phi(self, now: float) -> float:
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((interval - mean) ** 2 for interval in self.intervals) / len(self.intervals)
+        std_deviation = max(math.sqrt(variance), MIN_STD_DEVIATION)
+        y = (now - self.last_heartbeat - mean - ACCEPTABLE_HEARTBEAT_PAUSE) / std_deviation
+        # Logistic approximation of the normal distribution, phi = -log10(e / (1 + e)),
+        # computed in log space so that long silences do not overflow
+        exponent = -y * (1.5976 + 0.070566 * y * y)
+        if y > 0:
+            return (-exponent + math.log1p(math.exp(exponent))) / math.log(10)
+        return math.log1p(math.exp(-exponent)) / math.log(10)
+
+
+class FailureDetector:
+    """
+    Sends heartbeats to the leaders of all my games in the background and starts an election
+    as soon as a leader is suspected, so that commands never wait for a health check.
+    """
+
+    def __init__(self):
+        # Keyed by ip, one node can take part in many games
+        self.histories: Dict[str, HeartbeatHistory] = {}
+        self.lock = Lock()
+        self.elections: Dict[str, Future] = {}
+        self.probes = ThreadPoolExecutor(max_workers=network.MAX_PARALLEL_REQUESTS, thread_name_prefix="heartbeat")
+        self.election_runner = ThreadPoolExecutor(max_workers=16, thread_name_prefix="election")
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self._run, name="failure-detector", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.tick(time.time())
+            except Exception as e:
+                log.warning("Failure detector failed: %s", e)
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def phi(self, ip: str) -> float:
+        with self.lock:
+            history = self.histories.get(ip)
+            if history is None:
+                return 0.0
+            return history.phi(time.time())
+
+    def suspected(self, ip: str) -> bool:
+        return self.phi(ip) >= PHI_THRESHOLD
+
+    def leader_suspected(self, game: state.GameSession) -> bool:
+        if game.leader_node_number == game.own_node_number:
+            return False
+        leader = game.nodes.get(game.leader_node_number)
+        return leader is not None and self.suspected(leader.ip)
+
+    # Suspicion levels of the nodes of a game that I send heartbeats to, by player number
+    def suspicion_levels(self, game: state.GameSession) -> Dict[int, float]:
+        return {
+            node.player_number: self.phi(node.ip)
+            for node in game.nodes.snapshot()
+            if node.ip in self.histories
+        }
+
+    def _targets(self, games: List[state.GameSession]) -> Dict[str, PlayerRecord]:
+        targets = {}
+        for game in games:
+            if game.own_node_number == -1:
+                continue
+            if HEARTBEAT_TARGETS == "all":
+                for node in network.peers(game):
+                    targets[node.ip] = node
+            elif game.leader_node_number != game.own_node_number:
+                leader = game.nodes.get(game.leader_node_number)
+                if leader is not None:
+                    targets[leader.ip] = leader
+        return targets
+
+    def _probe(self, node: PlayerRecord, history: HeartbeatHistory):
+        try:
+            network.get(node, "/health", timeout=HEARTBEAT_INTERVAL * 2).raise_for_status()
+            with self.lock:
+                history.heartbeat(time.time())
+        except Exception:
+            pass
+        finally:
+            history.probe_in_flight = False
+
+    # Sends the heartbeats of one round without waiting for the answers, and starts elections for suspected leaders
+    def tick(self, now: float):
+        with state.sessions_lock:
+            games = list(state.SESSIONS.values())
+        targets = self._targets(games)
+        with self.lock:
+            for ip in list(self.histories):
+                if ip not in targets:
+                    del self.histories[ip]
+            for (ip, node) in targets.items():
+                history = self.histories.get(ip)
+                if history is None:
+                    history = self.histories[ip] = HeartbeatHistory(now)
+                if not history.probe_in_flight:
+                    history.probe_in_flight = True
+                    self.probes.submit(self._probe, node, history)
+
+        for (game_id, election) in list(self.elections.items()):
+            if election.done():
+                del self.elections[game_id]
+        for game in games:
+            if game.own_node_number == -1 or game.leader_election_ongoing or not self.leader_suspected(game):
+                continue
+            if game.game_id in self.elections:
+                continue
+            log.warning("Leader %s of game %s is suspected to have failed. Starting a new leader election.", game.leader_node_number, game.game_id)
+            self.elections[game.game_id] = self.election_runner.submit(bully.reverse_bully, game)
+
+
+detector = FailureDetector()
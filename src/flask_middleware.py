@@ -1,17 +1,30 @@
-from werkzeug.wrappers import Request
+import time
+
+import metrics
+import node_log
 
 
 class middleware:
     """
-    Middleware that does extra logging to make it more transparent what happens in the system
+    Middleware that times every request for the metrics, and writes a sample of the requests to the request log
     """
 
     def __init__(self, app):
         self.app = app
 
+    # Streamed responses are timed until their first part, the rest is sent after the handler has returned
     def __call__(self, environ, start_response):
-        request = Request(environ)
-        print(f"Starting processing request {request} from {request.remote_addr}")
-        res = self.app(environ, start_response)
-        print(f"Finished processing request {request} from {request.remote_addr}")
+        started = time.perf_counter()
+        statuses = []
+
+        def start_response_with_status(status: str, headers, exc_info=None):
+            statuses.append(int(status.split(" ", 1)[0]))
+            return start_response(status, headers, exc_info)
+
+        res = self.app(environ, start_response_with_status)
+        seconds = time.perf_counter() - started
+        status = statuses[-1] if statuses else 500
+        metrics.record_request(environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""), status, seconds)
+        if node_log.request_sampled():
+            node_log.log_request(environ, status, seconds)
         return res
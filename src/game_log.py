@@ -0,0 +1,227 @@
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+import json
+import os
+import time
+
+import node_log
+
+log = node_log.get_logger(__name__)
+
+# Directory of the game logs of this node, the logs are off if this is not set.
+# Nodes that share a file system need directories of their own.
+GAME_LOG_DIR = os.environ.get("GAME_LOG_DIR", "")
+# Records are written and synced to disk in batches, a record waits at most this many seconds for its batch
+FSYNC_INTERVAL = float(os.environ.get("GAME_LOG_FSYNC_INTERVAL", 0.005))
+# The log is compacted into a snapshot of the game after this many records
+SNAPSHOT_INTERVAL = int(os.environ.get("GAME_LOG_SNAPSHOT_INTERVAL", 1000))
+
+LOG_SUFFIX = ".log"
+SNAPSHOT_SUFFIX = ".snapshot"
+
+
+class GameLog:
+    """
+    Append-only log of the state changes of one game on this node. Every SNAPSHOT_INTERVAL records the whole
+    game state is written to a snapshot and the log starts over, so recovering never replays more than that.
+    Replaying a record twice must not change the result, records written after a snapshot may already be in it.
+    """
+
+    def __init__(self, game_id: str, take_snapshot: Callable[[], Dict[str, Any]]):
+        name = quote(game_id, safe="")
+        self.path = os.path.join(GAME_LOG_DIR, name + LOG_SUFFIX)
+        self.snapshot_path = os.path.join(GAME_LOG_DIR, name + SNAPSHOT_SUFFIX)
+        self.take_snapshot = take_snapshot
+        # The lock guards the pending records, the file lock the file. Appending never waits for the disk.
+        self.lock = Lock()
+        self.file_lock = Lock()
+        self.pending: List[bytes] = []
+        # Done once the pending record of the same index is on disk
+        self.pending_written: List[Future] = []
+        self.last_written: Future = _done()
+        self.records_since_snapshot = 0
+        self.file = None
+        self.closed = False
+
+    # Does not wait for the disk, the record is synced with the next batch. The future is done once it is on disk.
+    def append(self, record: Dict[str, Any]) -> Future:
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        written: Future = Future()
+        with self.lock:
+            if self.closed:
+                written.set_result(None)
+                return written
+            self.pending.append(line)
+            self.pending_written.append(written)
+            self.last_written = written
+        _writer.schedule(self)
+        return written
+
+    # Done once every record appended so far is on disk, the batches are written in order
+    def synced(self) -> Future:
+        with self.lock:
+            return self.last_written
+
+    # Replaces the log with a snapshot with the next batch, e.g. after recovering
+    def request_snapshot(self):
+        with self.lock:
+            self.records_since_snapshot = SNAPSHOT_INTERVAL
+        _writer.schedule(self)
+
+    # Stops logging. Removing the files forgets the game, e.g. after leaving it.
+    def close(self, remove: bool = False):
+        with self.lock:
+            self.closed = True
+            # The dropped records are not waited for, the game is forgotten
+            for written in self.pending_written:
+                written.set_result(None)
+            self.pending = []
+            self.pending_written = []
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if remove:
+                for path in (self.path, self.snapshot_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    # Called by the writer thread only. The records are taken from the pending ones and written outside of the lock,
+    # so that the handlers appending the next batch do not wait for the fsync of this one.
+    def write_pending(self):
+        with self.lock:
+            if self.closed:
+                return
+            lines = self.pending
+            written = self.pending_written
+            self.pending = []
+            self.pending_written = []
+        with self.file_lock:
+            # Closed while the records were taken, the game is forgotten
+            if self.closed:
+                for future in written:
+                    future.set_result(None)
+                return
+            try:
+                if self.file is None:
+                    self.file = open(self.path, "ab")
+                if len(lines) > 0:
+                    self.file.write(b"".join(lines))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            except Exception as e:
+                for future in written:
+                    future.set_exception(e)
+                raise
+            for future in written:
+                future.set_result(None)
+            with self.lock:
+                self.records_since_snapshot += len(lines)
+                snapshot_due = self.records_since_snapshot >= SNAPSHOT_INTERVAL
+                if snapshot_due:
+                    self.records_since_snapshot = 0
+            if snapshot_due:
+                self._write_snapshot()
+
+    # Caller must hold the file lock. The snapshot is taken after the records it replaces were written,
+    # so it contains all of them, and it is in place before the log is truncated. Records appended meanwhile
+    # are still pending and are written after the truncation.
+    def _write_snapshot(self):
+        snapshot = json.dumps(self.take_snapshot(), separators=(",", ":")).encode()
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(snapshot)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+
+
+class _LogWriter:
+    """
+    One background thread writes the records of all games, so that many records share one fsync.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.dirty: Set[GameLog] = set()
+        self.thread = None
+
+    def schedule(self, log: GameLog):
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="game-log", daemon=True)
+                self.thread.start()
+            self.dirty.add(log)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.dirty) > 0)
+            # Let more records join the batch
+            time.sleep(FSYNC_INTERVAL)
+            with self.condition:
+                logs = self.dirty
+                self.dirty = set()
+            for dirty in logs:
+                try:
+                    dirty.write_pending()
+                except Exception as e:
+                    log.error("Writing the game log %s failed: %s", dirty.path, e)
+
+
+_writer = _LogWriter()
+
+
+def _done() -> Future:
+    future: Future = Future()
+    future.set_result(None)
+    return future
+
+
+def enabled() -> bool:
+    return GAME_LOG_DIR != ""
+
+
+def open_log(game_id: str, take_snapshot: Callable[[], Dict[str, Any]]) -> Optional[GameLog]:
+    if not enabled():
+        return None
+    os.makedirs(GAME_LOG_DIR, exist_ok=True)
+    return GameLog(game_id, take_snapshot)
+
+
+# Games that have a log or a snapshot on disk
+def saved_games() -> List[str]:
+    if not enabled() or not os.path.isdir(GAME_LOG_DIR):
+        return []
+    game_ids = set()
+    for file_name in os.listdir(GAME_LOG_DIR):
+        for suffix in (LOG_SUFFIX, SNAPSHOT_SUFFIX):
+            if file_name.endswith(suffix):
+                game_ids.add(unquote(file_name[: -len(suffix)]))
+    return sorted(game_ids)
+
+
+# The snapshot of the game, if there is one, and the records written after it.
+# A record that was cut short by a crash ends the log.
+def read(game_id: str) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    name = quote(game_id, safe="")
+    snapshot = None
+    snapshot_path = os.path.join(GAME_LOG_DIR, name + SNAPSHOT_SUFFIX)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, "rb") as snapshot_file:
+            snapshot = json.loads(snapshot_file.read())
+    records = []
+    log_path = os.path.join(GAME_LOG_DIR, name + LOG_SUFFIX)
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as log_file:
+            for line in log_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    return (snapshot, records)
@@ -0,0 +1,42 @@
+from typing import Any, Dict
+import json
+
+# Longest long-poll of the game state, in seconds
+MAX_STATE_WAIT = 30
+
+
+class GameStateSnapshot:
+    """
+    Read-only view of one game for spectators and dashboards, serialized once per change of the game.
+    The ETag changes whenever the game does, and also when the node restarts.
+    """
+
+    __slots__ = ("version", "etag", "body")
+
+    def __init__(self, version: int, etag: str, body: bytes):
+        self.version = version
+        self.etag = etag
+        self.body = body
+
+
+# The parts of the game a spectator may see, the keys stay private until they are used for verification anyway
+def build_snapshot(game, version: int, etag: str) -> GameStateSnapshot:
+    (membership_version, nodes) = game.nodes.versioned_json()
+    votes = game.votes
+    view: Dict[str, Any] = {
+        "game_id": game.game_id,
+        "version": version,
+        "game_phase": game.game_phase.name,
+        "round_id": game.round_id,
+        "leader_node_number": game.leader_node_number,
+        "leader_election_ongoing": game.leader_election_ongoing,
+        "membership_epoch": game.membership_epoch,
+        "membership_version": membership_version,
+        "next_player_number": game.next_player_number,
+        "nodes": nodes,
+        "shuffler_player_numbers": list(game.shuffler_player_numbers),
+        "deal_results": game.deal_results,
+        "winner_number": game.winner_number,
+        "votes": {"agree": votes.agree, "disagree": votes.disagree, "voters": len(nodes)},
+    }
+    return GameStateSnapshot(version, etag, json.dumps(view, separators=(",", ":")).encode())
@@ -0,0 +1,119 @@
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+
+from classes import TournamentResult
+from node_registry import PlayerRecord
+
+# A lobby with more players waiting than this is split into tables of at most this many players, 0 turns lobbies off
+LOBBY_TABLE_SIZE = int(os.environ.get("LOBBY_TABLE_SIZE", 0))
+# Tables are games of their own, named after the lobby
+TABLE_SEPARATOR = "-table-"
+
+
+class Lobby:
+    """
+    The tables a lobby game has been split into, known to every node of the lobby.
+    The leader of the lobby splits it and routes joining players to the table with the fewest players.
+    """
+
+    def __init__(self, table_size: int = LOBBY_TABLE_SIZE):
+        self.table_size = table_size
+        self.lock = Lock()
+        # Players of every table when it was split off the lobby
+        self.tables: Dict[str, List[PlayerRecord]] = {}
+        # Players at every table, including the ones routed there afterwards
+        self.sizes: Dict[str, int] = {}
+        # Table of every seated player by ip, seats of a split are taken before its tables are added
+        self.seats: Dict[str, str] = {}
+        self.next_table_number = 1
+        # Results of the tables by tournament id and table
+        self.tournament_results: Dict[str, Dict[str, TournamentResult]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.table_size > 0
+
+    # Splits the players that are not at a table yet into tables of at most table_size players.
+    # Returns the new tables, None while the waiting players fit one table.
+    def split(self, lobby_game_id: str, players: Iterable[PlayerRecord]) -> Optional[Dict[str, List[PlayerRecord]]]:
+        with self.lock:
+            waiting = sorted((player for player in players if player.ip not in self.seats), key=lambda player: player.player_number)
+            if not self.enabled or len(waiting) <= self.table_size:
+                return None
+            number_of_tables = -(-len(waiting) // self.table_size)
+            tables = {}
+            for i in range(number_of_tables):
+                table_id = f"{lobby_game_id}{TABLE_SEPARATOR}{self.next_table_number}"
+                self.next_table_number += 1
+                tables[table_id] = waiting[i * len(waiting) // number_of_tables:(i + 1) * len(waiting) // number_of_tables]
+                for player in tables[table_id]:
+                    self.seats[player.ip] = table_id
+            return tables
+
+    # Tables are only routed to once they have been added, i.e. their players know about them
+    def add_tables(self, tables: Dict[str, List[PlayerRecord]]):
+        with self.lock:
+            for (table_id, players) in tables.items():
+                if table_id in self.tables:
+                    continue
+                self.tables[table_id] = list(players)
+                self.sizes[table_id] = len(players)
+                for player in players:
+                    self.seats[player.ip] = table_id
+            self.next_table_number = max(self.next_table_number, len(self.tables) + 1)
+
+    # The table of a joining player and a player of it to send the join to: the table it already sits at,
+    # or the table with the fewest players while one has room. None when the player has to wait in the lobby.
+    def route(self, ip: str) -> Optional[Tuple[str, PlayerRecord]]:
+        with self.lock:
+            table_id = self.seats.get(ip)
+            if table_id not in self.tables:
+                open_tables = [table_id for (table_id, size) in self.sizes.items() if size < self.table_size]
+                if len(open_tables) == 0:
+                    return None
+                table_id = min(open_tables, key=lambda table_id: self.sizes[table_id])
+                self.sizes[table_id] += 1
+                self.seats[ip] = table_id
+            others = [player for player in self.tables[table_id] if player.ip != ip]
+            return (table_id, others[0]) if len(others) > 0 else None
+
+    def table_ids(self) -> List[str]:
+        with self.lock:
+            return sorted(self.tables)
+
+    def players_at(self, table_id: str) -> List[PlayerRecord]:
+        with self.lock:
+            return list(self.tables.get(table_id, ()))
+
+    def record_result(self, tournament_id: str, result: TournamentResult):
+        with self.lock:
+            self.tournament_results.setdefault(tournament_id, {})[result["game_id"]] = result
+
+    def results_of(self, tournament_id: str) -> Dict[str, TournamentResult]:
+        with self.lock:
+            return dict(self.tournament_results.get(tournament_id, {}))
+
+    def forget_tournament(self, tournament_id: str):
+        with self.lock:
+            self.tournament_results.pop(tournament_id, None)
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+
+# Adds up the results of the tables of a tournament as (rounds played, outcomes, confirmed wins by ip).
+# Player numbers are only unique within a table, so the winners are told apart by their ip.
+def aggregate(results: Iterable[TournamentResult]) -> Tuple[int, Counter, Counter]:
+    rounds_played = 0
+    outcomes: Counter = Counter()
+    wins: Counter = Counter()
+    for result in results:
+        rounds_played += result["rounds_played"]
+        outcomes.update(result["outcomes"])
+        for (player_number, count) in result["wins"].items():
+            player = result["players"].get(player_number)
+            wins[player["ip"] if player is not None else f"{result['game_id']}#{player_number}"] += count
+    return (rounds_played, outcomes, wins)
+
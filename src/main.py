@@ -1,315 +1,832 @@
 import flask
 from flask import request
+from concurrent.futures import ThreadPoolExecutor
+import json as json_module
+import os
 import threading
-import requests
-from threading import Lock, Thread
+import time
 import pdb
-import traceback
-from classes import DealResultsBroadcastRequest, Deck, DoubleEncryptedDeckRequest, GamePhase, GameWinnerVerificationResultRequest, JoinRequest, JoinResponse, NewNodeListMessage, Player, PlzHelpWithEncryptingDeckRequest, PlzHelpWithEncryptingDeckResponse, ReverseBullyElectionResponse, ShareKeyRequest, WinnerRequest
-from command_line import CommandLoop, share_your_fairness_vote_and_wait_for_results
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from werkzeug.test import EnvironBuilder
+from ciphers import CIPHERS
+from classes import BATCHABLE_PATHS, DECK_MIMETYPE, POOLED_DECK_HEADER, ROUND_HEADER, SHUFFLE_CHAIN_HEADER, SHUFFLE_STAGE_TIMEOUT, SHUFFLE_TIMINGS_HEADER, DealResultsBroadcastRequest, Deck, DeckStreamReader, GamePhase, GameWinnerVerificationResultRequest, JoinRequest, JoinResponse, MembershipDeltaMessage, MessageBatchRequest, MessageBatchResponse, NewLeaderRequest, NodeList, Player, PlzHelpWithEncryptingDeckRequest, PlzHelpWithEncryptingDeckResponse, ReverseBullyElectionRequest, ReverseBullyElectionResponse, ShareKeyRequest, ShuffleStageTiming, TableAssignmentMessage, TableTournamentRequest, TableTournamentResult, UsePooledDeckRequest, WinnerRequest
+from command_line import CommandLoop, deck_pool_replenisher, play_table_tournament, share_your_fairness_vote_and_wait_for_results
 import state as state
 import reverse_bully as bully
+import failure_detector
+import network
+import overlay
+import metrics
+import node_log
+from batching import batcher
+from deck_pool import PooledShuffle
+from game_snapshot import MAX_STATE_WAIT
+from node_registry import PlayerRecord
 
 from flask_middleware import middleware
 
 
 
+log = node_log.get_logger(__name__)
+
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
 
 app.wsgi_app = middleware(app.wsgi_app)
 
+# "asyncio" serves the node on an event loop, "flask" with the Flask development server
+NODE_RUNTIME = os.environ.get("NODE_RUNTIME", "asyncio")
+
+# Work that handlers start in the background, e.g. verifying the game
+background_tasks = ThreadPoolExecutor(max_workers=256, thread_name_prefix="background")
+
+# How long verifying the game may wait for missing keys, in seconds
+VERIFY_TIMEOUT = 10
+
+# Players joining or leaving within this many seconds are announced to the other nodes in one membership delta
+MEMBERSHIP_BATCH_WINDOW = float(os.environ.get("MEMBERSHIP_BATCH_WINDOW", 0.05))
+
+# Set in the environ of the messages handled as part of a /messages batch
+BATCHED_MESSAGE_ENVIRON = "node.batched_message"
+
+# Views of the routes that may start a game this node does not know yet
+SESSION_CREATING_ENDPOINTS = {"register_nodes"}
+
+# Every game route is served both under /games/<game_id> and, for the default game, without a prefix
+def game_route(rule: str, **options):
+    def decorator(view_function):
+        app.add_url_rule(f"/games/<game_id>{rule}", view_func=view_function, **options)
+        app.add_url_rule(rule, view_func=view_function, **options)
+        return view_function
+    return decorator
+
+# Handlers find the game of the request from flask.g.game. Only joining starts a game this node does not know yet,
+# the other routes are about games that already exist.
+@app.url_value_preprocessor
+def pull_game(endpoint, values):
+    game_id = values.pop("game_id", state.DEFAULT_GAME_ID) if values else state.DEFAULT_GAME_ID
+    if endpoint not in SESSION_CREATING_ENDPOINTS:
+        game = state.find_session(game_id)
+        if game is None:
+            flask.abort(flask.make_response({"message": f"Unknown game {game_id}"}, 404))
+        flask.g.game = game
+        return
+    try:
+        flask.g.game = state.get_session(game_id)
+    except state.TooManySessions as e:
+        flask.abort(flask.make_response({"message": str(e)}, 503))
+
+# Nodes of the dissemination overlay pass a message on to the nodes below them before handling it themselves,
+# even one of a round they have already ended, the nodes below may not have ended it yet
+@app.before_request
+def forward_overlay_message():
+    subtree = request.headers.get(overlay.OVERLAY_SUBTREE_HEADER)
+    if subtree:
+        game: state.GameSession = flask.g.game
+        path = request.path
+        prefix = f"/games/{game.game_id}"
+        if path.startswith(prefix + "/"):
+            path = path[len(prefix):]
+        headers = {overlay.OVERLAY_PATH_HEADER: overlay.extend_path(game, request.headers.get(overlay.OVERLAY_PATH_HEADER))}
+        if ROUND_HEADER in request.headers:
+            headers[ROUND_HEADER] = request.headers[ROUND_HEADER]
+        background_tasks.submit(overlay.forward, game, subtree, path, request.get_data(), request.content_type, headers)
+
+# Messages of a later round start it, messages of an earlier one are refused. Older nodes do not send the round.
+@app.before_request
+def check_round():
+    round_id = request.headers.get(ROUND_HEADER)
+    if round_id is not None:
+        game: state.GameSession = flask.g.game
+        if not game.enter_round(int(round_id)):
+            return {"message": f"Round {round_id} is over"}, 409
+
+# Other nodes act on the answer to a message, so the changes it made have to be in the game log first.
+# The messages of a batch are answered together, after the batch.
+@app.after_request
+def wait_for_game_log(response: flask.Response) -> flask.Response:
+    game: Optional[state.GameSession] = flask.g.get("game")
+    if request.method == "POST" and game is not None and not request.environ.get(BATCHED_MESSAGE_ENVIRON):
+        game.wait_for_log()
+    return response
+
 def main():
-    print("Starting node")
-    server_thread = threading.Thread(target=start_server)
+    log.info("Starting node")
+    serve = choose_server()
+    recovered_games = state.recover_sessions()
+    server_thread = threading.Thread(target=serve)
     server_thread.start()
+    for game in recovered_games:
+        background_tasks.submit(rejoin_game, game)
+    failure_detector.detector.start()
+    deck_pool_replenisher.start()
     start_cmdloop()
 
-# Start FLASK thread
-def start_server():
-    app.run(port=6376, host="0.0.0.0")
+# The server of NODE_RUNTIME, started in its own thread. Fails before the node starts if the runtime cannot be used.
+def choose_server(host: str = network.NODE_HOST) -> Callable[[], None]:
+    if NODE_RUNTIME == "asyncio":
+        try:
+            import async_server
+        except ImportError as e:
+            raise RuntimeError("The asyncio runtime needs aiohttp, install it with `poetry install -E asyncio` or set NODE_RUNTIME=flask") from e
+        return lambda: async_server.serve(app.wsgi_app, host=host, port=network.PORT)
+    return lambda: app.run(port=network.PORT, host=host)
 
 # Start CMD line thread
 def start_cmdloop():
     try:
         CommandLoop().cmdloop()
-    except Exception as e:
-        print("Exception from cmdloop")
-        print(e)
-        traceback.print_exc()
+    except Exception:
+        log.exception("Exception from cmdloop")
         pdb.set_trace()
 
 # Reverse Bully election
-@app.route("/election", methods=["POST"])
+@game_route("/election", methods=["POST"])
 def election() -> ReverseBullyElectionResponse:
+    game: state.GameSession = flask.g.game
+    # Older nodes do not send a term
+    json: ReverseBullyElectionRequest = request.get_json(silent=True) or {}
     origin = request.remote_addr
-    if origin in [node["ip"] for node in state.NODES.values()]:
-        origin_number = next(
-            node["player_number"] for node in state.NODES.values() if node["ip"] == origin
-        )
-        if origin_number > state.OWN_NODE_NUMBER:
-            Thread(target=take_over_bully).start()
+    origin_node = game.nodes.by_ip(origin)
+    if origin_node is not None:
+        origin_number = origin_node.player_number
+        if origin_number > game.own_node_number:
+            background_tasks.submit(take_over_bully, game, json.get("term", game.election_term + 1))
             return {"taking_over": True}
     return {"taking_over": False}
 
 # Reverse bully, this is spawned in own thread
-def take_over_bully():
-    print("Taking over the election.")
-    bully.reverse_bully()
+def take_over_bully(game: state.GameSession, term: int):
+    # The sender has missed a later election, this one makes sure that it learns the leader
+    if term < game.election_term:
+        term = game.election_term + 1
+    log.info("Taking over the election.")
+    bully.reverse_bully(game, term)
 
 # Reverse bully, new leader announced
-@app.route("/new-leader", methods=["POST"])
+@game_route("/new-leader", methods=["POST"])
 def assign_new_leader():
-    origin = request.origin
-    if origin in [node["ip"] for node in state.NODES.values()]:
-        origin_number = next(
-            node["player_number"] for node in state.NODES.values() if node["ip"] == origin
-        )
-        if origin_number < state.OWN_NODE_NUMBER:
-            print(f"Assigning new leader: {origin_number}")
-            state.LEADER_NODE_NUMBER = origin_number
-            state.LEADER_ELECTION_ONGOING = False
+    game: state.GameSession = flask.g.game
+    json: NewLeaderRequest = request.get_json(silent=True) or {}
+    origin = request.remote_addr
+    origin_node = game.nodes.by_ip(origin)
+    if origin_node is not None:
+        origin_number = json.get("leader_node_number", origin_node.player_number)
+        term = json.get("term", game.election_term)
+        if origin_number < game.own_node_number:
+            if game.accept_leader(origin_number, term):
+                log.info("Assigning new leader: %s", origin_number)
+            else:
+                log.info("Ignoring leader %s of the old election term %s.", origin_number, term)
         else:
-            print("Someone with smaller node number is trying to take over.")
+            log.info("Someone with bigger node number is trying to take over.")
+            background_tasks.submit(take_over_bully, game, term + 1)
     return {"message": "Ok, assigned new leader."}
 
 @app.route("/health", methods=["GET"])
 def health():
     return {"message": "ok"}
 
-@app.route("/get-nodes", methods=["GET"])
-def get_nodes():
-    return {"message": "Here are my nodes I know of", "nodes": state.NODES}
-
-
-# have to prevent that two nodes don't join with the same player number
-registration_lock = Lock()
+# Counters and latency histograms of this node for Prometheus
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return flask.Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@game_route("/get-nodes", methods=["GET"])
+def get_nodes() -> NodeList:
+    game: state.GameSession = flask.g.game
+    (version, nodes) = game.nodes.versioned_json()
+    return NodeList(
+        message="Here are my nodes I know of",
+        nodes=nodes,
+        next_player_number=game.next_player_number,
+        leader_node_number=game.leader_node_number,
+        membership_epoch=game.membership_epoch,
+        membership_version=version,
+    )
+
+
+# Read-only state of the game for spectators and dashboards. A poll with the ETag of the previous answer gets
+# 304 Not Modified, with ?wait=<seconds> it first waits for the game to change (long-poll).
+@game_route("/state", methods=["GET"])
+def game_state():
+    game: state.GameSession = flask.g.game
+    snapshot = game.state_snapshot()
+    wait = min(request.args.get("wait", 0, type=float), MAX_STATE_WAIT)
+    if wait > 0 and request.if_none_match.contains(snapshot.etag):
+        game.wait_until(lambda: game.state_version != snapshot.version, wait)
+        snapshot = game.state_snapshot()
+    if request.if_none_match.contains(snapshot.etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(snapshot.body, mimetype="application/json")
+    response.set_etag(snapshot.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
-@app.route("/join", methods=["POST"])
+@game_route("/join", methods=["POST"])
 def register_nodes():
-    try:
-        registration_lock.acquire()
-
+    game: state.GameSession = flask.g.game
+    json: JoinRequest = request.json
+    origin = request.remote_addr
+    # Joining any node of the game works, the others send the player on to the leader
+    if game.own_node_number not in (-1, game.leader_node_number):
+        leader = game.nodes.get(game.leader_node_number)
+        if leader is not None:
+            return redirect_to(leader, "/join", game.game_id)
+    # The leader of a lobby sends new players on to the table with the fewest players
+    if game.own_node_number == game.leader_node_number and game.lobby.enabled and game.nodes.by_ip(origin) is None:
+        seat = game.lobby.route(origin)
+        if seat is not None:
+            (table_id, table_player) = seat
+            log.info("Routing %s to table %s", origin, table_id)
+            return redirect_to(table_player, "/join", table_id)
+    # Only the player number is assigned under the lock, the others hear about the new players once per batch of joins
+    with game.registration_lock:
         # Do not let players join while game ongoing.
-        if state.GAME_PHASE == state.GAME_PHASE.GAME_ONGOING:
+        if game.game_phase == GamePhase.GAME_ONGOING:
             return {"message": "Game ongoing, please join later."}
 
-        json: JoinRequest = request.json
-        origin = request.remote_addr
+        if len(game.nodes) >= state.MAX_PLAYERS_PER_GAME:
+            return {"message": "Game is full."}, 409
 
         # Leader assigns itself once first person joins
-        if state.NEXT_PLAYER_NUMBER == 1:
-            state.OWN_NODE_NUMBER = 1
-            state.NODES[state.LEADER_NODE_NUMBER] = Player(
-                player_number=1,
-                ip=json["your_ip"],
-                score=0,
-            )
-            state.NEXT_PLAYER_NUMBER = 2
-
-        # Check if node trying to join is/was already in-game
-        if origin in [node["ip"] for node in state.NODES.values()]:
-            print(
-                "Node with IP",
-                origin,
-                "already in game.",
+        if game.next_player_number == 1:
+            game.own_node_number = 1
+            game.start_membership_epoch()
+            leader = PlayerRecord(player_number=1, ip=json["your_ip"])
+            game.nodes.add(leader)
+            game.next_player_number = 2
+            game.log_roles()
+            game.log_membership(joined=[leader])
+
+        existing_node = game.nodes.by_ip(origin)
+        if existing_node is None:
+            log.info("Adding player #%s to game", game.next_player_number)
+            player = PlayerRecord(player_number=game.next_player_number, ip=origin)
+            game.nodes.add(player)
+            game.next_player_number += 1
+            game.log_membership(joined=[player])
+            game.notify_changed()
+
+    # Check if node trying to join is/was already in-game
+    if existing_node is not None:
+        log.info("Node with IP %s already in game.", origin)
+        # FAULT_TOLERANCE: If node drops out of game, get list his list of nodes, if it is empty, return him the current state
+        try:
+            get_nodes_result: NodeList = network.get(existing_node, "/get-nodes", game.game_id).json()
+            lost_state = len(get_nodes_result["nodes"]) == 0
+        except Exception:
+            lost_state = True
+        if lost_state:
+            log.info("Node did probably crash or lose connection, sending him the game state.")
+            (version, nodes) = game.nodes.versioned_json()
+            return JoinResponse(
+                message="You have already registered.",
+                nodes=nodes,
+                your_player_number=existing_node.player_number,
+                leader_node_number=game.leader_node_number,
+                membership_epoch=game.membership_epoch,
+                membership_version=version,
+                game_id=game.game_id,
             )
-            # FAULT_TOLERANCE: If node drops out of game, get list his list of nodes, if it is empty, return him the current state
-            get_nodes_result = requests.get(f"http://{origin}:6376/get-nodes").json
-            if get_nodes_result["nodes"].length == 0:
-                print(
-                    "Node did probably crash or lose connection, sending him the game state."
-                )
-                return {"message": "You have already registered.", "nodes": state.NODES}
-
-            return {"message": "You are already part of this game."}, 400
-
-        print("Adding player #", state.NEXT_PLAYER_NUMBER, " to game")
-        state.NODES[int(state.NEXT_PLAYER_NUMBER)] = Player(
-            ip=origin, player_number=state.NEXT_PLAYER_NUMBER, score=0
-        )
-        state.NEXT_PLAYER_NUMBER += 1
-
-        print("Broadcast to others the recently joining participant")
-        print("Nodes in game:", state.NODES)
-        broadcast_new_node_list()
-
-        print("Return current game state to joining paricipant.")
-        return JoinResponse(
-            message="New node has been added",
-            nodes=state.NODES,
-            your_player_number=state.NEXT_PLAYER_NUMBER - 1,
-            leader_node_number=state.LEADER_NODE_NUMBER,
-        )
-    finally:
-        registration_lock.release()
-
 
-@app.route("/leave", methods=["POST"])
+        return {"message": "You are already part of this game."}, 400
+
+    log.debug("Waiting for the batch of player #%s to be committed", player.player_number)
+    (version, nodes) = game.admissions.admit(player.player_number, lambda player_numbers: commit_joins(game, player_numbers)).result()
+    if game.lobby.enabled and len(nodes) > game.lobby.table_size:
+        background_tasks.submit(split_lobby, game)
+    return JoinResponse(
+        message="New node has been added",
+        nodes=nodes,
+        your_player_number=player.player_number,
+        leader_node_number=game.leader_node_number,
+        membership_epoch=game.membership_epoch,
+        membership_version=version,
+        game_id=game.game_id,
+    )
+
+# Sends the players that were already in the game one delta with a batch of joins.
+# The joiners get the whole node list in their responses instead.
+def commit_joins(game: state.GameSession, player_numbers: List[int]) -> Tuple[int, Dict[str, Player]]:
+    log.debug("Broadcast to others the %s recently joining participants", len(player_numbers))
+    return broadcast_membership_delta(game, player_numbers)
+
+
+# Sends the client to the same route of another node with 307, so that it repeats the POST there
+def redirect_to(node: PlayerRecord, path: str, game_id: str) -> flask.Response:
+    return flask.redirect(network.node_url(node, path, game_id), code=307)
+
+# Splits the players waiting in the lobby into tables once there are more than LOBBY_TABLE_SIZE of them.
+# The players hear about their tables before anyone is routed to them.
+def split_lobby(game: state.GameSession):
+    tables = game.lobby.split(game.game_id, game.nodes.snapshot())
+    if tables is None:
+        return
+    log.info("Splitting lobby %s into tables %s", game.game_id, sorted(tables))
+    message: TableAssignmentMessage = {
+        "tables": {table_id: {str(player.player_number): player.to_json() for player in players} for (table_id, players) in tables.items()},
+        "membership_epoch": time.time_ns(),
+    }
+    result = network.broadcast(network.peers(game), "/tables", game.game_id, json=message)
+    if not result.ok:
+        log.warning("Nodes %s did not get their tables", sorted(result.failures))
+    seat_at_tables(game, message)
+
+@game_route("/tables", methods=["POST"])
+def tables():
+    game: state.GameSession = flask.g.game
+    seat_at_tables(game, request.json)
+    return {"message": "Tables received"}
+
+# Remembers the tables of the lobby and starts playing at my own one. The tables keep the player numbers of the lobby,
+# so the player with the smallest number wins the reverse bully election of the table.
+def seat_at_tables(game: state.GameSession, message: TableAssignmentMessage):
+    game.lobby.add_tables({
+        table_id: [PlayerRecord.from_json(player) for player in players.values()] for (table_id, players) in message["tables"].items()
+    })
+    for (table_id, players) in message["tables"].items():
+        if str(game.own_node_number) not in players:
+            continue
+        table = state.get_session(table_id)
+        table.adopt_node_list(players, message["membership_epoch"], len(players))
+        player_numbers = [int(player_number) for player_number in players]
+        table.own_node_number = game.own_node_number
+        table.next_player_number = max(table.next_player_number, max(player_numbers) + 1)
+        table.leader_node_number = min(player_numbers)
+        table.log_roles()
+        table.notify_changed()
+        log.info("Seated at table %s with players %s", table_id, sorted(player_numbers))
+        if table.leader_node_number == table.own_node_number:
+            background_tasks.submit(bully.reverse_bully, table)
+
+# The leader of a lobby has the tables play a tournament, every table sends its result to /tournament-results
+@game_route("/tournament", methods=["POST"])
+def table_tournament():
+    game: state.GameSession = flask.g.game
+    if game.own_node_number != game.leader_node_number:
+        leader = game.nodes.get(game.leader_node_number)
+        if leader is None:
+            return {"message": "The leader of the table is not known"}, 503
+        return redirect_to(leader, "/tournament", game.game_id)
+    json: TableTournamentRequest = request.json
+    background_tasks.submit(play_table_tournament, game, json)
+    return {"message": "Tournament started"}
+
+@game_route("/tournament-results", methods=["POST"])
+def tournament_results():
+    game: state.GameSession = flask.g.game
+    json: TableTournamentResult = request.json
+    game.lobby.record_result(json["tournament_id"], json["result"])
+    game.notify_changed()
+    return {"message": "Result received"}
+
+
+@game_route("/leave", methods=["POST"])
 def unregister_nodes():
+    game: state.GameSession = flask.g.game
     origin = request.remote_addr
-    player_name = next(player_name for (player_name, node) in state.NODES.items() if node["ip"] == origin)
-    if player_name:
-        state.NODES.pop(player_name)
-        print("Nodes still in game", state.NODES)
-        broadcast_new_node_list()
+    leaving_node = game.nodes.by_ip(origin)
+    if leaving_node is not None:
+        game.nodes.remove(leaving_node.player_number)
+        game.log_membership(left=[leaving_node.player_number])
+        game.notify_changed()
+        log.info("Player #%s left the game", leaving_node.player_number)
+        log.debug("Nodes still in game %s", game.nodes)
+        schedule_membership_delta(game)
         return {"message": "Goodbye"}
     return {"message": "You are not part of this game"}
 
-# Used when a new player joins a game
-def broadcast_new_node_list():
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER:
+# Used when players join or leave a game. Changes within MEMBERSHIP_BATCH_WINDOW are sent together as one delta.
+def schedule_membership_delta(game: state.GameSession):
+    with game.membership_lock:
+        if game.membership_delta_scheduled:
+            return
+        game.membership_delta_scheduled = True
+    timer = threading.Timer(MEMBERSHIP_BATCH_WINDOW, broadcast_membership_delta, [game])
+    timer.daemon = True
+    timer.start()
+
+# Returns the node list with its version as it was when the delta was taken
+def broadcast_membership_delta(game: state.GameSession, excluded_player_numbers: Sequence[int] = ()) -> Tuple[int, Dict[str, Player]]:
+    with game.membership_lock:
+        game.membership_delta_scheduled = False
+    with game.membership_broadcast_lock:
+        delta = game.nodes.take_delta()
+        node_list = game.nodes.versioned_json()
+        if delta is None:
+            return node_list
+        (from_version, to_version, joined, left) = delta
+        message: MembershipDeltaMessage = {
+            "epoch": game.membership_epoch,
+            "from_version": from_version,
+            "to_version": to_version,
+            "joined": [player.to_json() for player in joined],
+            "left": left,
+            "next_player_number": game.next_player_number,
+        }
+        network.broadcast(network.peers(game, *excluded_player_numbers), "/membership-delta", game.game_id, json=message)
+        return node_list
+
+@game_route("/membership-delta", methods=["POST"])
+def membership_delta():
+    game: state.GameSession = flask.g.game
+    json: MembershipDeltaMessage = request.json
+    joined = [PlayerRecord.from_json(player) for player in json["joined"]]
+    applied = json["epoch"] == game.membership_epoch and game.nodes.apply_delta(
+        json["from_version"],
+        json["to_version"],
+        joined,
+        json["left"],
+    )
+    if not applied:
+        log.info("Missed membership changes before version %s, fetching all nodes.", json["from_version"])
+        background_tasks.submit(fetch_node_list, game, PlayerRecord(player_number=-1, ip=request.remote_addr))
+        return {"message": "Fetching all nodes"}
+    game.next_player_number = max(game.next_player_number, json["next_player_number"])
+    game.log_membership(joined, json["left"])
+    game.notify_changed()
+    return {"message": "Membership delta applied"}
+
+# After a restart, catches up with the membership changes and the leader changes made while I was down.
+# Asks the leader first and the others if it does not answer.
+def rejoin_game(game: state.GameSession):
+    if game.own_node_number == -1:
+        return
+    for node in sorted(network.peers(game), key=lambda node: node.player_number != game.leader_node_number):
+        try:
+            node_list: NodeList = network.get(node, "/get-nodes", game.game_id).json()
+        except Exception:
             continue
-        new_node_list: NewNodeListMessage = {"nodes": state.NODES, "next_player_number": state.NEXT_PLAYER_NUMBER}
-        requests.post(
-            f"http://{node['ip']}:6376/new-node-list", json=new_node_list
-        )
-
-@app.route("/new-node-list", methods=["POST"])
+        game.next_player_number = max(game.next_player_number, node_list["next_player_number"])
+        game.adopt_node_list(node_list["nodes"], node_list["membership_epoch"], node_list["membership_version"])
+        if node_list["leader_node_number"] != game.leader_node_number:
+            game.leader_node_number = node_list["leader_node_number"]
+            game.log_roles()
+        log.info("Rejoined game %s through node %s, the leader is %s.", game.game_id, node.player_number, game.leader_node_number)
+        return
+    log.warning("Could not reach any node of game %s after restarting.", game.game_id)
+
+# Replaces my nodes with the ones of the node that sent the delta, when I have missed membership changes
+def fetch_node_list(game: state.GameSession, sender: PlayerRecord):
+    try:
+        node_list: NodeList = network.get(sender, "/get-nodes", game.game_id).json()
+    except Exception as e:
+        log.warning("Fetching the nodes from %s failed: %s", sender.ip, e)
+        return
+    game.next_player_number = max(game.next_player_number, node_list["next_player_number"])
+    game.adopt_node_list(node_list["nodes"], node_list["membership_epoch"], node_list["membership_version"])
+    log.info("I fetched the nodes at version %s.", node_list["membership_version"])
+
+# Full node lists are sent by older nodes
+@game_route("/new-node-list", methods=["POST"])
 def new_node_list():
-    state.NODES = {int(k): v for k, v in request.json["nodes"].items()}
-    state.NEXT_PLAYER_NUMBER = request.json["next_player_number"]
-    print("I received the new node list.")
+    game: state.GameSession = flask.g.game
+    game.nodes.replace_all(PlayerRecord.from_json(player) for player in request.json["nodes"].values())
+    game.next_player_number = request.json["next_player_number"]
+    game.log_node_list()
+    game.notify_changed()
+    log.info("I received the new node list.")
     return {"message": "New node list received"}
 
-@app.route("/helper-key", methods=["POST"])
+@game_route("/helper-key", methods=["POST"])
 def handle_helper_key():
+    game: state.GameSession = flask.g.game
     json: ShareKeyRequest = request.json
-    state.HELPER_ENCRYPTION_KEY = json["key"]
-    print("I received the helper node encryption key.")
+    # Older nodes have one helper, which sends its key itself without naming itself
+    player_number = json.get("player_number")
+    if player_number is None:
+        sender = overlay.message_sender(game, request.remote_addr, request.headers.get(overlay.OVERLAY_PATH_HEADER))
+        if sender is None:
+            return {"message": "You are not part of this game"}, 400
+        player_number = sender.player_number
+    game.helper_encryption_keys[player_number] = json["key"]
+    game.log_change({"type": "helper_key", "player_number": player_number, "key": json["key"]})
+    game.notify_changed()
+    background_tasks.submit(game.verifier.add_key, player_number, json["key"])
+    log.debug("I received the encryption key of helper node %s.", player_number)
     return {"message": "Thanks!"}
 
-@app.route("/leader-key", methods=["POST"])
+@game_route("/leader-key", methods=["POST"])
 def handle_leader_key():
+    game: state.GameSession = flask.g.game
     json: ShareKeyRequest = request.json
-    state.ENCRYPTION_KEY = json["key"]
-    print("I received the leader node private key.")
+    game.encryption_key = json["key"]
+    game.log_change({"type": "leader_key", "key": json["key"]})
+    game.notify_changed()
+    background_tasks.submit(game.verifier.add_key, json.get("player_number", game.leader_node_number), json["key"])
+    log.debug("I received the leader node private key.")
     return {"message": "Thanks!"}
 
 
-@app.route("/game-starting", methods=["POST"])
+@game_route("/game-starting", methods=["POST"])
 def game_starting():
-    state.GAME_PHASE = GamePhase.GAME_ONGOING
-    print("Game started.")
+    game: state.GameSession = flask.g.game
+    # The leader sends this to itself too, together with the deal
+    if game.game_phase != GamePhase.WAITING_FOR_PLAYERS:
+        return {"message": "Ok"}
+    game.game_phase = GamePhase.GAME_ONGOING
+    game.log_change({"type": "phase", "phase": game.game_phase.value})
+    game.notify_changed()
+    log.info("Game started.")
     return {"message": "Ok"}
 
 
-@app.route("/plz-help-with-encrypting", methods=["POST"])
-def handle_plz_help_with_encrypting() -> PlzHelpWithEncryptingDeckResponse:
+# Deck endpoints accept both JSON and the binary deck format
+def deck_from_request() -> Deck:
+    if request.mimetype == DECK_MIMETYPE:
+        return Deck.from_bytes(request.get_data())
     json: PlzHelpWithEncryptingDeckRequest = request.json
-    deck = Deck(json["deck"])
-    state.HELPER_ENCRYPTION_KEY = deck.encrypt_all()
+    # Older nodes do not send the cipher, they only know Fernet
+    return Deck(json["deck"], cipher=json.get("cipher", "fernet"))
+
+# Binary deck is only sent if the client asks for it, JSON is preferred otherwise
+def deck_response(deck: Deck):
+    if request.accept_mimetypes.best_match(["application/json", DECK_MIMETYPE]) == DECK_MIMETYPE:
+        return flask.Response(deck.to_bytes(), mimetype=DECK_MIMETYPE)
+    response: PlzHelpWithEncryptingDeckResponse = {"deck": deck.cards_to_json(), "cipher": deck.cipher}
+    return response
+
+
+@game_route("/plz-help-with-encrypting", methods=["POST"])
+def handle_plz_help_with_encrypting() -> PlzHelpWithEncryptingDeckResponse:
+    game: state.GameSession = flask.g.game
+    deck = deck_from_request()
+    game.helper_encryption_keys[game.own_node_number] = deck.encrypt_all()
     deck.shuffle()
 
-    state.DOUBLE_ENCRYPTED_DECK = deck
+    game.double_encrypted_deck = deck
+    game.log_change({"type": "helper_key", "player_number": game.own_node_number, "key": game.helper_encryption_keys[game.own_node_number]})
+    game.log_deck(deck)
     # Broadcast to all other nodes so that everyone can later verify that there has been no cheating
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER or node["player_number"] == state.LEADER_NODE_NUMBER:
-            continue
-        requests.post(
-            f"http://{node['ip']}:6376/double-encrypted-deck", json={"deck": state.DOUBLE_ENCRYPTED_DECK.cards_to_json()}
+    network.broadcast(
+        network.peers(game, game.leader_node_number),
+        "/double-encrypted-deck",
+        game.game_id,
+        data=deck.to_bytes(),
+        headers={**game.round_headers(), "Content-Type": DECK_MIMETYPE},
+    )
+    return deck_response(deck)
+
+
+# One helper in the shuffle chain. Cards are encrypted as they arrive, then the deck is shuffled
+# and streamed to the next helper. The last helper's deck is passed back as the response.
+# Decks for the deck pool are not part of any round yet, their keys are kept until a round uses them.
+@game_route("/shuffle-stage", methods=["POST"])
+def handle_shuffle_stage():
+    game: state.GameSession = flask.g.game
+    pooled_deck_id = request.headers.get(POOLED_DECK_HEADER)
+    membership = game.membership_stamp()
+    started = time.time()
+    reader = DeckStreamReader(request.stream)
+    cipher = CIPHERS[reader.cipher].generate()
+    cards = []
+    for chunk in reader.iter_chunks():
+        cards.extend(cipher.encrypt_batch(chunk))
+    encrypted = time.time()
+    deck = Deck(cards=cards, cipher=reader.cipher)
+    deck.shuffle()
+    if pooled_deck_id is None:
+        game.helper_encryption_keys[game.own_node_number] = cipher.key
+        game.log_change({"type": "helper_key", "player_number": game.own_node_number, "key": cipher.key})
+    timing: ShuffleStageTiming = {
+        "player_number": game.own_node_number,
+        "encrypt_ms": round((encrypted - started) * 1000),
+        "shuffle_ms": round((time.time() - encrypted) * 1000),
+    }
+
+    rest_of_chain = [int(player_number) for player_number in request.headers.get(SHUFFLE_CHAIN_HEADER, "").split(",") if player_number]
+    if len(rest_of_chain) > 0:
+        if pooled_deck_id is not None:
+            game.pooled_shuffles.add(PooledShuffle(pooled_deck_id, cipher.key, None, membership))
+        downstream = network.post(
+            game.nodes[rest_of_chain[0]],
+            "/shuffle-stage",
+            game.game_id,
+            data=deck.iter_bytes(),
+            headers={
+                **({POOLED_DECK_HEADER: pooled_deck_id} if pooled_deck_id is not None else game.round_headers()),
+                "Content-Type": DECK_MIMETYPE,
+                SHUFFLE_CHAIN_HEADER: ",".join(str(player_number) for player_number in rest_of_chain[1:]),
+            },
+            timeout=SHUFFLE_STAGE_TIMEOUT * len(rest_of_chain),
+            stream=True,
+        )
+        downstream.raise_for_status()
+        timings = [timing] + json_module.loads(downstream.headers[SHUFFLE_TIMINGS_HEADER])
+        return flask.Response(
+            downstream.iter_content(64 * 1024),
+            mimetype=DECK_MIMETYPE,
+            headers={SHUFFLE_TIMINGS_HEADER: json_module.dumps(timings)},
         )
-    return {"deck": state.DOUBLE_ENCRYPTED_DECK.cards_to_json()}
 
+    # Last helper, everyone gets a copy of the final deck so that they can later verify that there has been no cheating.
+    # The copy of a pooled deck is sent when a round uses it.
+    if pooled_deck_id is not None:
+        game.pooled_shuffles.add(PooledShuffle(pooled_deck_id, cipher.key, deck, membership))
+    else:
+        share_double_encrypted_deck(game, deck)
+    return flask.Response(
+        deck.to_bytes(),
+        mimetype=DECK_MIMETYPE,
+        headers={SHUFFLE_TIMINGS_HEADER: json_module.dumps([timing])},
+    )
+
+
+# The leader starts a round with a pooled deck, the helpers use the keys they shuffled it with
+@game_route("/pooled-deck", methods=["POST"])
+def handle_pooled_deck():
+    game: state.GameSession = flask.g.game
+    json: UsePooledDeckRequest = request.json
+    shuffle = game.pooled_shuffles.take(json["deck_id"], game.membership_stamp())
+    if shuffle is None:
+        return {"message": "Unknown deck"}, 404
+    game.helper_encryption_keys[game.own_node_number] = shuffle.key
+    game.log_change({"type": "helper_key", "player_number": game.own_node_number, "key": shuffle.key})
+    if shuffle.deck is not None:
+        share_double_encrypted_deck(game, shuffle.deck)
+    game.notify_changed()
+    return {"message": "Ok"}
+
+
+def share_double_encrypted_deck(game: state.GameSession, deck: Deck):
+    game.double_encrypted_deck = deck
+    game.log_deck(deck)
+    network.broadcast(
+        network.peers(game, game.leader_node_number),
+        "/double-encrypted-deck",
+        game.game_id,
+        data=deck.to_bytes(),
+        headers={**game.round_headers(), "Content-Type": DECK_MIMETYPE},
+    )
 
-@app.route("/double-encrypted-deck", methods=["POST"])
+
+@game_route("/double-encrypted-deck", methods=["POST"])
 def handle_double_encrypted_deck():
-    json: DoubleEncryptedDeckRequest = request.json
-    deck = Deck(json["deck"])
-    state.DOUBLE_ENCRYPTED_DECK = deck
-    print("Copy of double encrypted deck received and stored for later game verification.")
+    game: state.GameSession = flask.g.game
+    deck = deck_from_request()
+    game.double_encrypted_deck = deck
+    game.log_deck(deck)
+    game.notify_changed()
+    log.debug("Copy of double encrypted deck received and stored for later game verification.")
     return {"message": "Ok"}
 
 
-@app.route("/winner", methods=["POST"])
+@game_route("/winner", methods=["POST"])
 def handle_winner():
+    game: state.GameSession = flask.g.game
     json: WinnerRequest = request.json
-    state.WINNER_NUMBER = json["winner"]
-    print(f"Winner is player #{state.WINNER_NUMBER}")
-    state.GAME_PHASE = GamePhase.VOTING
-    if state.WINNER_NUMBER == state.OWN_NODE_NUMBER:
-        print("I am the winner")
+    game.winner_number = json["winner"]
+    log.info("Winner is player #%s", game.winner_number)
+    game.game_phase = GamePhase.VOTING
+    game.log_change({"type": "winner", "winner": game.winner_number})
+    game.log_change({"type": "phase", "phase": game.game_phase.value})
+    game.notify_changed()
+    if game.winner_number == game.own_node_number:
+        log.info("I am the winner")
     else:
-        print("I lost")
-    Thread(target=verify_game_and_participate_in_fairness_voting).start()
+        log.info("I lost")
+    background_tasks.submit(verify_game_and_participate_in_fairness_voting, game, game.round_id)
     return {"message": "Ok"}
 
-def verify_game_and_participate_in_fairness_voting():
-    verify_dealt_cards = {}
-    print("Verifying game.")
-    for node in sorted(state.NODES):
-        verify_dealt_cards[node] = state.DOUBLE_ENCRYPTED_DECK.pop()
-
-
-    highest_card = -1
-    highest_card_owner = None
-    for (node, card) in verify_dealt_cards.items():
-        helper_decrypted_card = Deck.decrypt_helper(state.HELPER_ENCRYPTION_KEY, card)
-        decrypted_card_value = Deck.decrypt_one(state.ENCRYPTION_KEY, helper_decrypted_card)
-        print(f"According to my knowledge, player {node} received card {decrypted_card_value}.")
-        if decrypted_card_value > highest_card:
-            highest_card = decrypted_card_value
-            highest_card_owner = node
-
-    agree_on_winner = highest_card_owner == state.WINNER_NUMBER 
-    print(f"I found out that the player {highest_card_owner} is the winner, my agreement with leader: {agree_on_winner}")
-    game_winner: GameWinnerVerificationResultRequest = { "agree": agree_on_winner }
-    share_your_fairness_vote_and_wait_for_results(game_winner, state.WINNER_NUMBER)
-
-
-@app.route("/game-winner-verification-result", methods=["POST"])
+# The cards have usually been decrypted already, layer by layer while the keys were arriving
+def verify_game_and_participate_in_fairness_voting(game: state.GameSession, round_id: int):
+    # The leader may already start the next round, so the state of this one is read before checking that it is still current
+    verifier = game.verifier
+    winner_number = game.winner_number
+    if game.round_id != round_id:
+        log.info("Round %s is over, not verifying it.", round_id)
+        return
+    log.debug("Verifying game.")
+    start_verification(game)
+    game.feed_verifier()
+    game.wait_until(lambda: verifier.done or game.round_id != round_id, VERIFY_TIMEOUT)
+    if game.round_id != round_id:
+        log.info("Round %s is over, not verifying it.", round_id)
+        return
+    if not verifier.done:
+        log.warning("Could not decrypt the dealt cards, some of the keys are missing.")
+    for (node, card_value) in verifier.values.items():
+        log.debug("According to my knowledge, player %s received card %s.", node, card_value)
+
+    highest_card_owner = verifier.highest_card_owner
+    agree_on_winner = verifier.done and highest_card_owner == winner_number
+    log.info("I found out that the player %s is the winner, my agreement with leader: %s", highest_card_owner, agree_on_winner)
+    game_winner: GameWinnerVerificationResultRequest = { "agree": agree_on_winner, "player_number": game.own_node_number }
+    share_your_fairness_vote_and_wait_for_results(game, game_winner, winner_number, round_id)
+
+
+# Starts decrypting my copy of the deck once the order of the helpers is known
+def start_verification(game: state.GameSession):
+    if game.verifier.started or game.double_encrypted_deck is None or len(game.shuffler_player_numbers) == 0:
+        return
+    game.feed_verifier()
+    game.verifier.start_from_deck(
+        game.double_encrypted_deck, game.nodes.numbers(), game.shuffler_player_numbers, game.leader_node_number
+    )
+
+
+@game_route("/game-winner-verification-result", methods=["POST"])
 def handle_game_winner_verification_result():
+    game: state.GameSession = flask.g.game
     json: GameWinnerVerificationResultRequest = request.json
-    if json["agree"]:
-        state.NUMBER_OF_NODES_THAT_AGREE_WITH_THE_RESULT += 1
-    else:
-        state.NUMBER_OF_NODES_THAT_DISAGREE_WITH_THE_RESULT += 1
+    # Votes passed on through the tree are counted for the node they started from, the others for the node that sent them.
+    # Older nodes do not name the voter.
+    sender = overlay.message_sender(game, request.remote_addr, request.headers.get(overlay.OVERLAY_PATH_HEADER))
+    if sender is None:
+        return {"message": "You are not part of this game"}, 400
+    voter = json.get("player_number", sender.player_number)
+    if voter != sender.player_number:
+        return {"message": f"Player {sender.player_number} cannot vote for player {voter}"}, 403
+    # The round may have ended after check_round, its votes must not end up in the next one
+    (current_round_id, votes) = game.current_round()
+    round_id = request.headers.get(ROUND_HEADER)
+    if round_id is not None and (int(round_id) != current_round_id or game.ended_round_id == current_round_id):
+        return {"message": f"Round {round_id} is over"}, 409
+    if not votes.record(voter, json["agree"]):
+        return {"message": "Already voted"}
+    game.log_change({"type": "vote", "player_number": voter, "agree": json["agree"]})
+    game.notify_changed()
 
     return {"message": "Ok"}
 
-@app.route("/deal-results", methods=["POST"])
+@game_route("/deal-results", methods=["POST"])
 def handle_deal_results():
+    game: state.GameSession = flask.g.game
     json: DealResultsBroadcastRequest = request.json
-    state.DEAL_RESULTS = json["who_got_what_cards"]
-    # Fetch the helper ip to inform I got the dealt cards
-    helper_ip = next(
-            node["ip"] for node in state.NODES.values() if node["player_number"] == json["helper_player_number"]
-        )
-    requests.post(f"http://{helper_ip}:6376/i-got-the-dealt-cards")
+    game.deal_results = json["who_got_what_cards"]
+    game.shuffler_player_numbers = json.get("shuffler_player_numbers", [json["helper_player_number"]])
+    game.log_change({"type": "deal", "who_got_what_cards": game.deal_results, "shuffler_player_numbers": game.shuffler_player_numbers})
+    game.notify_changed()
+    background_tasks.submit(start_verification, game)
+    # Inform all the helpers that I got the dealt cards. The helpers count me by the address of the request.
+    helpers = [game.nodes[player_number] for player_number in game.shuffler_player_numbers]
+    batcher.send(game, helpers, "/i-got-the-dealt-cards", headers=game.round_headers(), direct=True)
     return {"message": "Ok"}
 
 
-i_got_the_dealt_cards_lock = Lock()
+# Messages that a node sent within MESSAGE_BATCH_WINDOW, handled in order as if they had come one by one
+@game_route("/messages", methods=["POST"])
+def handle_messages() -> MessageBatchResponse:
+    game: state.GameSession = flask.g.game
+    json: MessageBatchRequest = request.json
+    prefix = "" if game.game_id == state.DEFAULT_GAME_ID else f"/games/{game.game_id}"
+    results = []
+    for message in json["messages"]:
+        if message["path"] not in BATCHABLE_PATHS:
+            results.append({"status": 400, "json": {"message": f"{message['path']} cannot be batched"}})
+            continue
+        # The messages of a batch passed on through the tree have come the same way as the batch
+        headers = {name: value for (name, value) in message["headers"].items() if name != overlay.OVERLAY_PATH_HEADER}
+        if overlay.OVERLAY_PATH_HEADER in request.headers:
+            headers[overlay.OVERLAY_PATH_HEADER] = request.headers[overlay.OVERLAY_PATH_HEADER]
+        environ = EnvironBuilder(
+            path=prefix + message["path"],
+            method="POST",
+            json=message["json"],
+            headers=headers,
+            environ_base={"REMOTE_ADDR": request.remote_addr, BATCHED_MESSAGE_ENVIRON: True},
+        ).get_environ()
+        started = time.perf_counter()
+        try:
+            with app.request_context(environ):
+                response = app.full_dispatch_request()
+            metrics.BATCHED_MESSAGE_SECONDS.observe(time.perf_counter() - started, message["path"], str(response.status_code))
+            results.append({"status": response.status_code, "json": response.get_json(silent=True)})
+        except Exception as e:
+            log.exception("Handling %s of a batch failed", message["path"])
+            results.append({"status": 500, "json": {"message": str(e)}})
+    return {"results": results}
+
 
 # Helper receives this when others have gotten the dealt cards
-@app.route("/i-got-the-dealt-cards", methods=["POST"])
+@game_route("/i-got-the-dealt-cards", methods=["POST"])
 def handle_i_got_the_dealt_cards():
+    game: state.GameSession = flask.g.game
     try:
-        i_got_the_dealt_cards_lock.acquire()
+        game.i_got_the_dealt_cards_lock.acquire()
         origin = request.remote_addr
-        sender_player = next(node for node in state.NODES.values() if node["ip"] == origin)
-        state.HELPER_MAP_WHO_GOT_THE_CARDS[sender_player["player_number"]] = True
+        sender_player = game.nodes.by_ip(origin)
+        if sender_player is None:
+            return {"message": "You are not part of this game"}, 400
+        game.helper_map_who_got_the_cards[sender_player.player_number] = True
         # If the majority of nodes have gotten the deck, we can pubish our encryption key to the leader
-        number_of_nodes_who_got_the_cards = len([node for node in state.HELPER_MAP_WHO_GOT_THE_CARDS.values() if node])
-        if number_of_nodes_who_got_the_cards >= len(state.NODES) / 2:
+        number_of_nodes_who_got_the_cards = len(game.helper_map_who_got_the_cards)
+        if not game.helper_key_sent and number_of_nodes_who_got_the_cards >= len(game.nodes) / 2:
             # Broadcast this to everyone so that the key can be used for verification. 
             # What is more, the leader should publish their key once they have received this
-            broadcast_helper_encryption_key()
+            game.helper_key_sent = True
+            broadcast_helper_encryption_key(game)
         return {"message": "Ok"}
     finally:
-        i_got_the_dealt_cards_lock.release()
+        game.i_got_the_dealt_cards_lock.release()
 
 
-def broadcast_helper_encryption_key():
-    for node in state.NODES.values():
-        if node["player_number"] == state.OWN_NODE_NUMBER:
-            continue
-        body: ShareKeyRequest = {"key": state.HELPER_ENCRYPTION_KEY}
-        requests.post(
-            f"http://{node['ip']}:6376/helper-key", json=body
-        )
+def broadcast_helper_encryption_key(game: state.GameSession):
+    body: ShareKeyRequest = {"key": game.helper_encryption_keys[game.own_node_number], "player_number": game.own_node_number}
+    batcher.send(game, network.peers(game), "/helper-key", json=body, headers=game.round_headers())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+"""
+Counters and latency histograms of this node, served from /metrics in the Prometheus text format.
+Recording a value takes a lock and a few additions, so the metrics are always on.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+import time
+
+# Upper bounds of the latency buckets in seconds, from a millisecond to ten seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Route label of requests to paths that no route matched, so that random paths do not create new series
+UNMATCHED_ROUTE = "unmatched"
+
+LabelValues = Tuple[str, ...]
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    def __init__(self, name: str, description: str, kind: str, label_names: Sequence[str]):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        _registry.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, "counter", label_names)
+        self.lock = Lock()
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}" for (labels, value) in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, "histogram", label_names)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        # Per label values: the count of every bucket, not cumulative, then the sum and the count of all values
+        self.series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            series[0][index] += 1
+            series[1][0] += value
+            series[1][1] += 1
+
+    def collect(self) -> List[str]:
+        with self.lock:
+            series = {labels: (list(counts), list(totals)) for (labels, (counts, totals)) in self.series.items()}
+        lines = self.header()
+        for (labels, (counts, (total, count))) in sorted(series.items()):
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    A metric whose values are kept elsewhere, e.g. in the election metrics, and read when the metrics are served.
+    """
+
+    def __init__(self, name: str, description: str, kind: str, read: Callable[[], Dict[LabelValues, float]], label_names: Sequence[str] = ()):
+        super().__init__(name, description, kind, label_names)
+        self.read = read
+
+    def collect(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}" for (labels, value) in sorted(self.read().items())
+        ]
+
+
+# All metrics in the Prometheus text format
+def render() -> str:
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "card_game_http_request_duration_seconds",
+    "Time spent handling requests, by route without the game prefix, method and status",
+    ("route", "method", "status"),
+)
+BATCHED_MESSAGE_SECONDS = Histogram(
+    "card_game_batched_message_duration_seconds",
+    "Time spent handling the messages of batches sent to /messages, by route and status",
+    ("route", "status"),
+)
+OUTBOUND_SECONDS = Histogram(
+    "card_game_outbound_request_duration_seconds",
+    "Time of requests sent to other nodes until the response arrived, by route",
+    ("route",),
+)
+OUTBOUND_REQUESTS = Counter(
+    "card_game_outbound_requests_total",
+    "Requests sent to other nodes by the address of the node, failed ones got no answer or an error status",
+    ("peer", "result"),
+)
+ROUND_PHASE_SECONDS = Histogram(
+    "card_game_round_phase_duration_seconds",
+    "Time the rounds led by this node spent in each phase of the protocol",
+    ("phase",),
+)
+FAIRNESS_VOTES = Counter(
+    "card_game_fairness_votes_total",
+    "Fairness votes this node took part in, by outcome",
+    ("outcome",),
+)
+FAIRNESS_VOTE_SECONDS = Histogram(
+    "card_game_fairness_vote_duration_seconds",
+    "Time from casting my own fairness vote until the outcome was known",
+)
+
+
+# /games/<game id>/deal-results and /deal-results are the same route
+def route_of(path: str) -> str:
+    if path.startswith("/games/"):
+        parts = path.split("/", 3)
+        return "/" + parts[3] if len(parts) > 3 else "/"
+    return path
+
+
+def record_request(method: str, path: str, status: int, seconds: float):
+    route = UNMATCHED_ROUTE if status == 404 else route_of(path)
+    REQUEST_SECONDS.observe(seconds, route, method, str(status))
+
+
+def record_outbound(peer: str, path: str, seconds: float, ok: bool):
+    OUTBOUND_SECONDS.observe(seconds, path)
+    OUTBOUND_REQUESTS.inc(peer, "ok" if ok else "failed")
+
+
+class RoundTrace:
+    """
+    Timing spans of the protocol phases of one round led by this node. Every span is also counted in ROUND_PHASE_SECONDS.
+    """
+
+    def __init__(self, round_id: int):
+        self.round_id = round_id
+        self.spans: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.spans.append((phase, seconds))
+            ROUND_PHASE_SECONDS.observe(seconds, phase)
+
+    def __repr__(self):
+        return ", ".join(f"{phase} {seconds * 1000:.1f} ms" for (phase, seconds) in self.spans)
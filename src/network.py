@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import requests
+from requests.adapters import HTTPAdapter
+
+from node_registry import PlayerRecord
+import metrics
+import node_log
+import state
+
+log = node_log.get_logger(__name__)
+
+# Port of every node of the table, the nodes know each other by address only
+PORT = int(os.environ.get("NODE_PORT", 6376))
+# Address the node listens on. When set to a specific address, requests to other nodes are sent from it too,
+# because the other nodes know a node by the address its requests come from.
+NODE_HOST = os.environ.get("NODE_HOST", "0.0.0.0")
+# Timeout for a single request to a single node
+REQUEST_TIMEOUT = 5
+# Maximum number of requests that are in flight at the same time
+MAX_PARALLEL_REQUESTS = 64
+# Number of keep-alive connections kept open to a single node
+CONNECTIONS_PER_NODE = 4
+
+
+class _SourceAddressAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        if NODE_HOST != "0.0.0.0":
+            kwargs["source_address"] = (NODE_HOST, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+
+# One shared session so that connections to the other nodes are kept alive and reused.
+# The adapter keeps a separate connection pool for every node we talk to, and room for one for every player of a full table,
+# so that the pools of a big table are not dropped and reconnected on every broadcast.
+_session = requests.Session()
+_adapter = _SourceAddressAdapter(
+    pool_connections=state.MAX_PLAYERS_PER_GAME,
+    pool_maxsize=CONNECTIONS_PER_NODE,
+    pool_block=False,
+)
+_session.mount("http://", _adapter)
+
+_executor = ThreadPoolExecutor(
+    max_workers=MAX_PARALLEL_REQUESTS, thread_name_prefix="broadcast"
+)
+
+# The asyncio runtime sends broadcasts with its own client on its event loop instead of the thread pool
+_broadcaster: Optional[Callable[..., "BroadcastResult"]] = None
+
+
+def set_broadcaster(broadcaster: Optional[Callable[..., "BroadcastResult"]]):
+    global _broadcaster
+    _broadcaster = broadcaster
+
+
+class BroadcastResult:
+    """
+    Collects the outcome of a broadcast. Responses and failures are keyed by player number.
+    Responses are requests.Response objects, or look like them when the asyncio runtime sent the broadcast.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.responses: Dict[int, requests.Response] = {}
+        self.failures: Dict[int, Exception] = {}
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failures) == 0
+
+    # Parsed JSON bodies of the successful responses
+    def json(self) -> Dict[int, Any]:
+        return {
+            player_number: response.json()
+            for (player_number, response) in self.responses.items()
+        }
+
+    def __repr__(self):
+        return f"<BroadcastResult {self.path} ok={sorted(self.responses)} failed={sorted(self.failures)}>"
+
+
+# Status code of a failed request, None if it did not get an answer
+def status_code_of(error: Exception) -> Optional[int]:
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code
+    # The asyncio runtime raises aiohttp errors
+    return getattr(error, "status", None)
+
+
+# Warns about the nodes that a message did not reach. Nodes answer 409 to messages of a round they have already ended,
+# e.g. to the fairness votes that arrive after the quorum, so those are expected and only logged for debugging.
+def log_failures(logger, action: str, result: BroadcastResult):
+    round_over = sorted(
+        player_number for (player_number, error) in result.failures.items() if status_code_of(error) == 409
+    )
+    failed = sorted(player_number for player_number in result.failures if player_number not in round_over)
+    if len(failed) > 0:
+        logger.warning(action + " failed for nodes %s", result.path, failed)
+    if len(round_over) > 0:
+        logger.debug("Nodes %s had already ended the round of %s", round_over, result.path)
+
+
+# Routes of the default game are not prefixed, so that nodes that only know one game can still talk to us
+def node_url(node: PlayerRecord, path: str, game_id: str = state.DEFAULT_GAME_ID) -> str:
+    if game_id == state.DEFAULT_GAME_ID:
+        return f"http://{node.ip}:{PORT}{path}"
+    return f"http://{node.ip}:{PORT}/games/{game_id}{path}"
+
+
+# Every request to another node is timed and counted in the metrics
+def _request(method: str, node: PlayerRecord, path: str, game_id: str, timeout: float, kwargs) -> requests.Response:
+    started = time.perf_counter()
+    ok = False
+    try:
+        response = _session.request(method, node_url(node, path, game_id), timeout=timeout, **kwargs)
+        ok = response.ok
+        return response
+    finally:
+        metrics.record_outbound(node.ip, path, time.perf_counter() - started, ok)
+
+
+def post(node: PlayerRecord, path: str, game_id: str = state.DEFAULT_GAME_ID, timeout: float = REQUEST_TIMEOUT, **kwargs) -> requests.Response:
+    return _request("POST", node, path, game_id, timeout, kwargs)
+
+
+def get(node: PlayerRecord, path: str, game_id: str = state.DEFAULT_GAME_ID, timeout: float = REQUEST_TIMEOUT, **kwargs) -> requests.Response:
+    return _request("GET", node, path, game_id, timeout, kwargs)
+
+
+def _post_and_check(node: PlayerRecord, path: str, game_id: str, timeout: float, kwargs) -> requests.Response:
+    response = post(node, path, game_id, timeout=timeout, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+# All nodes of the game except myself and the given player numbers
+def peers(game: state.GameSession, *excluded_player_numbers: int) -> List[PlayerRecord]:
+    excluded = {game.own_node_number, *excluded_player_numbers}
+    return [node for node in game.nodes.snapshot() if node.player_number not in excluded]
+
+
+# Sends the same POST to all given nodes in parallel.
+# The deadline limits how long the whole broadcast may take, nodes that have not answered by then are counted as failed.
+def broadcast(
+    nodes: Iterable[PlayerRecord],
+    path: str,
+    game_id: str = state.DEFAULT_GAME_ID,
+    timeout: float = REQUEST_TIMEOUT,
+    deadline: Optional[float] = None,
+    **kwargs,
+) -> BroadcastResult:
+    if _broadcaster is not None:
+        result = _broadcaster(nodes, path, game_id, timeout, deadline, kwargs)
+        log_failures(log, "Broadcasting %s", result)
+        return result
+
+    result = BroadcastResult(path)
+    futures = {
+        _executor.submit(_post_and_check, node, path, game_id, timeout, kwargs): node.player_number
+        for node in list(nodes)
+    }
+    if len(futures) == 0:
+        return result
+    done, not_done = wait(futures, timeout=deadline)
+    for future in done:
+        player_number = futures[future]
+        try:
+            result.responses[player_number] = future.result()
+        except Exception as e:
+            result.failures[player_number] = e
+    for future in not_done:
+        future.cancel()
+        result.failures[futures[future]] = TimeoutError(
+            f"No response before the broadcast deadline of {deadline}s"
+        )
+    log_failures(log, "Broadcasting %s", result)
+    return result
@@ -0,0 +1,61 @@
+"""
+Logging of the node. Handlers put their records on a queue and one background thread writes them to stdout,
+so that no request waits for the terminal. Records below LOG_LEVEL are dropped before they are formatted.
+"""
+from typing import Any, Dict
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# DEBUG shows every message the node receives, INFO the progress of the game, WARNING only what went wrong
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Fraction of the requests written to the request log, all of them at DEBUG
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", 0))
+
+_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_listener = logging.handlers.QueueListener(_queue, logging.StreamHandler(sys.stdout))
+
+
+def _setup():
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    handler = logging.handlers.QueueHandler(_queue)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(handler)
+    # The Flask development server and aiohttp would log every request, the middleware has a request log of its own
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    _listener.start()
+    # Writes what is still on the queue when the node exits
+    atexit.register(_listener.stop)
+
+
+_setup()
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+_request_log = get_logger("requests")
+_log_every_request = _request_log.isEnabledFor(logging.DEBUG)
+
+
+# Decided once per request, costs a comparison when the request log is off
+def request_sampled() -> bool:
+    return _log_every_request or (REQUEST_LOG_SAMPLE_RATE > 0 and random.random() < REQUEST_LOG_SAMPLE_RATE)
+
+
+def log_request(environ: Dict[str, Any], status: int, seconds: float):
+    _request_log.info(
+        "%s %s %s in %.1f ms from %s",
+        environ["REQUEST_METHOD"],
+        environ.get("PATH_INFO", ""),
+        status,
+        seconds * 1000,
+        environ.get("REMOTE_ADDR"),
+    )
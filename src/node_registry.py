@@ -0,0 +1,154 @@
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from classes import Player
+
+
+class PlayerRecord:
+    """
+    A node of the game. Serialized as the Player JSON object.
+    """
+
+    __slots__ = ("player_number", "ip", "score")
+
+    def __init__(self, player_number: int, ip: str, score: int = 0):
+        self.player_number = player_number
+        self.ip = ip
+        self.score = score
+
+    def to_json(self) -> Player:
+        return Player(player_number=self.player_number, ip=self.ip, score=self.score)
+
+    @staticmethod
+    def from_json(player: Player) -> "PlayerRecord":
+        return PlayerRecord(int(player["player_number"]), player["ip"], player.get("score", 0))
+
+    def __repr__(self):
+        return f"Player(#{self.player_number}, {self.ip}, score={self.score})"
+
+
+class NodeRegistry:
+    """
+    The nodes of a game, indexed by player number and by ip.
+    Changes replace an immutable snapshot, so readers and broadcasts never see a half updated list.
+    Every change bumps the version, and the changes since the last take_delta are remembered so that
+    they can be sent to the other nodes instead of the whole list.
+    """
+
+    def __init__(self, players: Iterable[PlayerRecord] = ()):
+        self._lock = Lock()
+        self.version = 0
+        self._delta_from_version = 0
+        self._joined: List[PlayerRecord] = []
+        self._left: List[int] = []
+        self._set_players({player.player_number: player for player in players})
+
+    # Caller must hold the lock, or be the constructor
+    def _set_players(self, by_number: Dict[int, PlayerRecord]):
+        snapshot = tuple(by_number[player_number] for player_number in sorted(by_number))
+        self._by_number = by_number
+        self._by_ip = {player.ip: player for player in snapshot}
+        self._snapshot = snapshot
+        self._json: Optional[Dict[str, Player]] = None
+
+    def add(self, player: PlayerRecord):
+        with self._lock:
+            by_number = dict(self._by_number)
+            by_number[player.player_number] = player
+            self._set_players(by_number)
+            self.version += 1
+            self._joined.append(player)
+
+    def remove(self, player_number: int) -> Optional[PlayerRecord]:
+        with self._lock:
+            by_number = dict(self._by_number)
+            player = by_number.pop(player_number, None)
+            if player is None:
+                return None
+            self._set_players(by_number)
+            self.version += 1
+            self._left.append(player_number)
+            return player
+
+    # Replaces the whole list, e.g. with a snapshot from the leader. Forgets the changes not taken yet.
+    def replace_all(self, players: Iterable[PlayerRecord], version: int = 0):
+        with self._lock:
+            self._set_players({player.player_number: player for player in players})
+            self.version = version
+            self._delta_from_version = version
+            self._joined = []
+            self._left = []
+
+    # The changes since the previous call as (from_version, to_version, joined, left), None if nothing changed
+    def take_delta(self) -> Optional[Tuple[int, int, List[PlayerRecord], List[int]]]:
+        with self._lock:
+            if self.version == self._delta_from_version:
+                return None
+            delta = (self._delta_from_version, self.version, self._joined, self._left)
+            self._delta_from_version = self.version
+            self._joined = []
+            self._left = []
+            return delta
+
+    # Applies changes another node took with take_delta. Returns False if changes before from_version are missing.
+    # Deltas that overlap with what we already have are fine, adding and removing the same players again changes nothing.
+    def apply_delta(self, from_version: int, to_version: int, joined: Iterable[PlayerRecord], left: Iterable[int]) -> bool:
+        with self._lock:
+            if to_version <= self.version:
+                # Already seen
+                return True
+            if from_version > self.version:
+                return False
+            by_number = dict(self._by_number)
+            for player in joined:
+                by_number[player.player_number] = player
+            for player_number in left:
+                by_number.pop(player_number, None)
+            self._set_players(by_number)
+            self.version = to_version
+            self._delta_from_version = to_version
+            return True
+
+    # All players sorted by player number. The tuple never changes, so it is safe to broadcast to.
+    def snapshot(self) -> Tuple[PlayerRecord, ...]:
+        return self._snapshot
+
+    def values(self) -> Tuple[PlayerRecord, ...]:
+        return self._snapshot
+
+    def numbers(self) -> Tuple[int, ...]:
+        return tuple(player.player_number for player in self._snapshot)
+
+    def by_ip(self, ip: str) -> Optional[PlayerRecord]:
+        return self._by_ip.get(ip)
+
+    def get(self, player_number: int) -> Optional[PlayerRecord]:
+        return self._by_number.get(player_number)
+
+    def __getitem__(self, player_number: int) -> PlayerRecord:
+        return self._by_number[player_number]
+
+    def __contains__(self, player_number: int) -> bool:
+        return player_number in self._by_number
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
+
+    def __iter__(self) -> Iterator[PlayerRecord]:
+        return iter(self._snapshot)
+
+    # JSON object keyed by player number, built once per change
+    def to_json(self) -> Dict[str, Player]:
+        serialized = self._json
+        if serialized is None:
+            serialized = {str(player.player_number): player.to_json() for player in self._snapshot}
+            self._json = serialized
+        return serialized
+
+    # The JSON object together with its version, so that a snapshot sent to another node matches the version
+    def versioned_json(self) -> Tuple[int, Dict[str, Player]]:
+        with self._lock:
+            return self.version, self.to_json()
+
+    def __repr__(self):
+        return repr(list(self._snapshot))
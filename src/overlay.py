@@ -0,0 +1,165 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import json as json_module
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from node_registry import PlayerRecord
+import network
+import node_log
+import state
+
+log = node_log.get_logger(__name__)
+
+# "direct" sends a message from the sender to every node,
+# "tree" sends it along a spanning tree where every node passes it on to at most TREE_FANOUT others
+DISSEMINATION_MODE = os.environ.get("DISSEMINATION_MODE", "direct")
+TREE_FANOUT = int(os.environ.get("TREE_FANOUT", 4))
+# Player numbers of the nodes the receiver has to pass the message on to, in tree order
+OVERLAY_SUBTREE_HEADER = "X-Overlay-Subtree"
+# Player numbers of the nodes the message has passed through, from the node that sent it to the one that passed it on last
+OVERLAY_PATH_HEADER = "X-Overlay-Path"
+
+_forwarders = ThreadPoolExecutor(max_workers=network.MAX_PARALLEL_REQUESTS, thread_name_prefix="overlay")
+
+
+# Splits the nodes below a node of the tree among its children.
+# Returns the children with the nodes below them, the tree is about log(n) / log(fanout) levels deep.
+def split_subtree(player_numbers: Sequence[int], fanout: int = TREE_FANOUT) -> List[Tuple[int, List[int]]]:
+    size = len(player_numbers)
+    number_of_children = min(fanout, size)
+    children = []
+    for i in range(number_of_children):
+        chunk = player_numbers[i * size // number_of_children:(i + 1) * size // number_of_children]
+        children.append((chunk[0], list(chunk[1:])))
+    return children
+
+
+def _send_to_child(game: state.GameSession, child: int, subtree: List[int], path: str, body: bytes, content_type: str, headers: Dict[str, str]):
+    node = game.nodes.get(child)
+    if node is None:
+        raise LookupError(f"Player {child} is not in the game")
+    response = network.post(
+        node,
+        path,
+        game.game_id,
+        data=body,
+        headers={
+            **headers,
+            "Content-Type": content_type,
+            OVERLAY_SUBTREE_HEADER: ",".join(str(player_number) for player_number in subtree),
+        },
+    )
+    response.raise_for_status()
+    return response
+
+
+# Sends the message to the children of this node. The subtree of a child that did not get it is served by this node instead.
+# The headers, e.g. the round of the message, are passed on with it.
+def send_to_subtree(
+    game: state.GameSession,
+    player_numbers: Sequence[int],
+    path: str,
+    body: bytes,
+    content_type: str,
+    headers: Optional[Dict[str, str]] = None,
+) -> network.BroadcastResult:
+    headers = headers or {}
+    result = network.BroadcastResult(path)
+    futures = {
+        _forwarders.submit(_send_to_child, game, child, subtree, path, body, content_type, headers): (child, subtree)
+        for (child, subtree) in split_subtree(player_numbers)
+    }
+    wait(futures)
+    orphaned_subtrees = []
+    for (future, (child, subtree)) in futures.items():
+        try:
+            result.responses[child] = future.result()
+        except Exception as e:
+            result.failures[child] = e
+            # A child that has ended the round of the message has still passed it on
+            if network.status_code_of(e) != 409:
+                orphaned_subtrees.append(subtree)
+    for subtree in orphaned_subtrees:
+        if len(subtree) > 0:
+            log.info("Sending %s to the nodes below a failed node myself", path)
+            fallback = send_to_subtree(game, subtree, path, body, content_type, headers)
+            result.responses.update(fallback.responses)
+            result.failures.update(fallback.failures)
+    return result
+
+
+# Sends the same POST to all given nodes, directly or through the overlay depending on DISSEMINATION_MODE.
+# In the overlay only the children of the sender answer, the others answer to the node that passed the message on.
+def disseminate(
+    game: state.GameSession,
+    nodes: Iterable[PlayerRecord],
+    path: str,
+    json: Any = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> network.BroadcastResult:
+    nodes = list(nodes)
+    if DISSEMINATION_MODE != "tree" or len(nodes) <= TREE_FANOUT:
+        return network.broadcast(nodes, path, game.game_id, json=json, headers=headers)
+    player_numbers = sorted(node.player_number for node in nodes)
+    body = json_module.dumps(json).encode()
+    headers = {**(headers or {}), OVERLAY_PATH_HEADER: str(game.own_node_number)}
+    result = send_to_subtree(game, player_numbers, path, body, "application/json", headers)
+    network.log_failures(log, "Disseminating %s", result)
+    return result
+
+
+# Called by a node of the tree when it receives a message with a subtree
+def forward(
+    game: state.GameSession,
+    subtree_header: str,
+    path: str,
+    body: bytes,
+    content_type: Optional[str],
+    headers: Optional[Dict[str, str]] = None,
+):
+    subtree = [int(player_number) for player_number in subtree_header.split(",") if player_number]
+    if len(subtree) > 0:
+        send_to_subtree(game, subtree, path, body, content_type or "application/json", headers)
+
+
+# The path to send on with a message this node passes on
+def extend_path(game: state.GameSession, path_header: Optional[str]) -> str:
+    return f"{path_header},{game.own_node_number}" if path_header else str(game.own_node_number)
+
+
+# The nodes above a node in the tree that a message of root is disseminated along, nearest first.
+# Empty if the node is not in the tree.
+def ancestors(root: int, player_numbers: Iterable[int], player_number: int) -> List[int]:
+    chain = [root]
+    subtree = sorted(number for number in player_numbers if number != root)
+    while len(subtree) > 0:
+        for (child, below) in split_subtree(subtree, TREE_FANOUT):
+            if child == player_number:
+                return list(reversed(chain))
+            if player_number in below:
+                chain.append(child)
+                subtree = below
+                break
+        else:
+            break
+    return []
+
+
+# The node that sent a message. In tree mode a message passed on through the tree counts for the first node of its path,
+# if the node the request came from is the last one and is above this node in the tree of the first one:
+# its parent, or a node further up that took over the subtree of a failed parent.
+# Otherwise the message counts for the node the request came from. None if that node is not part of the game.
+def message_sender(game: state.GameSession, remote_addr: Optional[str], path_header: Optional[str]) -> Optional[PlayerRecord]:
+    sender = game.nodes.by_ip(remote_addr) if remote_addr is not None else None
+    if sender is None or not path_header or DISSEMINATION_MODE != "tree":
+        return sender
+    try:
+        hops = [int(player_number) for player_number in path_header.split(",")]
+    except ValueError:
+        return sender
+    origin = game.nodes.get(hops[0])
+    if origin is None or hops[-1] != sender.player_number:
+        return sender
+    if sender.player_number != origin.player_number and sender.player_number not in ancestors(origin.player_number, game.nodes.numbers(), game.own_node_number):
+        return sender
+    return origin
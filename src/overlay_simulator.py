@@ -0,0 +1,78 @@
+"""
+Simulates sending one message to every node of a table, directly from the sender and through the overlay tree.
+Reports how many messages are sent, the largest fan-out of a single node and when the last node has the message.
+
+Run with e.g. `python overlay_simulator.py 10 100 1000`.
+"""
+import heapq
+import random
+import sys
+from typing import Dict, List, Tuple
+
+from overlay import TREE_FANOUT, split_subtree
+
+# Time a node spends putting one message on the wire, its sends go out one after another
+SEND_MS = 0.3
+# One way network latency between two nodes, each message gets a random latency in this range
+LATENCY_MS = (1.0, 3.0)
+# Time a node takes to read the subtree header before it starts passing the message on
+FORWARD_MS = 0.1
+DEFAULT_NODE_COUNTS = [10, 100, 1000]
+
+
+class SimulationResult:
+    def __init__(self, mode: str, nodes: int):
+        self.mode = mode
+        self.nodes = nodes
+        self.messages = 0
+        self.max_fanout = 0
+        self.received_at: Dict[int, float] = {}
+
+    @property
+    def completion_ms(self) -> float:
+        return max(self.received_at.values())
+
+    def __str__(self):
+        return (
+            f"{self.mode:>6} {self.nodes:>6} nodes: {self.messages:>6} messages, "
+            f"max fan-out {self.max_fanout:>5}, last node after {self.completion_ms:8.1f} ms"
+        )
+
+
+# Events are messages arriving at a node as (time, node, subtree). The original sender is node 0 and starts at time 0.
+def _run(mode: str, nodes: int, fanout: int, rng: random.Random) -> SimulationResult:
+    result = SimulationResult(mode, nodes)
+    receivers = list(range(1, nodes))
+    events: List[Tuple[float, int, List[int]]] = []
+
+    def send(now: float, children: List[Tuple[int, List[int]]]):
+        result.max_fanout = max(result.max_fanout, len(children))
+        for (i, (child, subtree)) in enumerate(children):
+            result.messages += 1
+            departs = now + (i + 1) * SEND_MS
+            heapq.heappush(events, (departs + rng.uniform(*LATENCY_MS), child, subtree))
+
+    result.received_at[0] = 0.0
+    if mode == "direct":
+        send(0.0, [(receiver, []) for receiver in receivers])
+    else:
+        send(0.0, split_subtree(receivers, fanout))
+    while events:
+        (arrived, node, subtree) = heapq.heappop(events)
+        result.received_at[node] = arrived
+        if len(subtree) > 0:
+            send(arrived + FORWARD_MS, split_subtree(subtree, fanout))
+    assert len(result.received_at) == nodes
+    return result
+
+
+def simulate(nodes: int, fanout: int = TREE_FANOUT, seed: int = 0) -> List[SimulationResult]:
+    return [_run(mode, nodes, fanout, random.Random(seed)) for mode in ("direct", "tree")]
+
+
+if __name__ == "__main__":
+    node_counts = [int(argument) for argument in sys.argv[1:]] or DEFAULT_NODE_COUNTS
+    print(f"Send {SEND_MS} ms per message, latency {LATENCY_MS[0]}-{LATENCY_MS[1]} ms, tree fan-out {TREE_FANOUT}")
+    for node_count in node_counts:
+        for result in simulate(node_count):
+            print(result)
@@ -0,0 +1,61 @@
+"""
+Plays rounds on local tables in settings that have broken before, and fails if a round does not reach its winner in time.
+
+Every run starts a LocalCluster (Linux) with the settings of the run, lets the nodes join the first one and
+has the leader play a few rounds. Run all of them with `python regression_harness.py`, or some of them by name,
+e.g. `python regression_harness.py tree-shufflers`.
+"""
+from typing import Dict, List, NamedTuple
+import sys
+
+from cluster import LocalCluster
+
+ROUNDS = 3
+# A round that waits for a missing message runs into the 30 s timeouts of the leader
+ROUND_TIME_LIMIT = 10
+
+
+class Run(NamedTuple):
+    name: str
+    number_of_nodes: int
+    environment: Dict[str, str]
+
+
+RUNS = [
+    # The acknowledgements of the dealt cards must reach the helpers from the nodes themselves, not through the tree
+    Run("tree-shufflers", 6, {"DISSEMINATION_MODE": "tree", "TREE_FANOUT": "2", "SHUFFLE_STAGES": "3"}),
+]
+
+
+# Returns the problems of the run, nothing if every round reached its winner in time
+def play(run: Run) -> List[str]:
+    problems = []
+    with LocalCluster(run.number_of_nodes, run.environment) as cluster:
+        cluster.join_all()
+        for round_number in range(1, ROUNDS + 1):
+            timings = cluster.play_round()
+            phases = timings.phases()
+            print(f"{run.name}, round {round_number}: {phases}")
+            if timings.winner_known is None:
+                problems.append(f"round {round_number} ended without a winner")
+            elif phases["total"] is not None and phases["total"] > ROUND_TIME_LIMIT:
+                problems.append(f"round {round_number} took {phases['total']:.1f} s")
+    return problems
+
+
+def main(names: List[str]) -> int:
+    failed = 0
+    for run in RUNS:
+        if len(names) > 0 and run.name not in names:
+            continue
+        problems = play(run)
+        if len(problems) > 0:
+            failed += 1
+            print(f"FAILED {run.name}: {'; '.join(problems)}")
+        else:
+            print(f"ok {run.name}")
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,59 +1,140 @@
+from typing import Optional
 import time
-import requests
-from classes import ReverseBullyElectionResponse
+
+from classes import NewLeaderRequest, ReverseBullyElectionRequest
 import state
+import metrics
+import network
+import node_log
+
+log = node_log.get_logger(__name__)
+
+# How long a whole election may take, from the first election message until the new leader is known, in seconds
+ELECTION_TIMEOUT = 10
+# How long the election messages may take, and the victory announcement too
+ELECTION_MESSAGE_TIMEOUT = 2
+
+
+class ElectionMetrics:
+    """
+    How long the elections this node was a candidate in took, from starting until the new leader was known.
+    """
+
+    __slots__ = ("won", "lost", "timed_out", "total_seconds", "max_seconds", "last_seconds")
+
+    def __init__(self):
+        self.won = 0
+        self.lost = 0
+        self.timed_out = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    @property
+    def elections(self) -> int:
+        return self.won + self.lost + self.timed_out
 
-# Bully algorithm, but prefers small numbers
-def reverse_bully():
-    print("Starting reverse bully election.")
-    state.LEADER_ELECTION_ONGOING = True
-    victory = reverse_bully_send_election_messages()
-    if victory:
-        print("I won the election. I am the new leader.")
-        state.LEADER_NODE_NUMBER = state.OWN_NODE_NUMBER
-        announce_election_victory()
-    while state.LEADER_ELECTION_ONGOING:
-        # Fine to sleep since we're in UI thread and the http server is running on a different thread.
-        time.sleep(0.1)
+    def record(self, outcome: str, seconds: float):
+        if outcome == "won":
+            self.won += 1
+        elif outcome == "lost":
+            self.lost += 1
+        else:
+            self.timed_out += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.last_seconds = seconds
+
+    def __repr__(self):
+        mean = self.total_seconds / self.elections if self.elections > 0 else 0.0
+        return (
+            f"{self.elections} elections ({self.won} won, {self.lost} lost, {self.timed_out} timed out), "
+            f"mean {mean * 1000:.0f} ms, max {self.max_seconds * 1000:.0f} ms, last {self.last_seconds * 1000:.0f} ms"
+        )
+
+
+election_metrics = ElectionMetrics()
+
+metrics.CallbackMetric(
+    "card_game_elections_total",
+    "Elections this node was a candidate in, by outcome",
+    "counter",
+    lambda: {("won",): election_metrics.won, ("lost",): election_metrics.lost, ("timed_out",): election_metrics.timed_out},
+    ("outcome",),
+)
+metrics.CallbackMetric(
+    "card_game_election_seconds_total",
+    "Time spent in the elections this node was a candidate in",
+    "counter",
+    lambda: {(): election_metrics.total_seconds},
+)
+metrics.CallbackMetric(
+    "card_game_election_seconds_max",
+    "Longest election this node was a candidate in",
+    "gauge",
+    lambda: {(): election_metrics.max_seconds},
+)
+
+
+# Bully algorithm, but prefers small numbers.
+# Every election has a term, a node is a candidate at most once per term and ignores leaders of older terms.
+def reverse_bully(game: state.GameSession, term: Optional[int] = None):
+    if term is None:
+        term = game.election_term + 1
+    if not game.begin_election(term):
+        return
+    started = time.time()
+    log.info("Starting reverse bully election of term %s.", term)
+    victory = reverse_bully_send_election_messages(game, term)
+    if victory and game.accept_leader(game.own_node_number, term):
+        log.info("I won the election. I am the new leader.")
+        game.start_membership_epoch()
+        announce_election_victory(game, term)
+        election_metrics.record("won", time.time() - started)
+        return
+    # The /new-leader handler wakes us up.
+    remaining = started + ELECTION_TIMEOUT - time.time()
+    if game.wait_until(lambda: not game.leader_election_ongoing, max(remaining, 0)):
+        election_metrics.record("lost", time.time() - started)
+        log.info("Node %s is the new leader.", game.leader_node_number)
+        return
+    log.warning("No new leader was announced before the election timed out.")
+    with game.election_lock:
+        if game.candidate_term == term:
+            game.leader_election_ongoing = False
+    game.notify_changed()
+    election_metrics.record("timed_out", time.time() - started)
 
 
 # Returns true if nobody wants to take over the election, false otherwise
-def reverse_bully_send_election_messages() -> bool:
-    print(
-        f"Sending election messages to nodes that have number smaller than {state.OWN_NODE_NUMBER}."
+def reverse_bully_send_election_messages(game: state.GameSession, term: int) -> bool:
+    log.debug("Sending election messages to nodes that have number smaller than %s.", game.own_node_number)
+    nodes_to_receive_eletion_msg = [node for node in game.nodes.snapshot() if node.player_number < game.own_node_number]
+    body: ReverseBullyElectionRequest = {"term": term}
+    result = network.broadcast(
+        nodes_to_receive_eletion_msg,
+        "/election",
+        game.game_id,
+        timeout=ELECTION_MESSAGE_TIMEOUT,
+        deadline=ELECTION_MESSAGE_TIMEOUT,
+        json=body,
     )
-    nodes_to_receive_eletion_msg = [node for node in state.NODES.values() if node["player_number"] < state.OWN_NODE_NUMBER]
-    for node in nodes_to_receive_eletion_msg:
-        print(f"Sending election message to {node['player_number']}")
-        try:
-            response: ReverseBullyElectionResponse = requests.post(
-                f"http://{node['ip']}:6376/election", timeout=5
-            ).json()
-            if response["taking_over"]:
-                print(
-                    f"Node {node['player_number']} answered and taking over election."
-                )
-                return False
-            else:
-                print(
-                    f"Node {node['player_number']} answered and did not take over election."
-                )
-        except:
-            print("Timed out waiting for response from node:", node["player_number"])
+    taking_over = [player_number for (player_number, response) in result.json().items() if response["taking_over"]]
+    if len(taking_over) > 0:
+        log.info("Nodes %s answered and are taking over the election.", sorted(taking_over))
+        return False
     return True
 
 
-def announce_election_victory():
-    print("Announcing election victory.")
-    for node in state.NODES.values():
-        try:
-            if node["player_number"] == state.OWN_NODE_NUMBER:
-                continue
-            print("Announcing victory to node:", node["player_number"])
-            requests.post(f"http://{node['ip']}:6376/new-leader", timeout=5)
-            print("Announced victory to node:", node["player_number"])
-        except:
-            print(
-                "Timed out waiting acknowledgement for election victory announcement:",
-                node["player_number"],
-            )
+def announce_election_victory(game: state.GameSession, term: int):
+    log.debug("Announcing election victory.")
+    body: NewLeaderRequest = {"term": term, "leader_node_number": game.own_node_number}
+    result = network.broadcast(
+        network.peers(game),
+        "/new-leader",
+        game.game_id,
+        timeout=ELECTION_MESSAGE_TIMEOUT,
+        deadline=ELECTION_MESSAGE_TIMEOUT,
+        json=body,
+    )
+    log.info("Announced victory to nodes %s", sorted(result.responses))
@@ -1,46 +1,501 @@
-from typing import Optional, Dict, DefaultDict
-
-from classes import Deck, GamePhase, Player
-
-# The distributed state of NODE
-# First node is player 1
-NEXT_PLAYER_NUMBER = 1
-LEADER_NODE_NUMBER = 1
-OWN_NODE_NUMBER = -1
-NODES: Dict[int, Player] = {}
-LEADER_ELECTION_ONGOING = False
-GAME_PHASE = GamePhase.WAITING_FOR_PLAYERS
-ENCRYPTION_KEY: Optional[str] = None
-HELPER_ENCRYPTION_KEY: Optional[str] = None
-DECK: Optional[Deck] = None
-DOUBLE_ENCRYPTED_DECK: Optional[Deck] = None
-DEAL_RESULTS:  Optional[Dict[int, str]] = None
-WINNER_NUMBER: Optional[int] = None
-HELPER_MAP_WHO_GOT_THE_CARDS: Dict[int, bool] = DefaultDict(bool)
-NUMBER_OF_NODES_THAT_AGREE_WITH_THE_RESULT = 0
-NUMBER_OF_NODES_THAT_DISAGREE_WITH_THE_RESULT = 0
-# End global state for NODE
-
-def empty_game_states():
-    global ENCRYPTION_KEY
-    global HELPER_ENCRYPTION_KEY
-    global WINNER_NUMBER
-    global DECK
-    global DOUBLE_ENCRYPTED_DECK
-    global DEAL_RESULTS
-    global HELPER_MAP_WHO_GOT_THE_CARDS
-    global NUMBER_OF_NODES_THAT_AGREE_WITH_THE_RESULT
-    global NUMBER_OF_NODES_THAT_DISAGREE_WITH_THE_RESULT
-    global GAME_PHASE
-
-    print("Emptying game state for next game.")
-    GAME_PHASE = GamePhase.WAITING_FOR_PLAYERS
-    ENCRYPTION_KEY = None
-    HELPER_ENCRYPTION_KEY = None
-    DECK = None
-    DOUBLE_ENCRYPTED_DECK = None
-    DEAL_RESULTS = None
-    WINNER_NUMBER = None
-    HELPER_MAP_WHO_GOT_THE_CARDS = DefaultDict(bool)
-    NUMBER_OF_NODES_THAT_AGREE_WITH_THE_RESULT = 0
-    NUMBER_OF_NODES_THAT_DISAGREE_WITH_THE_RESULT = 0
\ No newline at end of file
+from collections import OrderedDict
+from threading import Condition, Lock
+from typing import Any, Callable, Iterable, List, Optional, Dict, DefaultDict, Set, Tuple
+import base64
+import os
+import time
+
+from admission import JoinAdmissions
+from classes import ROUND_HEADER, Deck, GamePhase, Player
+from deck_pool import DeckPool, Membership, PooledShuffles
+from game_snapshot import GameStateSnapshot, build_snapshot
+import game_log
+from lobby import Lobby
+import node_log
+from node_registry import NodeRegistry, PlayerRecord
+from verification import IncrementalVerifier
+from voting import VoteTracker
+
+log = node_log.get_logger(__name__)
+
+# Game used by nodes and routes that do not name a game
+DEFAULT_GAME_ID = "default"
+# Upper bounds for the memory used by game sessions
+MAX_GAME_SESSIONS = int(os.environ.get("MAX_GAME_SESSIONS", 10000))
+MAX_PLAYERS_PER_GAME = int(os.environ.get("MAX_PLAYERS_PER_GAME", 1000))
+# Sessions of games this node is no longer part of are evicted after being idle for this many seconds,
+# sessions without any players already after EMPTY_SESSION_TIMEOUT. Games the node is in are never evicted.
+IDLE_SESSION_TIMEOUT = 60 * 60
+EMPTY_SESSION_TIMEOUT = 60
+
+
+class TooManySessions(RuntimeError):
+    """
+    The node already has MAX_GAME_SESSIONS games and none of them can be evicted.
+    """
+
+
+class GameSession:
+    """
+    The distributed state of one game table, as seen by this node. A node can take part in many tables at once.
+    """
+
+    __slots__ = (
+        "game_id",
+        "next_player_number",
+        "leader_node_number",
+        "own_node_number",
+        "nodes",
+        "membership_epoch",
+        "membership_lock",
+        "membership_delta_scheduled",
+        "membership_broadcast_lock",
+        "leader_election_ongoing",
+        "election_term",
+        "candidate_term",
+        "leader_term",
+        "election_lock",
+        "round_id",
+        "ended_round_id",
+        "round_lock",
+        "deck_pool",
+        "pooled_shuffles",
+        "game_phase",
+        "encryption_key",
+        "helper_encryption_keys",
+        "shuffler_player_numbers",
+        "deck",
+        "double_encrypted_deck",
+        "deal_results",
+        "winner_number",
+        "helper_map_who_got_the_cards",
+        "helper_key_sent",
+        "verifier",
+        "votes",
+        "registration_lock",
+        "admissions",
+        "lobby",
+        "i_got_the_dealt_cards_lock",
+        "changed",
+        "state_version",
+        "state_watchers",
+        "snapshot_lock",
+        "snapshot_cache",
+        "started_ns",
+        "last_active",
+        "log",
+    )
+
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        # First node is player 1
+        self.next_player_number = 1
+        self.leader_node_number = 1
+        self.own_node_number = -1
+        self.nodes = NodeRegistry()
+        # Membership deltas are only applied when they come from the same epoch
+        self.membership_epoch = 0
+        self.membership_lock = Lock()
+        self.membership_delta_scheduled = False
+        # Deltas are broadcast one at a time so that every node gets them in order
+        self.membership_broadcast_lock = Lock()
+        self.leader_election_ongoing = False
+        # Highest election term I have seen, the last term I have been a candidate in and the term of the current leader
+        self.election_term = 0
+        self.candidate_term = 0
+        self.leader_term = 0
+        self.election_lock = Lock()
+        # have to prevent that two nodes don't join with the same player number
+        self.registration_lock = Lock()
+        # Joins get their player numbers under the lock, the membership update is sent once per batch of joins
+        self.admissions = JoinAdmissions()
+        # Tables of the game when it is a lobby
+        self.lobby = Lobby()
+        self.i_got_the_dealt_cards_lock = Lock()
+        # Notified whenever a handler changes the game, so that nobody has to poll
+        self.changed = Condition()
+        # Counts the changes, spectators get a new snapshot of the game when it changes
+        self.state_version = 0
+        self.state_watchers: Set[Callable[[], None]] = set()
+        self.snapshot_lock = Lock()
+        self.snapshot_cache: Optional[GameStateSnapshot] = None
+        self.started_ns = time.time_ns()
+        self.last_active = time.time()
+        # Every round of the game has its own id, the state below belongs to the current round
+        self.round_id = 0
+        # Late messages of a round that has ended are refused like those of earlier rounds
+        self.ended_round_id = 0
+        self.round_lock = Lock()
+        # Decks shuffled ahead of the rounds, as the leader and as a helper
+        self.deck_pool = DeckPool()
+        self.pooled_shuffles = PooledShuffles()
+        self._reset_game()
+        # None when the game log is off
+        self.log = game_log.open_log(game_id, self.to_snapshot)
+
+    # Makes me a candidate of the term, unless I already am, the term already has a leader or a later term has started.
+    # Returns whether I became one.
+    def begin_election(self, term: int) -> bool:
+        with self.election_lock:
+            if term < self.election_term or term <= self.candidate_term or term <= self.leader_term:
+                return False
+            self.election_term = term
+            self.candidate_term = term
+            self.leader_election_ongoing = True
+        self.notify_changed()
+        return True
+
+    # Accepts a leader announced in the given term, unless a later term has started. Returns whether it was accepted.
+    def accept_leader(self, leader_node_number: int, term: int) -> bool:
+        with self.election_lock:
+            if term < self.election_term:
+                return False
+            self.election_term = term
+            self.leader_term = term
+            self.leader_node_number = leader_node_number
+            self.leader_election_ongoing = False
+        self.log_roles()
+        self.notify_changed()
+        return True
+
+    # Changes whenever a player joins or leaves, or another node starts managing the membership
+    def membership_stamp(self) -> Membership:
+        return (self.membership_epoch, self.nodes.version)
+
+    # Called when this node starts managing the membership, so that the others resync with it
+    def start_membership_epoch(self):
+        self.membership_epoch = time.time_ns()
+        self.log_membership()
+
+    # Takes over the node list of the node that manages the membership, unless we already have a newer one
+    def adopt_node_list(self, nodes: Dict[str, Player], epoch: int, version: int):
+        with self.membership_lock:
+            if epoch == self.membership_epoch and version <= self.nodes.version:
+                return
+            self.nodes.replace_all((PlayerRecord.from_json(player) for player in nodes.values()), version)
+            self.membership_epoch = epoch
+        self.log_node_list()
+        self.notify_changed()
+
+    # Round ids come from the clock like membership epochs, so that a new leader does not reuse the ids of the old one
+    def next_round_id(self) -> int:
+        return max(self.round_id + 1, time.time_ns())
+
+    # Starts the given round with an empty game state, unless it is older than the current one.
+    # Returns False for older rounds, their messages must be ignored.
+    def enter_round(self, round_id: int) -> bool:
+        with self.round_lock:
+            if round_id < self.round_id or round_id <= self.ended_round_id:
+                return False
+            if round_id == self.round_id:
+                return True
+            self.round_id = round_id
+            self._reset_game()
+        self.log_change({"type": "round", "round_id": round_id})
+        self.notify_changed()
+        return True
+
+    # Empties the game state after the round, unless the next round has already started
+    def end_round(self, round_id: int):
+        with self.round_lock:
+            if round_id != self.round_id:
+                return
+            log.debug("Emptying game state of game %s for next game.", self.game_id)
+            self.ended_round_id = round_id
+            self._reset_game()
+        self.log_change({"type": "round_end", "round_id": round_id})
+        self.notify_changed()
+
+    # The id and the fairness votes of the current round, read together so that a new round cannot start in between
+    def current_round(self) -> Tuple[int, VoteTracker]:
+        with self.round_lock:
+            return (self.round_id, self.votes)
+
+    # Sent with every message of the current round
+    def round_headers(self) -> Dict[str, str]:
+        return {ROUND_HEADER: str(self.round_id)}
+
+    # Wakes up everyone waiting in wait_until or watching the state
+    def notify_changed(self):
+        with self.changed:
+            self.state_version += 1
+            self.changed.notify_all()
+            for watcher in self.state_watchers:
+                watcher()
+
+    # The watcher is called on every change, from the thread that made it
+    def add_state_watcher(self, watcher: Callable[[], None]):
+        with self.changed:
+            self.state_watchers.add(watcher)
+
+    def remove_state_watcher(self, watcher: Callable[[], None]):
+        with self.changed:
+            self.state_watchers.discard(watcher)
+
+    # Read-only view of the game, built at most once per change and shared by all readers
+    def state_snapshot(self) -> GameStateSnapshot:
+        snapshot = self.snapshot_cache
+        if snapshot is not None and snapshot.version == self.state_version:
+            return snapshot
+        with self.snapshot_lock:
+            version = self.state_version
+            snapshot = self.snapshot_cache
+            if snapshot is None or snapshot.version != version:
+                snapshot = build_snapshot(self, version, f"{self.started_ns:x}-{version}")
+                self.snapshot_cache = snapshot
+            return snapshot
+
+    # Blocks until the predicate is true or the timeout expires. Returns the last result of the predicate.
+    def wait_until(self, predicate: Callable[[], bool], timeout: Optional[float]) -> bool:
+        with self.changed:
+            return self.changed.wait_for(predicate, timeout)
+
+    def _reset_game(self):
+        self.game_phase = GamePhase.WAITING_FOR_PLAYERS
+        self.encryption_key: Optional[str] = None
+        # Keys of the nodes that helped with shuffling, by player number
+        self.helper_encryption_keys: Dict[int, str] = {}
+        # Helpers in the order they encrypted the deck
+        self.shuffler_player_numbers: List[int] = []
+        self.deck: Optional[Deck] = None
+        self.double_encrypted_deck: Optional[Deck] = None
+        self.deal_results: Optional[Dict[int, str]] = None
+        self.winner_number: Optional[int] = None
+        self.helper_map_who_got_the_cards: Dict[int, bool] = DefaultDict(bool)
+        # Whether I have sent my helper key to the others this round
+        self.helper_key_sent = False
+        self.verifier = IncrementalVerifier(self.notify_changed)
+        self.votes = VoteTracker()
+
+    def all_helper_keys_received(self) -> bool:
+        return len(self.shuffler_player_numbers) > 0 and all(
+            player_number in self.helper_encryption_keys for player_number in self.shuffler_player_numbers
+        )
+
+    # Gives the verifier of the round the keys I know of, the others are added as they arrive
+    def feed_verifier(self):
+        verifier = self.verifier
+        for (player_number, key) in dict(self.helper_encryption_keys).items():
+            verifier.add_key(player_number, key)
+        if self.encryption_key is not None:
+            verifier.add_key(self.leader_node_number, self.encryption_key)
+
+    # Appends a state change to the game log, if it is on. Changes are logged after they are made.
+    def log_change(self, record: Dict[str, Any]):
+        if self.log is not None:
+            self.log.append(record)
+
+    # Waits until the changes logged so far are on disk, so that the node does not confirm a change it can lose in a crash
+    def wait_for_log(self):
+        if self.log is not None:
+            self.log.synced().result()
+
+    def log_membership(self, joined: Iterable[PlayerRecord] = (), left: Iterable[int] = ()):
+        self.log_change({
+            "type": "membership",
+            "epoch": self.membership_epoch,
+            "version": self.nodes.version,
+            "joined": [player.to_json() for player in joined],
+            "left": list(left),
+            "next_player_number": self.next_player_number,
+        })
+
+    def log_node_list(self):
+        (version, nodes) = self.nodes.versioned_json()
+        self.log_change({
+            "type": "node_list",
+            "epoch": self.membership_epoch,
+            "version": version,
+            "nodes": nodes,
+            "next_player_number": self.next_player_number,
+        })
+
+    def log_roles(self):
+        self.log_change({
+            "type": "roles",
+            "own_node_number": self.own_node_number,
+            "leader_node_number": self.leader_node_number,
+            "election_term": self.election_term,
+            "leader_term": self.leader_term,
+        })
+
+    def log_deck(self, deck: Deck):
+        self.log_change({"type": "deck", "deck": base64.b64encode(deck.to_bytes()).decode("ascii")})
+
+    # The whole state of the game, the game log replaces the records before it with this
+    def to_snapshot(self) -> Dict[str, Any]:
+        (version, nodes) = self.nodes.versioned_json()
+        deck = self.double_encrypted_deck
+        return {
+            "next_player_number": self.next_player_number,
+            "own_node_number": self.own_node_number,
+            "leader_node_number": self.leader_node_number,
+            "election_term": self.election_term,
+            "leader_term": self.leader_term,
+            "membership_epoch": self.membership_epoch,
+            "membership_version": version,
+            "nodes": nodes,
+            "round_id": self.round_id,
+            "game_phase": self.game_phase.value,
+            "encryption_key": self.encryption_key,
+            "helper_encryption_keys": {str(player_number): key for (player_number, key) in dict(self.helper_encryption_keys).items()},
+            "shuffler_player_numbers": list(self.shuffler_player_numbers),
+            "double_encrypted_deck": base64.b64encode(deck.to_bytes()).decode("ascii") if deck is not None else None,
+            "deal_results": self.deal_results,
+            "winner_number": self.winner_number,
+            "votes": {str(player_number): agree for (player_number, agree) in dict(self.votes.votes).items()},
+        }
+
+    # Rebuilds the game from its snapshot and the records logged after it, e.g. after a crash
+    def restore(self, snapshot: Optional[Dict[str, Any]], records: List[Dict[str, Any]]):
+        players: Dict[int, PlayerRecord] = {}
+        version = 0
+        if snapshot is not None:
+            self.next_player_number = snapshot["next_player_number"]
+            self._replay_roles(snapshot)
+            self.membership_epoch = snapshot["membership_epoch"]
+            version = snapshot["membership_version"]
+            players = {int(number): PlayerRecord.from_json(player) for (number, player) in snapshot["nodes"].items()}
+            self.round_id = snapshot["round_id"]
+            self.game_phase = GamePhase(snapshot["game_phase"])
+            self.encryption_key = snapshot["encryption_key"]
+            self.helper_encryption_keys = {int(number): key for (number, key) in snapshot["helper_encryption_keys"].items()}
+            self.shuffler_player_numbers = snapshot["shuffler_player_numbers"]
+            if snapshot["double_encrypted_deck"] is not None:
+                self.double_encrypted_deck = Deck.from_bytes(base64.b64decode(snapshot["double_encrypted_deck"]))
+            self.deal_results = snapshot["deal_results"]
+            self.winner_number = snapshot["winner_number"]
+            for (number, agree) in snapshot["votes"].items():
+                self.votes.record(int(number), agree)
+        for record in records:
+            kind = record["type"]
+            if kind == "membership" or kind == "node_list":
+                if kind == "node_list":
+                    players = {}
+                for player in record.get("nodes", {}).values():
+                    players[int(player["player_number"])] = PlayerRecord.from_json(player)
+                for player in record.get("joined", []):
+                    players[int(player["player_number"])] = PlayerRecord.from_json(player)
+                for player_number in record.get("left", []):
+                    players.pop(player_number, None)
+                self.membership_epoch = record["epoch"]
+                version = record["version"]
+                self.next_player_number = max(self.next_player_number, record["next_player_number"])
+            elif kind == "roles":
+                self._replay_roles(record)
+            elif kind == "round":
+                if record["round_id"] > self.round_id:
+                    self.round_id = record["round_id"]
+                    self._reset_game()
+            elif kind == "round_end":
+                if record["round_id"] == self.round_id:
+                    self.ended_round_id = self.round_id
+                    self._reset_game()
+            elif kind == "phase":
+                self.game_phase = GamePhase(record["phase"])
+            elif kind == "helper_key":
+                self.helper_encryption_keys[record["player_number"]] = record["key"]
+            elif kind == "leader_key":
+                self.encryption_key = record["key"]
+            elif kind == "deck":
+                self.double_encrypted_deck = Deck.from_bytes(base64.b64decode(record["deck"]))
+            elif kind == "deal":
+                self.deal_results = record["who_got_what_cards"]
+                self.shuffler_player_numbers = record["shuffler_player_numbers"]
+            elif kind == "winner":
+                self.winner_number = record["winner"]
+            elif kind == "vote":
+                self.votes.record(record["player_number"], record["agree"])
+        self.nodes.replace_all(players.values(), version)
+        self.notify_changed()
+
+    def _replay_roles(self, record: Dict[str, Any]):
+        self.own_node_number = record["own_node_number"]
+        self.leader_node_number = record["leader_node_number"]
+        self.election_term = max(self.election_term, record["election_term"])
+        self.leader_term = max(self.leader_term, record["leader_term"])
+
+    def is_idle(self, now: float) -> bool:
+        idle_for = now - self.last_active
+        if len(self.nodes) == 0:
+            return idle_for > EMPTY_SESSION_TIMEOUT
+        return self.own_node_number not in self.nodes and idle_for > IDLE_SESSION_TIMEOUT
+
+
+# All the games of this node by game id, least recently used first
+SESSIONS: "OrderedDict[str, GameSession]" = OrderedDict()
+sessions_lock = Lock()
+# Idle sessions are looked for at most this often, unless the node is out of sessions
+EVICTION_INTERVAL = 60
+_last_eviction = time.time()
+
+
+def get_session(game_id: str = DEFAULT_GAME_ID) -> GameSession:
+    with sessions_lock:
+        session = SESSIONS.get(game_id)
+        if session is None:
+            if len(SESSIONS) >= MAX_GAME_SESSIONS or time.time() - _last_eviction > EVICTION_INTERVAL:
+                evict_idle_sessions()
+            if len(SESSIONS) >= MAX_GAME_SESSIONS:
+                raise TooManySessions("Too many concurrent games on this node")
+            session = GameSession(game_id)
+            SESSIONS[game_id] = session
+        else:
+            SESSIONS.move_to_end(game_id)
+        session.last_active = time.time()
+        return session
+
+
+# The game if this node knows it, without starting a new one. The default game always exists.
+def find_session(game_id: str) -> Optional[GameSession]:
+    if game_id == DEFAULT_GAME_ID:
+        return get_session(game_id)
+    with sessions_lock:
+        session = SESSIONS.get(game_id)
+        if session is not None:
+            SESSIONS.move_to_end(game_id)
+            session.last_active = time.time()
+        return session
+
+
+# Caller must hold sessions_lock
+def evict_idle_sessions():
+    global _last_eviction
+    now = time.time()
+    _last_eviction = now
+    for (game_id, session) in list(SESSIONS.items()):
+        if game_id != DEFAULT_GAME_ID and session.is_idle(now):
+            log.info("Evicting game %s, this node is not part of it", game_id)
+            del SESSIONS[game_id]
+            if session.log is not None:
+                session.log.close(remove=True)
+
+
+# Forget a game, e.g. after leaving it
+def drop_session(game_id: str):
+    with sessions_lock:
+        session = SESSIONS.pop(game_id, None)
+    if session is not None and session.log is not None:
+        session.log.close(remove=True)
+
+
+# Rebuilds the games of the game log after a restart
+def recover_sessions() -> List[GameSession]:
+    recovered = []
+    for game_id in game_log.saved_games():
+        started = time.time()
+        (snapshot, records) = game_log.read(game_id)
+        session = get_session(game_id)
+        session.restore(snapshot, records)
+        # The recovered state replaces the old log right away
+        if session.log is not None:
+            session.log.request_snapshot()
+        log.info(
+            "Recovered game %s from %s%s log records in %s ms",
+            game_id,
+            "a snapshot and " if snapshot is not None else "",
+            len(records),
+            round((time.time() - started) * 1000),
+        )
+        recovered.append(session)
+    return recovered
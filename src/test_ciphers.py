@@ -0,0 +1,82 @@
+import io
+import itertools
+import unittest
+
+from ciphers import CIPHERS, FernetCipher, SraCipher, decrypt_cards
+from classes import Deck, DeckStreamReader
+
+VALUES = list(range(52))
+# Every order of the SRA layers is tried on a few cards, exponentiations are slow
+FEW_VALUES = [0, 1, 25, 51]
+
+
+class CipherTest(unittest.TestCase):
+    def test_cards_round_trip_through_encoding(self):
+        for cipher_class in CIPHERS.values():
+            with self.subTest(cipher=cipher_class.name):
+                cipher = cipher_class.generate()
+                self.assertEqual(cipher.decode_cards(cipher.encode_cards(VALUES)), VALUES)
+
+    def test_cards_round_trip_through_encryption(self):
+        for cipher_class in CIPHERS.values():
+            with self.subTest(cipher=cipher_class.name):
+                cipher = cipher_class.generate()
+                tokens = cipher.encrypt_batch(cipher.encode_cards(VALUES))
+                self.assertEqual(cipher.decode_cards(cipher.decrypt_batch(tokens)), VALUES)
+
+    def test_sra_layers_come_off_in_any_order(self):
+        ciphers = [SraCipher.generate() for _ in range(3)]
+        tokens = ciphers[0].encode_cards(FEW_VALUES)
+        for cipher in ciphers:
+            tokens = cipher.encrypt_batch(tokens)
+        for order in itertools.permutations(ciphers):
+            decrypted = tokens
+            for cipher in order:
+                decrypted = cipher.decrypt_batch(decrypted)
+            self.assertEqual(ciphers[0].decode_cards(decrypted), FEW_VALUES)
+        combined = SraCipher.combine(ciphers)
+        self.assertEqual(combined.decode_cards(combined.decrypt_batch(tokens)), FEW_VALUES)
+        self.assertEqual(decrypt_cards(tokens, [cipher.key for cipher in ciphers]), FEW_VALUES)
+
+    def test_fernet_layers_come_off_outermost_first(self):
+        ciphers = [FernetCipher.generate() for _ in range(2)]
+        tokens = ciphers[0].encode_cards(VALUES)
+        for cipher in ciphers:
+            tokens = cipher.encrypt_batch(tokens)
+        self.assertEqual(decrypt_cards(tokens, [cipher.key for cipher in reversed(ciphers)]), VALUES)
+
+
+class BinaryDeckTest(unittest.TestCase):
+    def encrypted_deck(self, cipher: str) -> Deck:
+        deck = Deck(cipher=cipher)
+        deck.shuffle()
+        deck.encrypt_all()
+        return deck
+
+    def test_deck_survives_the_binary_format(self):
+        for cipher in CIPHERS:
+            with self.subTest(cipher=cipher):
+                deck = self.encrypted_deck(cipher)
+                parsed = Deck.from_bytes(deck.to_bytes())
+                self.assertEqual(parsed.cipher, cipher)
+                self.assertEqual([bytes(card) for card in parsed.cards], deck.cards)
+
+    def test_streamed_deck_is_read_in_chunks(self):
+        deck = self.encrypted_deck("sra")
+        reader = DeckStreamReader(io.BytesIO(b"".join(deck.iter_bytes(chunk_size=10))))
+        chunks = list(reader.iter_chunks(chunk_size=20))
+        self.assertEqual([len(chunk) for chunk in chunks], [20, 20, 12])
+        self.assertEqual([card for chunk in chunks for card in chunk], deck.cards)
+
+    def test_damaged_decks_are_refused(self):
+        buffer = self.encrypted_deck("fernet").to_bytes()
+        with self.assertRaises(ValueError):
+            Deck.from_bytes(b"XXXX" + buffer[4:])
+        with self.assertRaises(ValueError):
+            Deck.from_bytes(buffer + b"\0")
+        with self.assertRaises(ValueError):
+            list(DeckStreamReader(io.BytesIO(buffer[:-1])).iter_chunks())
+
+
+if __name__ == "__main__":
+    unittest.main()
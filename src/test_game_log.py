@@ -0,0 +1,83 @@
+from unittest import mock
+import os
+import tempfile
+import unittest
+
+import game_log
+from node_registry import PlayerRecord
+import state
+
+GAME_ID = "log-test"
+
+
+class GameLogRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patch in (
+            mock.patch.object(game_log, "GAME_LOG_DIR", directory.name),
+            # The test writes the records itself instead of the background writer
+            mock.patch.object(game_log._writer, "schedule"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.game = state.GameSession(GAME_ID)
+        self.addCleanup(self.game.log.close)
+        self.play(self.game)
+
+    # Joins two players, starts a round and records a key and a vote, logging every change like the handlers do
+    def play(self, game: state.GameSession):
+        game.start_membership_epoch()
+        players = [PlayerRecord(1, "10.0.0.1"), PlayerRecord(2, "10.0.0.2")]
+        for player in players:
+            game.nodes.add(player)
+        game.next_player_number = 3
+        game.own_node_number = 2
+        game.leader_node_number = 1
+        game.log_roles()
+        game.log_membership(joined=players)
+        game.enter_round(1)
+        game.helper_encryption_keys[2] = "helper key"
+        game.log_change({"type": "helper_key", "player_number": 2, "key": "helper key"})
+        game.votes.record(1, True)
+        game.log_change({"type": "vote", "player_number": 1, "agree": True})
+
+    def restored(self) -> state.GameSession:
+        (snapshot, records) = game_log.read(GAME_ID)
+        game = state.GameSession(GAME_ID)
+        game.restore(snapshot, records)
+        return game
+
+    def test_records_are_synced_by_the_writer(self):
+        written = self.game.log.synced()
+        self.assertFalse(written.done())
+        self.game.log.write_pending()
+        self.assertTrue(written.done())
+
+    def test_replaying_the_log_restores_the_game(self):
+        self.game.log.write_pending()
+        (snapshot, records) = game_log.read(GAME_ID)
+        self.assertIsNone(snapshot)
+        self.assertEqual(self.restored().to_snapshot(), self.game.to_snapshot())
+
+    def test_snapshot_replaces_the_records_before_it(self):
+        self.game.log.request_snapshot()
+        self.game.log.write_pending()
+        self.assertEqual(os.path.getsize(self.game.log.path), 0)
+        self.game.votes.record(2, True)
+        self.game.log_change({"type": "vote", "player_number": 2, "agree": True})
+        self.game.log.write_pending()
+        (snapshot, records) = game_log.read(GAME_ID)
+        self.assertIsNotNone(snapshot)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(self.restored().to_snapshot(), self.game.to_snapshot())
+
+    def test_record_cut_short_by_a_crash_ends_the_log(self):
+        self.game.log.write_pending()
+        with open(self.game.log.path, "ab") as log_file:
+            log_file.write(b'{"type":"vote","player_')
+        self.assertEqual(self.restored().to_snapshot(), self.game.to_snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+from unittest import mock
+import unittest
+
+from node_registry import PlayerRecord
+import overlay
+import state
+import voting
+from voting import VoteTracker
+
+
+class VoteTrackerOutcomeTest(unittest.TestCase):
+    def vote(self, *agrees: bool) -> VoteTracker:
+        votes = VoteTracker()
+        for (player_number, agree) in enumerate(agrees, start=1):
+            votes.record(player_number, agree)
+        return votes
+
+    def test_undecided_until_one_side_has_half_of_the_votes(self):
+        self.assertIsNone(self.vote().outcome(5))
+        self.assertIsNone(self.vote(True, True).outcome(5))
+        self.assertIsNone(self.vote(True, False, True, False).outcome(5))
+
+    def test_decided_before_everyone_has_voted(self):
+        self.assertEqual(self.vote(True, True, True).outcome(5), voting.CONFIRMED)
+        self.assertEqual(self.vote(False, True, False, False).outcome(5), voting.CHEATING)
+
+    def test_tie_confirms_the_winner(self):
+        self.assertEqual(self.vote(True, False, False, True).outcome(4), voting.CONFIRMED)
+        self.assertEqual(self.vote(False, False).outcome(4), voting.CHEATING)
+
+    def test_every_complete_vote_is_decided(self):
+        for number_of_voters in range(1, 9):
+            for number_agreeing in range(number_of_voters + 1):
+                votes = self.vote(*([True] * number_agreeing + [False] * (number_of_voters - number_agreeing)))
+                self.assertIsNotNone(votes.outcome(number_of_voters))
+
+    def test_second_vote_of_a_player_is_not_counted(self):
+        votes = self.vote(False)
+        self.assertFalse(votes.record(1, True))
+        self.assertEqual((votes.agree, votes.disagree), (0, 1))
+
+    def test_undecided_vote_times_out_or_is_abandoned(self):
+        votes = self.vote(True)
+        self.assertEqual(votes.result(5, 1, 0).outcome, voting.TIMED_OUT)
+        self.assertEqual(votes.result(5, 1, 0, abandoned=True).outcome, voting.ABANDONED)
+
+
+
+class VoteSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.game = state.GameSession("voting-test")
+        for player_number in range(1, 11):
+            self.game.nodes.add(PlayerRecord(player_number, f"10.0.0.{player_number}"))
+        self.game.own_node_number = 10
+        self.parent = overlay.ancestors(1, self.game.nodes.numbers(), 10)[0]
+
+    def sender(self, remote_player: int, path: str) -> int:
+        return overlay.message_sender(self.game, f"10.0.0.{remote_player}", path).player_number
+
+    def test_vote_passed_on_by_the_parent_counts_for_its_origin(self):
+        with mock.patch.object(overlay, "DISSEMINATION_MODE", "tree"):
+            self.assertNotEqual(self.parent, 1)
+            self.assertEqual(self.sender(self.parent, f"1,{self.parent}"), 1)
+
+    def test_forged_path_counts_for_the_node_that_sent_it(self):
+        forger = next(player_number for player_number in range(2, 10) if player_number != self.parent)
+        with mock.patch.object(overlay, "DISSEMINATION_MODE", "tree"):
+            self.assertEqual(self.sender(forger, f"1,{forger}"), forger)
+            self.assertEqual(self.sender(self.parent, f"1,{forger}"), self.parent)
+
+    def test_path_is_ignored_without_the_tree(self):
+        with mock.patch.object(overlay, "DISSEMINATION_MODE", "direct"):
+            self.assertEqual(self.sender(self.parent, f"1,{self.parent}"), self.parent)
+
+
+if __name__ == "__main__":
+    unittest.main()
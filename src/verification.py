@@ -0,0 +1,94 @@
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence
+
+from ciphers import CIPHERS, SraCipher, cipher_for_key
+from classes import Deck, card_to_token
+
+
+class IncrementalVerifier:
+    """
+    Decrypts the dealt cards of one round layer by layer as the keys arrive, instead of all at once after the winner is known.
+    The highest card is found while the cards are decrypted, and every card is decrypted only once.
+    """
+
+    def __init__(self, on_change: Callable[[], None] = lambda: None):
+        self.lock = Lock()
+        self.on_change = on_change
+        # Keys by the player number of the node that encrypted with them
+        self.keys: Dict[int, str] = {}
+        # Encryption layers still on the cards as player numbers, outermost first
+        self.layers: Optional[List[int]] = None
+        self.commutative = False
+        # The cards by player number, as far as they have been decrypted
+        self.cards: Optional[Dict[int, bytes]] = None
+        self.values: Dict[int, int] = {}
+        self.highest_card = -1
+        self.highest_card_owner: Optional[int] = None
+
+    @property
+    def started(self) -> bool:
+        return self.cards is not None
+
+    @property
+    def done(self) -> bool:
+        return self.layers is not None and len(self.layers) == 0
+
+    # The dealt cards by player number, and the nodes that encrypted them in the order they did it
+    def start(self, cards: Dict[int, bytes], cipher: str, shuffler_player_numbers: Sequence[int], leader_node_number: int):
+        with self.lock:
+            self._start(cards, cipher, shuffler_player_numbers, leader_node_number)
+        self.on_change()
+
+    # Takes the cards from a copy of the deck the same way the leader deals them, one for every player from the top
+    def start_from_deck(self, deck: Deck, player_numbers: Sequence[int], shuffler_player_numbers: Sequence[int], leader_node_number: int):
+        with self.lock:
+            if not self.started:
+                cards = {player_number: deck.pop() for player_number in player_numbers}
+                self._start(cards, deck.cipher, shuffler_player_numbers, leader_node_number)
+        self.on_change()
+
+    def _start(self, cards: Dict[int, bytes], cipher: str, shuffler_player_numbers: Sequence[int], leader_node_number: int):
+        if self.started:
+            return
+        self.cards = {player_number: card_to_token(card) for (player_number, card) in cards.items()}
+        self.layers = list(reversed(shuffler_player_numbers)) + [leader_node_number]
+        self.commutative = CIPHERS[cipher].commutative
+        self._advance()
+
+    def add_key(self, player_number: int, key: str):
+        with self.lock:
+            if player_number in self.keys:
+                return
+            self.keys[player_number] = key
+            self._advance()
+        self.on_change()
+
+    # Removes the layers whose keys are known. Layers of non-commutative ciphers are removed outermost first.
+    def _advance(self):
+        if self.cards is None or self.done:
+            return
+        if self.commutative:
+            removable = [player_number for player_number in self.layers if player_number in self.keys]
+        else:
+            removable = []
+            for player_number in self.layers:
+                if player_number not in self.keys:
+                    break
+                removable.append(player_number)
+        if len(removable) == 0:
+            return
+        ciphers = [cipher_for_key(self.keys[player_number]) for player_number in removable]
+        if len(ciphers) > 1 and self.commutative:
+            ciphers = [SraCipher.combine(ciphers)]
+        players = list(self.cards)
+        tokens = list(self.cards.values())
+        for cipher in ciphers:
+            tokens = cipher.decrypt_batch(tokens)
+        self.cards = dict(zip(players, tokens))
+        self.layers = [player_number for player_number in self.layers if player_number not in removable]
+        if self.done:
+            for (player_number, value) in zip(players, ciphers[-1].decode_cards(tokens)):
+                self.values[player_number] = value
+                if value > self.highest_card:
+                    self.highest_card = value
+                    self.highest_card_owner = player_number
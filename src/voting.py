@@ -0,0 +1,81 @@
+from threading import Lock
+from typing import Dict, Optional
+import math
+import time
+
+# Outcomes of a fairness vote
+CONFIRMED = "confirmed"
+CHEATING = "cheating"
+TIMED_OUT = "timed out"
+# The next round started before the vote was decided
+ABANDONED = "abandoned"
+
+
+class VoteResult:
+    """
+    Outcome of one fairness vote, and how long this node waited for it.
+    """
+
+    __slots__ = ("outcome", "winner_number", "agree", "disagree", "voters", "latency_ms")
+
+    def __init__(self, outcome: str, winner_number: int, agree: int, disagree: int, voters: int, latency_ms: int):
+        self.outcome = outcome
+        self.winner_number = winner_number
+        self.agree = agree
+        self.disagree = disagree
+        self.voters = voters
+        self.latency_ms = latency_ms
+
+    def __repr__(self):
+        return (
+            f"<VoteResult {self.outcome} winner={self.winner_number} agree={self.agree} "
+            f"disagree={self.disagree} of {self.voters} in {self.latency_ms} ms>"
+        )
+
+
+class VoteTracker:
+    """
+    The fairness votes of one game, at most one per player. Like before, half of the nodes agreeing confirms the winner.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.votes: Dict[int, bool] = {}
+        self.agree = 0
+        self.disagree = 0
+
+    # Returns False if the player has already voted
+    def record(self, player_number: int, agree: bool) -> bool:
+        with self.lock:
+            if player_number in self.votes:
+                return False
+            self.votes[player_number] = agree
+            if agree:
+                self.agree += 1
+            else:
+                self.disagree += 1
+            return True
+
+    # The outcome as soon as one side has half of the votes, None before. Once everyone has voted one side always has,
+    # and with an even number of voters a tie confirms the winner.
+    def outcome(self, number_of_voters: int) -> Optional[str]:
+        quorum = math.ceil(number_of_voters / 2)
+        with self.lock:
+            if self.agree >= quorum:
+                return CONFIRMED
+            if self.disagree >= quorum:
+                return CHEATING
+            return None
+
+    # The latency is counted from started, when this node cast its own vote
+    def result(self, number_of_voters: int, winner_number: int, started: float, abandoned: bool = False) -> VoteResult:
+        outcome = self.outcome(number_of_voters) or (ABANDONED if abandoned else TIMED_OUT)
+        with self.lock:
+            return VoteResult(
+                outcome,
+                winner_number,
+                self.agree,
+                self.disagree,
+                number_of_voters,
+                round((time.time() - started) * 1000),
+            )